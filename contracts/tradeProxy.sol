@@ -92,6 +92,7 @@ contract tradeProxy {
     {
         require(msg.sender == owner, "Only the Owner can enable/disable trading");
         enableTrading = _enableTrading;
+        emit enableTradingUpdate(_enableTrading);
     }
     
      /**
@@ -119,6 +120,7 @@ contract tradeProxy {
     {
         require(msg.sender == owner, "Only the Owner can set the fee rate.");
         feeRate = _feeRate; 
+        emit feeRateUpdate(_feeRate);
     }
     
     function setminMinsBtwTrades(uint _minMinsBtwTrades)
@@ -126,6 +128,7 @@ contract tradeProxy {
     {
         require(msg.sender == owner, "Only the Owner can set the minutes between trades.");
         minMinsBtwTrades = _minMinsBtwTrades;
+        emit minMinsBtwTradesUpdate(_minMinsBtwTrades);
     }
     
     function setTraderAddress(address _trader)
@@ -133,6 +136,7 @@ contract tradeProxy {
     {
         require(msg.sender == trader, "Only the Trader can change the Trader's address.");
         trader = _trader; 
+        emit traderUpdate(_trader);
     }
     
     
@@ -350,5 +354,12 @@ contract tradeProxy {
                    bytes32 _destinationCurrencyKey);
                    
     event labelUpdate(string _tradingStrategyLabel);
+    
+    // State change events. These allow the signal server to refresh the state of a contract
+    // only when it changes.
+    event enableTradingUpdate(bool _enableTrading);
+    event feeRateUpdate(uint _feeRate);
+    event minMinsBtwTradesUpdate(uint _minMinsBtwTrades);
+    event traderUpdate(address _trader);
                    
 }
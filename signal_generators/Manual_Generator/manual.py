@@ -9,19 +9,55 @@
     The json encoded file should include a single signal (dictionary) or a list of signals.
     
     An optional second argument can be used to specify the zmq socket (default is "tcp://localhost:6237")
+    
+    With the --ack option, the signals are sent to the acknowledging ROUTER socket of the signal server 
+    (default is "tcp://localhost:6238") and the script waits for each signal to be accepted. Signals without
+    an "id" field are given one.
 """
 
 FN = "signals.json"
 ZMQ_PUSH_SOCKET = "tcp://localhost:6237"
+ZMQ_ACK_SOCKET = "tcp://localhost:6238"
+ACK_TIMEOUT_MS = 10000
+
+import sys, json, zmq, pprint, uuid
 
-import sys, json, zmq, pprint
+def sendWithAck(signals, socket_address):
+    """Sends the signals over a DEALER socket and waits for the acknowledgements.
+    
+    Returns: the number of accepted signals."""
+    context = zmq.Context()
+    sender = context.socket(zmq.DEALER)
+    sender.connect(socket_address)
+    
+    for s in signals:
+        s.setdefault('id', str(uuid.uuid4()))
+        sender.send_string(json.dumps(s))
+    
+    n_accepted = 0
+    waiting = set(s['id'] for s in signals)
+    while waiting:
+        if not sender.poll(ACK_TIMEOUT_MS):
+            print("Timed out waiting for acknowledgements of: {}".format(sorted(waiting)))
+            break
+        ack = json.loads(sender.recv())
+        waiting.discard(ack['id'])
+        if ack['status'] == 'accepted':
+            n_accepted += 1
+        print("Signal {}: {}{}".format(ack['id'], ack['status'], ". " + ack['error'] if ack['error'] else ""))
+    return n_accepted
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        FN = sys.argv[1]
+    ack = "--ack" in sys.argv
+    args = [a for a in sys.argv if a != "--ack"]
+    if ack:
+        ZMQ_PUSH_SOCKET = ZMQ_ACK_SOCKET
+    
+    if len(args) > 1:
+        FN = args[1]
         
-    if len(sys.argv) > 2:
-        ZMQ_PUSH_SOCKET = sys.argv[2]        
+    if len(args) > 2:
+        ZMQ_PUSH_SOCKET = args[2]        
         
     try:   
         signals = json.load(open(FN, "r"))
@@ -31,6 +67,11 @@ if __name__ == "__main__":
     
     if type(signals) == dict:
         signals = [signals]
+    
+    if ack:
+        n = sendWithAck(signals, ZMQ_PUSH_SOCKET)
+        print("Finished transmitting signals. Number accepted: {} of {}".format(n, len(signals)))
+        sys.exit(0 if n == len(signals) else 1)
         
     context = zmq.Context()
     sender = context.socket(zmq.PUSH)
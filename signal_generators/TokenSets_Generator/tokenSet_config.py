@@ -9,11 +9,52 @@ zmqPushSocket = "tcp://localhost:6237"
 #
 # network = "mainnet" or "kovan"
 network = "mainnet"
+#The url can also be a list of node urls, used as a pool (see signal_server/lib/EndpointPool.py): reads go to the
+#fastest endpoint and are hedged on another one after RPC_HEDGE_MIN_MS..RPC_HEDGE_MAX_MS, failing endpoints are ejected.
 def getConnectionUrl():
     if network == "kovan":
         return  """KOVAN NODE URL GOES HERE"""
     elif network == "mainnet":
         return """https://grossly-becoming-sailfish.quiknode.io/6e1c4338-e2be-48ae-be0e-aa7dba60c684/OhIG80rMIgd9CHXQstdQTg==/"""
+
+#Requests made within this window are merged into one JSON-RPC batch request (0 to disable)
+RPC_BATCH_WINDOW_MS = 2
+RPC_HEDGE_MIN_MS = 50
+RPC_HEDGE_MAX_MS = 1000
+RPC_BREAKER_FAILURES = 3
+RPC_BREAKER_COOLDOWN_SECS = 30
+
+def getMulticallAddress():
+    """address of the Multicall contract used to aggregate reads (None to make each call separately)"""
+    if network == "kovan":
+        return "0x2cc8688C5f75E365aaEEb4ea8D6a480405A48D2A"
+    elif network == "mainnet":
+        return "0xeefBa1e63905eF1D7ACbA5a8513c70307C1cE441"
+
+#the maximum number of calls aggregated into a single eth_call
+MULTICALL_BATCH_SIZE = 300
+
+#The symbols of the setToken addresses and the active sets are cached in this file (keyed by block number),
+#so a restart does not have to rediscover them. None to disable.
+setToken_cache_fn = "setToken_cache.json"
+
+#how often the block number is polled. The rebalancing states are read once per new block.
+BLOCK_POLL_SECS = 1
+
+#The sets that are rebalancing (and whether their signal was sent) are journaled to this SQLite file and
+#restored at startup. None to disable.
+journal_fn = "generator_journal.db"
+
+#Log records are written as JSON lines to log_fn, which is rotated at LOG_MAX_MB (LOG_BACKUPS files are kept).
+log_fn = "logger.jsonl"
+LOG_MAX_MB = 50
+LOG_BACKUPS = 5
+
+#Metrics (Prometheus text format) are served on http://127.0.0.1:METRICS_PORT/metrics (None to disable).
+#If PROFILER_ENABLED, http://127.0.0.1:METRICS_PORT/profile?seconds=10 samples the stacks of the generator.
+METRICS_PORT = 9102
+PROFILER_ENABLED = False
+
 def getCoreAddress():
     """address of the tokenSet 'core' module"""
     if network == "kovan":
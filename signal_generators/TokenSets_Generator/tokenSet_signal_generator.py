@@ -1,36 +1,113 @@
 
-import web3, json, time, datetime,sys, zmq
+import web3, json, time, datetime,sys, zmq, os
 import tokenSet_config as cfg
 
+#The generator shares the RPC helpers (lib/) of the signal server: run it with signal_server on the PYTHONPATH
+import lib.EndpointPool, lib.Multicall, lib.Journal, lib.Metrics, lib.AsyncLogger
 
-def log(s):
-    dt = datetime.datetime.now().strftime("%m-%d %H:%M:%S")
-    print(dt + " " + s)
-    with open("logger.log" , 'a') as f:
-        f.write(dt + " " + s + '\n')   
+DETECT_SECONDS = lib.Metrics.histogram("detect_pass_seconds", "Duration of the evaluation of the sets for one block")
+DETECTION_BLOCKS = lib.Metrics.histogram("detection_latency_blocks", "Blocks between a trigger threshold crossing and "
+                                         "its signal", [], lib.Metrics.BLOCK_BUCKETS)
+TRIGGERS = lib.Metrics.counter("rebalance_triggers_total", "Signals sent for rebalancing sets", ["symbol"])
+EVALUATED_BLOCK = lib.Metrics.gauge("detect_last_block", "Last block evaluated by the detection loop")
+SKIPPED_BLOCKS = lib.Metrics.counter("detect_skipped_blocks_total", "Blocks that were not evaluated")
 
-def fetchActiveSetTokens(core_k, w3, monitored_symbols):
-    setToken_abi = json.load(open("setToken-contract-abi.json", "r"))
-    setToken_addresses = core_k.functions.setTokens().call()
-    active_setTokens = {}
-    for addr in setToken_addresses:
-        r = core_k.functions.validSets(addr).call()
-        if r:
-            st_k = w3.eth.contract(address = addr, abi = setToken_abi)
-            symbol = st_k.functions.symbol().call()
-            if symbol in monitored_symbols:
-                d = {'symbol': symbol, 'addr': addr, 'contract': st_k}
-                active_setTokens[symbol] = d
-    return active_setTokens
 
-def fetchRebalancing(active_setTokens):
-    """Returns a set of the symbols that have a state == 2 (rebalancing)"""
-    r = set()
-    for _symbol, d in active_setTokens.items():
-        state = d['contract'].functions.rebalanceState().call()
-        if state == 2:
-            r.add(d['symbol'])
-    return r
+#log records are written to a rotating JSON lines file by a background thread
+log = lib.AsyncLogger.AsyncLogger(cfg.log_fn, cfg.LOG_MAX_MB, cfg.LOG_BACKUPS)
+
+def loadSetTokenCache(fn):
+    """Returns the setToken cache: {'block': block number of the last refresh, 'symbols': {addr: symbol}, 
+    'active': {symbol: addr}}. Symbols never change, so only new setToken addresses need to be read."""
+    if fn and os.path.exists(fn):
+        return json.load(open(fn, "r"))
+    return {'block': None, 'symbols': {}, 'active': {}}
+
+def saveSetTokenCache(fn, cache):
+    if not fn:
+        return
+    with open(fn + ".tmp", "w") as f:
+        json.dump(cache, f)
+    os.replace(fn + ".tmp", fn)
+
+def activeSetTokens(cache, w3, setToken_abi):
+    """Builds the {symbol: {symbol, addr, contract}} dictionary of the active sets in the cache."""
+    return {symbol: {'symbol': symbol, 'addr': addr, 'contract': w3.eth.contract(address = addr, abi = setToken_abi)}
+            for symbol, addr in cache['active'].items()}
+
+def fetchActiveSetTokens(core_k, w3, multicall, setToken_abi, monitored_symbols, cache):
+    """Refreshes the cache incrementally and returns the active sets of the monitored symbols.
+    
+    The symbols of the new setToken addresses are read with one aggregated call. The validSets flag can 
+    change, so it is re-read for the addresses of the monitored symbols only (also aggregated)."""
+    block_number = w3.eth.blockNumber
+    setToken_addresses = core_k.functions.setTokens().call(block_identifier = block_number)
+    
+    new_addresses = [addr for addr in setToken_addresses if addr not in cache['symbols']]
+    if new_addresses:
+        calls = [(addr, lib.Multicall.encodeCall('symbol()'), ['string']) for addr in new_addresses]
+        _block, results = multicall.aggregate(calls, block_number)
+        for addr, r in zip(new_addresses, results):
+            if r is not None:    #not cached if the call failed, so it is retried at the next refresh
+                cache['symbols'][addr] = r[0]
+        log("Read the symbols of {} new setToken addresses".format(len(new_addresses)))
+    
+    candidates = [addr for addr in setToken_addresses if cache['symbols'].get(addr) in monitored_symbols]
+    calls = [(core_k.address, lib.Multicall.encodeCall('validSets(address)', ['address'], [addr]), ['bool'])
+             for addr in candidates]
+    _block, results = multicall.aggregate(calls, block_number)
+    cache['active'] = {cache['symbols'][addr]: addr for addr, r in zip(candidates, results) if r is not None and r[0]}
+    cache['block'] = block_number
+    return activeSetTokens(cache, w3, setToken_abi)
+
+REBALANCING_STATE = 2
+
+def fetchSetStates(multicall, active_setTokens, block_number):
+    """Reads the rebalanceState and biddingParameters of every active set with one aggregated call, pinned 
+    to block_number.
+    
+    Returns: {symbol: (rebalance_state, remaining_shares)}. Sets whose state could not be read are left out.
+    remaining_shares is None if only biddingParameters failed."""
+    symbols = sorted(active_setTokens)
+    calls = []
+    for symbol in symbols:
+        addr = active_setTokens[symbol]['addr']
+        calls.append((addr, lib.Multicall.encodeCall('rebalanceState()'), ['uint8']))
+        calls.append((addr, lib.Multicall.encodeCall('biddingParameters()'), ['uint256', 'uint256']))
+    _block, results = multicall.aggregate(calls, block_number)
+    
+    states = {}
+    for i, symbol in enumerate(symbols):
+        state, bidding = results[2 * i], results[2 * i + 1]
+        if state is not None:
+            states[symbol] = (state[0], bidding[1] if bidding is not None else None)
+    return states
+
+def detectTriggers(states, rebalancing, block_number):
+    """Evaluates the trigger predicates on the states of one block.
+    
+    rebalancing: {symbol: {'initial_remaining', 'start_block', 'triggered'}} of the sets being tracked. It is 
+                 updated in place: sets that start rebalancing are added and sets that are no longer 
+                 rebalancing are removed (whether they triggered or not). A set triggers once per rebalance,
+                 and only while it is rebalancing.
+    
+    Returns: list of the symbols whose signal must be sent (half of the remaining shares were filled)."""
+    triggered = []
+    for symbol, (state, remaining) in states.items():
+        d = rebalancing.get(symbol)
+        if state != REBALANCING_STATE:
+            if d is not None:
+                del rebalancing[symbol]
+                if not d['triggered']:
+                    log("Rebalancing of symbol: {} ended in block {} before it triggered".format(symbol, block_number))
+        elif d is None:
+            if remaining is not None:
+                rebalancing[symbol] = {'initial_remaining': remaining, 'start_block': block_number, 'triggered': False}
+                log("Rebalancing beginning detected for symbol: {} in block {}".format(symbol, block_number))
+        elif not d['triggered'] and remaining is not None and remaining <= d['initial_remaining'] / 2:
+            triggered.append(symbol)
+            d['triggered'] = True
+    return triggered
 
 def main():
     log("Starting main loop of tokenSet signal generator .. scanning for set rebalancing.")
@@ -39,58 +116,79 @@ def main():
     monitored_symbols = list(cfg.tokenSet_symbols.keys())
     log("Symbols that are being monitored are: {}".format(monitored_symbols))
     abi_core = json.load(open("abi_core.json", "r"))
-    provider = web3.Web3.HTTPProvider(cfg.getConnectionUrl())
+    setToken_abi = json.load(open("setToken-contract-abi.json", "r"))
+    provider = lib.EndpointPool.makeProvider(cfg.getConnectionUrl(), cfg.RPC_BATCH_WINDOW_MS, hedge_min_ms = cfg.RPC_HEDGE_MIN_MS,
+                                             hedge_max_ms = cfg.RPC_HEDGE_MAX_MS, breaker_failures = cfg.RPC_BREAKER_FAILURES,
+                                             breaker_cooldown_secs = cfg.RPC_BREAKER_COOLDOWN_SECS)
     w3 = web3.Web3(provider)
+    w3.middleware_onion.add(lib.Metrics.rpcMiddleware, "metrics")
+    if cfg.METRICS_PORT:
+        lib.Metrics.startServer(cfg.METRICS_PORT, profiler = cfg.PROFILER_ENABLED)
     core_k = w3.eth.contract(address = cfg.getCoreAddress(), abi = abi_core)  
+    multicall = lib.Multicall.Multicall(w3, cfg.getMulticallAddress(), cfg.MULTICALL_BATCH_SIZE, log)
     
     #zmq socket initialization
     context = zmq.Context()
     sender = context.socket(zmq.PUSH)
     sender.connect(cfg.zmqPushSocket)
     
-    #State variables
-    rebalancing_tokens = set()
-    active_setTokens = {}
-    last_active_tokenSet_fetch = 0
+    #State variables. The rebalancing sets are journaled so that a restart neither misses nor repeats a trigger.
+    journal = lib.Journal.Journal(cfg.journal_fn, log) if cfg.journal_fn else None
+    #symbol => {'initial_remaining', 'start_block', 'triggered'} of the sets that are rebalancing
+    rebalancing = journal.getState('rebalancing', {}) if journal is not None else {}
+    #The active sets are taken from the cache at startup and refreshed (incrementally) an hour later 
+    setToken_cache = loadSetTokenCache(cfg.setToken_cache_fn)
+    active_setTokens = activeSetTokens(setToken_cache, w3, setToken_abi)
+    last_active_tokenSet_fetch = time.time() if setToken_cache['block'] is not None else 0
+    last_block = None    #last block whose states were evaluated
     ONE_HOUR = 60 * 60
     
-    #Main loop
+    #Main loop. All of the monitored sets are evaluated once per new block.
     while True:
         
         #For each monitored setToken, build a dictionary of the fields:
         # {symbol, addr, contract}. Rebuild active sets no more than once and hour and only
-        #if there are no currently rebalancing sets.
-        if time.time() - last_active_tokenSet_fetch > ONE_HOUR and len(rebalancing_tokens) == 0:
-            active_setTokens = fetchActiveSetTokens(core_k, w3, monitored_symbols) 
+        #if none of the active sets is rebalancing (the tracked sets that are not active, e.g. restored
+        #from the journal, can't end their rebalance until they are active again).
+        if (time.time() - last_active_tokenSet_fetch > ONE_HOUR
+                and not any(symbol in active_setTokens for symbol in rebalancing)):
+            active_setTokens = fetchActiveSetTokens(core_k, w3, multicall, setToken_abi, monitored_symbols, setToken_cache) 
+            saveSetTokenCache(cfg.setToken_cache_fn, setToken_cache)
             last_active_tokenSet_fetch = time.time()
-            
-        # Get set of the active tokens that are rebalancing
-        _rebalancing_tokens = fetchRebalancing(active_setTokens)   
-        new_rebalancing = _rebalancing_tokens - rebalancing_tokens
-        
-        
-        for symbol in new_rebalancing:
-            k = active_setTokens[symbol]['contract']
-            remain_shares = k.functions.biddingParameters().call()[1]
-            active_setTokens[symbol]['initial_remaining'] = remain_shares
-            rebalancing_tokens.add(symbol)
-            log("Rebalancing beginning detected for symbol: " + symbol)
+            inactive = [symbol for symbol in rebalancing if symbol not in active_setTokens]
+            for symbol in inactive:
+                log("Symbol: {} is no longer an active set, its rebalance is not tracked".format(symbol))
+                del rebalancing[symbol]
+            if inactive and journal is not None:
+                journal.setState('rebalancing', rebalancing)
         
-        remove_tokens = set()
-        for symbol in rebalancing_tokens:
-            k = active_setTokens[symbol]['contract']
-            remain_shares = k.functions.biddingParameters().call()[1]
-            if remain_shares <= active_setTokens[symbol]['initial_remaining']/2:
-                #generate signal and send over the zeroMQ channel. 
-                signal = cfg.tokenSet_symbols[symbol]
-                signal['execution_time'] = 'NOW'
-                signal['name'] = symbol
-                sender.send(json.dumps(signal))
-                log("Rebalance Execution detected for symbol: " + symbol)
-                remove_tokens.add(symbol)
-        rebalancing_tokens = rebalancing_tokens - remove_tokens
+        block_number = w3.eth.blockNumber
+        if block_number == last_block:
+            time.sleep(cfg.BLOCK_POLL_SECS)
+            continue
         
-        time.sleep(60)
+        start = time.time()
+        states = fetchSetStates(multicall, active_setTokens, block_number)
+        previous = json.dumps(rebalancing, sort_keys = True)
+        for symbol in detectTriggers(states, rebalancing, block_number):
+            #generate signal and send over the zeroMQ channel. The id lets the server drop a repeated signal.
+            signal = dict(cfg.tokenSet_symbols[symbol], execution_time = 'NOW', name = symbol,
+                          id = "{}-{}".format(symbol, rebalancing[symbol]['start_block']))
+            sender.send_string(json.dumps(signal))
+            #the threshold was crossed in one of the blocks after last_block
+            latency = block_number - (last_block + 1 if last_block is not None else block_number)
+            DETECTION_BLOCKS.observe(latency)
+            TRIGGERS.inc(symbol = symbol)
+            log("Rebalance Execution detected for symbol: {} in block {} ({} blocks after the rebalance start). "
+                "Detection latency: {} block(s)".format(symbol, block_number, 
+                                                        block_number - rebalancing[symbol]['start_block'], latency))
+        if journal is not None and json.dumps(rebalancing, sort_keys = True) != previous:
+            journal.setState('rebalancing', rebalancing)
+        DETECT_SECONDS.observe(time.time() - start)
+        EVALUATED_BLOCK.set(block_number)
+        if last_block is not None and block_number > last_block + 1:
+            SKIPPED_BLOCKS.inc(block_number - last_block - 1)
+        last_block = block_number
     
 if __name__ == "__main__":
     try:
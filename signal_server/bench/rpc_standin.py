@@ -0,0 +1,223 @@
+"""In-process JSON-RPC stand-in for an Ethereum node, used by the benchmarks.
+
+It emulates the contracts the server talks to: the tradeProxy contracts (getters, and trade simulated with
+eth_estimateGas), the Synthetix contract (gasPriceLimit, synths, effectiveValue), the synth contracts
+(balanceOf) and a Multicall contract (aggregate). Transactions are accepted and recorded but never mined;
+eth_getTransactionByHash finds them as pending.
+
+The node is served over HTTP on a local port (JSON-RPC batches are supported), so that the real providers
+are exercised. Each HTTP request is delayed by rtt_ms and each JSON-RPC call by call_ms. Several stand-ins can
+serve as the endpoints of a lib.EndpointPool; http_status makes one fail (e.g. 503), rpc_error makes it answer
+every call with a JSON-RPC error (e.g. "header not found") and rtt slows it down.
+"""
+import json, threading, time, socket
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import web3, eth_abi
+from eth_account import Account
+
+SYNTHETIX_ADDRESS = web3.Web3.toChecksumAddress("0x" + "5e" * 20)
+MULTICALL_ADDRESS = web3.Web3.toChecksumAddress("0x" + "ca" * 20)
+OWNER_ADDRESS = web3.Web3.toChecksumAddress("0x" + "0e" * 20)
+CHAIN_ID = 42
+
+def _selector(signature):
+    return bytes(web3.Web3.keccak(text = signature)[:4])
+
+def contractAddress(i):
+    """Address of the i-th generated tradeProxy contract."""
+    return web3.Web3.toChecksumAddress("0x" + "c0" + "%038x" % i)
+
+def synthAddress(currency_key):
+    """Address of the synth contract of a bytes32 currency key."""
+    return web3.Web3.toChecksumAddress("0x" + "5f" + bytes(web3.Web3.keccak(currency_key)[:19]).hex())
+
+def traderKey(i):
+    """Private key of the i-th generated trader account."""
+    return web3.Web3.keccak(text = "bench trader {}".format(i)).hex()
+
+
+class RPCStandIn():
+    """ JSON-RPC node with n_contracts tradeProxy contracts, whose traders are n_traders generated accounts.
+
+        The contracts are labeled labels[i % len(labels)], have trading enabled and hold balance of every synth.
+        Setting contracts[address]['eligible'] = False makes isTradeEligible() false and trade revert.
+
+        counters holds the number of HTTP requests, of JSON-RPC calls per method and of calls aggregated by
+        Multicall. sent holds the (timestamp, raw tx hash) of every eth_sendRawTransaction.
+    """
+    GETTERS = {'enableTrading()': ('bool', lambda c: c['enableTrading']),
+               'feeRate()': ('uint256', lambda c: c['feeRate']),
+               'minMinsBtwTrades()': ('uint256', lambda c: c['minMinsBtwTrades']),
+               'trader()': ('address', lambda c: c['trader']),
+               'owner()': ('address', lambda c: c['owner']),
+               'tradingStrategyLabel()': ('string', lambda c: c['tradingStrategyLabel']),
+               'isTradeEligible()': ('bool', lambda c: c.get('eligible', True))}
+    TRADE_GAS = 150000
+
+    def __init__(self, n_contracts, n_traders = 10, labels = ("BENCH",), rtt_ms = 0, call_ms = 0,
+                 balance = 10**18, block_secs = None):
+        """
+        block_secs: if given, a new block is produced every block_secs. Otherwise the block number is fixed.
+        """
+        self.rtt = rtt_ms / 1000.
+        self.http_status = 200   #any other status is returned without a body
+        self.rpc_error = None    #if set, the message of the JSON-RPC error returned for every call
+        self.call_latency = call_ms / 1000.
+        self.balance = balance
+        self.block_secs = block_secs
+        self.start_ts = time.time()
+
+        self.trader_keys = {}    #trader address => private key
+        for i in range(max(1, n_traders)):
+            key = traderKey(i)
+            self.trader_keys[Account.from_key(key).address] = key
+        traders = sorted(self.trader_keys)
+
+        self.contracts = {}
+        for i in range(n_contracts):
+            self.contracts[contractAddress(i)] = {'enableTrading': True, 'feeRate': 100, 'minMinsBtwTrades': 0,
+                                                  'trader': traders[i % len(traders)], 'owner': OWNER_ADDRESS,
+                                                  'tradingStrategyLabel': labels[i % len(labels)]}
+
+        self.getters = {_selector(sig): getter for sig, getter in self.GETTERS.items()}
+        self.sent = []
+        self.counters = {}
+        self._lock = threading.Lock()
+        self.server = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def start(self):
+        standin = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def log_message(self, *args):
+                pass
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                #the headers and the body are written separately; don't let Nagle delay the body
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                if standin.http_status != 200:
+                    standin._count('http_errors')
+                    self.send_response(standin.http_status)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                data = json.dumps(standin.handle(body)).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def resetCounters(self):
+        with self._lock:
+            self.counters = {}
+            self.sent = []
+
+    def blockNumber(self):
+        if self.block_secs:
+            return 1000 + int((time.time() - self.start_ts) / self.block_secs)
+        return 1000
+
+    def handle(self, body):
+        """Handles a JSON-RPC request or batch."""
+        self._count('http_requests')
+        time.sleep(self.rtt)
+        if isinstance(body, list):
+            return [self._handleOne(r) for r in body]
+        return self._handleOne(body)
+
+    def _handleOne(self, request):
+        self._count(request['method'])
+        time.sleep(self.call_latency)
+        if self.rpc_error is not None:
+            return {'jsonrpc': '2.0', 'id': request['id'], 'error': {'code': -32000, 'message': self.rpc_error}}
+        try:
+            result = self._dispatch(request['method'], request.get('params', []))
+            return {'jsonrpc': '2.0', 'id': request['id'], 'result': result}
+        except Exception as e:
+            return {'jsonrpc': '2.0', 'id': request['id'], 'error': {'code': -32000, 'message': str(e)}}
+
+    def _dispatch(self, method, params):
+        if method == 'eth_blockNumber':
+            return hex(self.blockNumber())
+        if method in ('eth_chainId', 'net_version'):
+            return hex(CHAIN_ID) if method == 'eth_chainId' else str(CHAIN_ID)
+        if method == 'eth_gasPrice':
+            return hex(10**9)
+        if method == 'eth_getTransactionCount':
+            return '0x0'
+        if method == 'eth_getLogs':
+            return []
+        if method == 'eth_getTransactionByHash':
+            with self._lock:
+                known = any(tx_hash == params[0] for _ts, tx_hash in self.sent)
+            return {'hash': params[0], 'blockHash': None, 'blockNumber': None} if known else None
+        if method == 'eth_getTransactionReceipt':
+            return None
+        if method == 'eth_sendRawTransaction':
+            tx_hash = web3.Web3.keccak(hexstr = params[0]).hex()
+            with self._lock:
+                self.sent.append((time.time(), tx_hash))
+            return tx_hash
+        if method == 'eth_estimateGas':
+            return hex(self._estimateTrade(params[0]))
+        if method == 'eth_call':
+            tx = params[0]
+            return "0x" + self._call(web3.Web3.toChecksumAddress(tx['to']), bytes.fromhex(tx['data'][2:])).hex()
+        raise ValueError("method not supported: {}".format(method))
+
+    def _call(self, to, data):
+        sel = data[:4]
+        if to == MULTICALL_ADDRESS:
+            if sel != _selector('aggregate((address,bytes)[])'):
+                raise ValueError("execution reverted")
+            (calls,) = eth_abi.decode_abi(['(address,bytes)[]'], data[4:])
+            self._count('multicall_calls', len(calls))
+            return_data = [self._call(web3.Web3.toChecksumAddress(target), bytes(calldata)) for target, calldata in calls]
+            return eth_abi.encode_abi(['uint256', 'bytes[]'], [self.blockNumber(), return_data])
+        if to == SYNTHETIX_ADDRESS:
+            if sel == _selector('gasPriceLimit()'):
+                return eth_abi.encode_abi(['uint256'], [5 * 10**9])
+            if sel == _selector('synths(bytes32)'):
+                return eth_abi.encode_abi(['address'], [synthAddress(data[4:36])])
+            if sel == _selector('effectiveValue(bytes32,uint256,bytes32)'):
+                _src, amount, _dst = eth_abi.decode_abi(['bytes32', 'uint256', 'bytes32'], data[4:])
+                return eth_abi.encode_abi(['uint256'], [amount])
+            raise ValueError("execution reverted")
+        if sel == _selector('balanceOf(address)'):
+            return eth_abi.encode_abi(['uint256'], [self.balance])
+        contract = self.contracts.get(to)
+        if contract is None or sel not in self.getters:
+            raise ValueError("execution reverted")
+        output_type, getter = self.getters[sel]
+        return eth_abi.encode_abi([output_type], [getter(contract)])
+
+    def _estimateTrade(self, tx):
+        """Checks the requires of tradeProxy.trade for a tx. Returns its gas."""
+        contract = self.contracts.get(web3.Web3.toChecksumAddress(tx['to']))
+        data = bytes.fromhex(tx['data'][2:])
+        if contract is None or data[:4] != _selector('trade(bytes32,uint256,bytes32,uint256)'):
+            raise ValueError("execution reverted")
+        _src, amount, _dst, min_fee_rate = eth_abi.decode_abi(['bytes32', 'uint256', 'bytes32', 'uint256'], data[4:])
+        if (web3.Web3.toChecksumAddress(tx['from']) != contract['trader'] or not contract['enableTrading']
+                or not contract.get('eligible', True) or contract['feeRate'] < min_fee_rate or amount > self.balance):
+            raise ValueError("execution reverted")
+        return self.TRADE_GAS
+
+    def _count(self, key, n = 1):
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
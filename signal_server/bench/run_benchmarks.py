@@ -0,0 +1,156 @@
+"""Benchmarks of the signal server against a local JSON-RPC stand-in (see bench/rpc_standin.py).
+
+For each number of monitored contracts it measures:
+- the ContractMonitor initial read and full refresh times
+- the signal-to-first-broadcast and signal-to-last-broadcast latencies of a fan-out of a type3 signal
+  to all of the contracts (broadcast = the stand-in received the eth_sendRawTransaction)
+- the number of HTTP requests, JSON-RPC calls (per method) and aggregated calls of each phase
+
+The server components are configured from server_config (batch sizes, RPC batching, fan-out workers).
+Results are written as JSON, so runs of different releases can be compared.
+
+Run from the signal_server directory:
+    python -m bench.run_benchmarks --sizes 10,100,1000,10000 --rtt-ms 5 --out bench_results.json
+"""
+import argparse, json, os, platform, statistics, subprocess, tempfile, time
+import web3
+import lib.EndpointPool, lib.ContractMonitor, lib.TradeExecutor, lib.FanoutExecutor, lib.BulkSigner, lib.Preflight
+import server_config as cfg
+from bench.rpc_standin import RPCStandIn, SYNTHETIX_ADDRESS, MULTICALL_ADDRESS
+
+LABEL = "BENCH"
+SIGNAL = {"type": "type3", "name": LABEL, "execution_time": "NOW", "params": {"pairs": [["sUSD", "sETH"]]}}
+
+
+class _Logger():
+    """Collects the log records of the server components (they are not printed), and counts the error records
+    (logged with level = "error", see lib.AsyncLogger)."""
+    def __init__(self):
+        self.lines = []
+        self.errors = 0
+    def __call__(self, s, **fields):
+        self.lines.append(s)
+        if fields.get('level') == "error":
+            self.errors += 1
+
+
+def _rpcCounts(standin):
+    return dict(standin.counters)
+
+def _web3(standins):
+    """Returns a web3.Web3 for a stand-in, or for a list of stand-ins served by a lib.EndpointPool."""
+    urls = [s.url for s in standins] if isinstance(standins, list) else standins.url
+    provider = lib.EndpointPool.makeProvider(urls, cfg.RPC_BATCH_WINDOW_MS, cfg.RPC_POOL_SIZE,
+                                             hedge_min_ms = cfg.RPC_HEDGE_MIN_MS, hedge_max_ms = cfg.RPC_HEDGE_MAX_MS,
+                                             breaker_failures = cfg.RPC_BREAKER_FAILURES,
+                                             breaker_cooldown_secs = cfg.RPC_BREAKER_COOLDOWN_SECS)
+    return web3.Web3(provider)
+
+def benchMonitor(standin, contracts_fn, logger):
+    """Returns the ContractMonitor and its timings and RPC counts."""
+    w3 = _web3(standin)
+    standin.resetCounters()
+    start = time.time()
+    cm = lib.ContractMonitor.ContractMonitor(w3, contracts_fn, logger, MULTICALL_ADDRESS, cfg.MULTICALL_BATCH_SIZE)
+    init_secs = time.time() - start
+    init_rpc = _rpcCounts(standin)
+
+    standin.resetCounters()
+    start = time.time()
+    cm.updateStates(cm.getAllMonitoredAddresses())
+    refresh_secs = time.time() - start
+    return cm, {'monitor_init_secs': init_secs, 'monitor_init_rpc': init_rpc,
+                'monitor_refresh_secs': refresh_secs, 'monitor_refresh_rpc': _rpcCounts(standin),
+                'monitored_contracts': len(cm.contract_state)}
+
+def benchFanout(standin, cm, logger, repeat, signing_processes = cfg.SIGNING_PROCESSES, preflight = cfg.PREFLIGHT_ENABLED):
+    """Executes the signal on all of the contracts repeat times. Returns the median latencies and the RPC
+    counts of the last run. If signing_processes is not 0, the txes are signed by a BulkSigner (None: in as
+    many processes as cpus). If preflight, the txes are simulated by a Preflight before they are signed. Both
+    default to the server configuration."""
+    w3 = _web3(standin)
+    te = lib.TradeExecutor.TradeExecutor(w3, SYNTHETIX_ADDRESS, standin.trader_keys, "kovan", 0, logger,
+                                         MULTICALL_ADDRESS, cfg.MULTICALL_BATCH_SIZE)
+    signer = None
+    if signing_processes != 0:
+        signer = lib.BulkSigner.BulkSigner(standin.trader_keys, signing_processes, logger, cfg.BULK_SIGN_MIN_BATCH)
+    fe = lib.FanoutExecutor.FanoutExecutor(te, cfg.MAX_FANOUT_WORKERS, 0, logger, signer = signer,
+                                           preflight = lib.Preflight.Preflight(w3, te.multicall, logger, cfg.GAS_LIMIT_MARGIN_PCT)
+                                                       if preflight else None)
+
+    first = []; last = []; total = []
+    for _ in range(repeat):
+        standin.resetCounters()
+        start = time.time()
+        results = fe.execute(dict(SIGNAL), cm.getStatesThatMatchLabel(LABEL))
+        total.append(time.time() - start)
+        sent = [ts for ts, _hash in standin.sent]
+        if sent:
+            first.append(min(sent) - start)
+            last.append(max(sent) - start)
+    n_txes = sum(len(tx_hashes) for _address, tx_hashes, _ts in results)
+    if signer is not None:
+        signer.shutdown()
+    ms = lambda v: statistics.median(v) * 1000 if v else None
+    return {'signal_to_first_broadcast_ms': ms(first), 'signal_to_last_broadcast_ms': ms(last),
+            'fanout_total_ms': ms(total), 'fanout_txes': n_txes, 'fanout_rpc': _rpcCounts(standin)}
+
+def runSize(n_contracts, args):
+    standin = RPCStandIn(n_contracts, args.traders, (LABEL,), args.rtt_ms, args.call_ms).start()
+    logger = _Logger()
+    fd, contracts_fn = tempfile.mkstemp(suffix = ".json")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(sorted(standin.contracts), f)
+        cm, result = benchMonitor(standin, contracts_fn, logger)
+        result.update(benchFanout(standin, cm, logger, args.repeat, args.signing_processes, args.preflight))
+    finally:
+        os.remove(contracts_fn)
+        standin.stop()
+    result['contracts'] = n_contracts
+    result['errors'] = logger.errors
+    return result
+
+def _gitRevision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr = subprocess.DEVNULL).decode().strip()
+    except:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description = "Signal server benchmarks against a local JSON-RPC stand-in")
+    parser.add_argument("--sizes", default = "10,100,1000,10000", help = "comma separated numbers of contracts")
+    parser.add_argument("--traders", type = int, default = 50, help = "number of trader accounts")
+    parser.add_argument("--rtt-ms", type = float, default = 5, help = "latency of each HTTP request")
+    parser.add_argument("--call-ms", type = float, default = 0, help = "latency of each JSON-RPC call")
+    parser.add_argument("--repeat", type = int, default = 3, help = "number of fan-outs per size (median is reported)")
+    parser.add_argument("--signing-processes", type = int, default = cfg.SIGNING_PROCESSES,
+                        help = "sign the fan-out txes in this many processes (0: on the fan-out threads, -1: cpus; "
+                               "default: SIGNING_PROCESSES of server_config)")
+    parser.add_argument("--preflight", action = "store_true", default = cfg.PREFLIGHT_ENABLED,
+                        help = "simulate the fan-out txes before they are signed (default: PREFLIGHT_ENABLED of server_config)")
+    parser.add_argument("--no-preflight", dest = "preflight", action = "store_false", help = "send the fan-out txes unchecked")
+    parser.add_argument("--out", default = "bench_results.json", help = "output json file")
+    args = parser.parse_args()
+
+    results = []
+    for n in [int(s) for s in args.sizes.split(",")]:
+        r = runSize(n, args)
+        print("{:>6} contracts: monitor init {:.2f}s, refresh {:.2f}s, first broadcast {}ms, last broadcast {}ms".format(
+            n, r['monitor_init_secs'], r['monitor_refresh_secs'],
+            "%.0f" % r['signal_to_first_broadcast_ms'] if r['signal_to_first_broadcast_ms'] is not None else "-",
+            "%.0f" % r['signal_to_last_broadcast_ms'] if r['signal_to_last_broadcast_ms'] is not None else "-"))
+        results.append(r)
+
+    out = {'meta': {'timestamp': time.time(), 'git_revision': _gitRevision(), 'python': platform.python_version(),
+                    'traders': args.traders, 'rtt_ms': args.rtt_ms, 'call_ms': args.call_ms, 'repeat': args.repeat,
+                    'multicall_batch_size': cfg.MULTICALL_BATCH_SIZE, 'rpc_batch_window_ms': cfg.RPC_BATCH_WINDOW_MS,
+                    'rpc_pool_size': cfg.RPC_POOL_SIZE, 'max_fanout_workers': cfg.MAX_FANOUT_WORKERS,
+                    'signing_processes': args.signing_processes, 'preflight': args.preflight},
+           'results': results}
+    with open(args.out, "w") as f:
+        json.dump(out, f, indent = 2)
+    print("Results written to {}".format(args.out))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import threading, queue, time, datetime, json, os, sys, random, atexit
+import lib.Metrics
+
+DROPPED = lib.Metrics.counter("log_records_dropped_total", "Log records dropped because a logger queue was full", ["queue"])
+QUEUED = lib.Metrics.gauge("log_records_queued", "Log records waiting to be written")
+
+class AsyncLogger():
+    """ Logger that hands records off to a background writer.
+
+        A logger is called like the log(s) functions it replaces: log("message", key = value, ...). The call
+        only stamps the record and puts it on a queue. A background thread writes the queued records in
+        batches, as JSON lines ({"ts", "time", "thread", "msg", ...fields}), to a file that is rotated when
+        it reaches max_mb (fn, fn.1, ..., fn.<backups>), and echoes them to stdout. The server components log
+        their errors with level = "error", so error records can be counted from the level field.
+
+        defer(msg, fn, sample) runs a diagnostic lookup (e.g. an RPC) on a separate thread and logs its
+        result, for a sample of the calls, so it stays off the caller's critical path.
+
+        If a queue is full, records are dropped and counted rather than blocking the caller. The threads
+        are started by the first record, and the queued records are written at exit.
+    """
+    def __init__(self, fn, max_mb = 50, backups = 5, echo = True, flush_ms = 200, max_batch = 5000,
+                 max_queue = 100000, max_deferred = 1000):
+        """
+        fn: the JSON lines file. If None, the records are only echoed.
+        max_mb: the file is rotated when it is larger than this.
+        backups: the number of rotated files that are kept.
+        echo: print the records to stdout.
+        flush_ms: how long the writer waits for more records before writing a batch.
+        max_batch: the maximum number of records in one write.
+        max_deferred: the maximum number of deferred lookups waiting to run.
+        """
+        self.fn = fn
+        self.max_bytes = max_mb * 1024 * 1024
+        self.backups = backups
+        self.echo = echo
+        self.flush_window = flush_ms / 1000.
+        self.max_batch = max_batch
+        self.records = queue.Queue(max_queue)
+        self.deferred = queue.Queue(max_deferred)
+        self._started = False
+        self._start_lock = threading.Lock()
+        QUEUED.setFunction(self.records.qsize)
+
+    def __call__(self, msg, **fields):
+        record = {'ts': time.time(), 'thread': threading.current_thread().name, 'msg': msg}
+        record.update(fields)
+        self._put(self.records, record, "records")
+
+    def defer(self, msg, fn, sample = 1.0):
+        """Logs msg with the result of fn() (in the "result" field), computed on the diagnostics thread.
+        Only a random fraction sample of the calls is logged."""
+        if sample < 1 and random.random() >= sample:
+            return
+        self._put(self.deferred, (msg, fn, time.time()), "deferred")
+
+    def flush(self):
+        """Blocks until the queued records are written."""
+        if self._started:
+            self.records.join()
+
+    def _put(self, q, item, name):
+        if not self._started:
+            self._start()
+        try:
+            q.put_nowait(item)
+        except queue.Full:
+            DROPPED.inc(queue = name)
+
+    def _start(self):
+        with self._start_lock:
+            if self._started:
+                return
+            threading.Thread(target = self._writeLoop, name = "log-writer", daemon = True).start()
+            threading.Thread(target = self._deferredLoop, name = "log-deferred", daemon = True).start()
+            atexit.register(self.flush)
+            self._started = True
+
+    def _deferredLoop(self):
+        while True:
+            msg, fn, ts = self.deferred.get()
+            try:
+                self(msg, result = str(fn()), requested_ts = ts)
+            except:
+                self(msg, error = str(sys.exc_info()[1]), requested_ts = ts)
+
+    def _writeLoop(self):
+        while True:
+            batch = [self.records.get()]
+            time.sleep(self.flush_window)   #let other records join the batch
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except:
+                print("Error writing log records. Msg: {}".format(sys.exc_info()[1]))
+            for _ in batch:
+                self.records.task_done()
+
+    def _write(self, batch):
+        lines = []; text = []
+        for record in batch:
+            dt = datetime.datetime.fromtimestamp(record['ts']).strftime("%m-%d %H:%M:%S")
+            record = dict(record, time = dt)
+            try:
+                lines.append(json.dumps(record, default = str))
+            except:
+                #e.g. a field was modified by another thread while it was serialized
+                lines.append(json.dumps({'ts': record['ts'], 'time': dt, 'msg': str(record['msg']),
+                                         'error': str(sys.exc_info()[1])}))
+            if self.echo:
+                fields = " ".join("{}={}".format(k, v) for k, v in record.items() if k not in ('ts', 'time', 'thread', 'msg'))
+                text.append(dt + " " + record['msg'] + (" " + fields if fields else ""))
+        if self.echo:
+            print("\n".join(text), flush = True)
+        if self.fn is not None:
+            self._rotate()
+            with open(self.fn, "a") as f:
+                f.write("\n".join(lines) + "\n")
+
+    def _rotate(self):
+        if not os.path.exists(self.fn) or os.path.getsize(self.fn) < self.max_bytes:
+            return
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists("{}.{}".format(self.fn, i)):
+                os.replace("{}.{}".format(self.fn, i), "{}.{}".format(self.fn, i + 1))
+        if self.backups > 0:
+            os.replace(self.fn, self.fn + ".1")
+        else:
+            os.remove(self.fn)
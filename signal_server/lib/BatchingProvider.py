@@ -0,0 +1,148 @@
+import json, threading, time, itertools, sys
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from web3.providers.base import JSONBaseProvider
+from web3._utils.encoding import Web3JsonEncoder
+import lib.Metrics
+
+HTTP_SECONDS = lib.Metrics.histogram("rpc_http_seconds", "Duration of the HTTP requests to the node")
+BATCH_SIZE = lib.Metrics.histogram("rpc_batch_size", "JSON-RPC requests per HTTP request", [], lib.Metrics.SIZE_BUCKETS)
+BATCHED = lib.Metrics.counter("rpc_batched_requests_total", "JSON-RPC requests sent with makeBatchRequest "
+                              "(these bypass the web3 middlewares)", ["method"])
+
+class BatchingHTTPProvider(JSONBaseProvider):
+    """ web3 HTTP provider that merges concurrent requests into JSON-RPC batch requests.
+
+        Requests made within batch_window_ms of each other (from any thread) are sent together as a single
+        JSON-RPC batch over a pool of keep-alive connections. The provider can be shared by the monitor
+        thread, the zmq thread and the main loop. With batch_window_ms = 0 requests are sent one at a time,
+        but still over the pooled connections.
+
+        makeBatchRequest() sends a list of requests as one batch right away, e.g. to fetch many receipts.
+    """
+    def __init__(self, endpoint_uri, batch_window_ms = 2, max_batch_size = 100, pool_size = 16, timeout = 30):
+        """
+        endpoint_uri: the URL of the node
+        batch_window_ms: how long a request waits for other requests to join its batch.
+        max_batch_size: the maximum number of requests in one batch.
+        pool_size: the number of keep-alive connections (and of batches in flight).
+        timeout: HTTP request timeout in seconds.
+        """
+        super().__init__()
+        self.endpoint_uri = endpoint_uri
+        self.batch_window = batch_window_ms / 1000.
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.headers = {'Content-Type': 'application/json'}
+
+        self._ids = itertools.count()
+        self.pending = []     #list of (request dict, slot) waiting to be sent
+        self.cond = threading.Condition()
+        self.senders = ThreadPoolExecutor(max_workers = pool_size, thread_name_prefix = "rpc-batch")
+        self.counters = {'requests': 0, 'http_requests': 0}
+
+        if self.batch_window > 0:
+            t = threading.Thread(target = self._flushLoop, daemon = True)
+            t.start()
+
+    def __str__(self):
+        return "Batching RPC connection {}".format(self.endpoint_uri)
+
+    def make_request(self, method, params):
+        request = self._request(method, params)
+        if self.batch_window <= 0:
+            return self._post([request])[0]
+
+        slot = _Slot()
+        with self.cond:
+            self.pending.append((request, slot))
+            self.cond.notify()
+        return slot.wait()
+
+    def makeBatchRequest(self, method_params):
+        """Sends the requests as JSON-RPC batches right away.
+
+        method_params: list of (method, params) tuples
+
+        Returns: list of the response dictionaries, in the order of method_params."""
+        requests_ = [self._request(method, params) for method, params in method_params]
+        for method, _params in method_params:
+            BATCHED.inc(method = method)
+        responses = []
+        for i in range(0, len(requests_), self.max_batch_size):
+            responses.extend(self._post(requests_[i:i + self.max_batch_size]))
+        return responses
+
+    def _request(self, method, params):
+        return {"jsonrpc": "2.0", "method": method, "params": params or [], "id": next(self._ids)}
+
+    def _flushLoop(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+            #give other threads a short window to add their requests to the batch
+            time.sleep(self.batch_window)
+            with self.cond:
+                batch = self.pending[:self.max_batch_size]
+                self.pending = self.pending[self.max_batch_size:]
+            self.senders.submit(self._sendBatch, batch)
+
+    def _sendBatch(self, batch):
+        try:
+            responses = self._post([request for request, _slot in batch])
+        except:
+            for _request, slot in batch:
+                slot.setError(sys.exc_info()[1])
+            return
+        for (_request, slot), response in zip(batch, responses):
+            slot.set(response)
+
+    def _post(self, requests_):
+        """POSTs the requests (as a batch if there is more than one) and returns the responses in order."""
+        body = requests_[0] if len(requests_) == 1 else requests_
+        start = time.time()
+        r = self.session.post(self.endpoint_uri, data = json.dumps(body, cls = Web3JsonEncoder),
+                              headers = self.headers, timeout = self.timeout)
+        HTTP_SECONDS.observe(time.time() - start)
+        BATCH_SIZE.observe(len(requests_))
+        r.raise_for_status()
+        with self.cond:
+            self.counters['requests'] += len(requests_)
+            self.counters['http_requests'] += 1
+
+        decoded = r.json()
+        if not isinstance(decoded, list):
+            decoded = [decoded]
+        by_id = {d.get('id'): d for d in decoded}
+        return [by_id.get(request['id'], {'id': request['id'], 'jsonrpc': '2.0',
+                                          'error': {'code': -32603, 'message': 'No response in batch'}})
+                for request in requests_]
+
+
+class _Slot():
+    """Holds the response of a request until the batch it is part of returns."""
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+        self.error = None
+
+    def set(self, response):
+        self.response = response
+        self.event.set()
+
+    def setError(self, error):
+        self.error = error
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.response
@@ -0,0 +1,107 @@
+import multiprocessing, os, sys, time
+from concurrent.futures import ProcessPoolExecutor
+from eth_account import Account
+import lib.Metrics
+
+SIGN_SECONDS = lib.Metrics.histogram("bulk_sign_seconds", "Duration of signing a batch of txes", ["mode"])
+BATCH_SIZE = lib.Metrics.histogram("bulk_sign_batch_size", "Number of txes in a signing batch",
+                                   buckets = lib.Metrics.SIZE_BUCKETS)
+
+#The accounts of a worker process (address => eth_account LocalAccount). Set once by _initWorker.
+_accounts = {}
+
+def _initWorker(signing_accounts):
+    global _accounts
+    _accounts = {address: Account.from_key(key) for address, key in signing_accounts.items()}
+
+def _signWith(accounts, items):
+    """Signs a list of (trader address, unsigned txn). Returns a list of (raw txn, tx hash)."""
+    out = []
+    for trader_address, txn in items:
+        signed_txn = accounts[trader_address].sign_transaction(txn)
+        out.append((bytes(signed_txn.rawTransaction), "0x" + bytes(signed_txn.hash).hex()))
+    return out
+
+def _signChunk(items):
+    return _signWith(_accounts, items)
+
+def _ready():
+    pass
+
+
+class BulkSigner():
+    """ Signs batches of transactions in a pool of worker processes.
+
+        ECDSA signing and RLP encoding are CPU bound and hold the GIL, so signing the txes of a large fan-out
+        on one thread is limited to a single core. The private keys are loaded into the workers once, when
+        the pool is started; a task only carries the unsigned transactions. A batch is split into one chunk
+        per worker.
+
+        Batches smaller than min_batch are signed in the calling thread, where the round trip to the workers
+        would cost more than the signing.
+    """
+    def __init__(self, signing_accounts, processes, logger, min_batch = 16):
+        """
+        signing_accounts: dictionary of address => private key
+        processes: the number of worker processes. The number of cpus if None or negative.
+        min_batch: the minimum number of txes signed by the workers.
+        """
+        self.log = logger
+        self.min_batch = min_batch
+        self.processes = processes if processes and processes > 0 else (os.cpu_count() or 1)
+        self.accounts = {address: Account.from_key(key) for address, key in signing_accounts.items()}
+
+        self.pool = None
+        if self.processes > 1:
+            #spawn (not fork) the workers: the server process runs threads and zmq sockets
+            self.pool = ProcessPoolExecutor(max_workers = self.processes, mp_context = multiprocessing.get_context("spawn"),
+                                            initializer = _initWorker, initargs = (signing_accounts,))
+            #start the workers now, so the first fan-out doesn't wait for them
+            try:
+                for f in [self.pool.submit(_ready) for _ in range(self.processes)]:
+                    f.result()
+                self.log("Started {} signing processes".format(self.processes))
+            except:
+                self.log("Error starting the signing processes. Signing inline. Msg: {}".format(sys.exc_info()[1]),
+                         level = "error")
+                self.pool.shutdown(wait = False)
+                self.pool = None
+
+    def sign(self, items):
+        """Signs the transactions.
+
+        items: list of (trader address, unsigned txn). The txns must have their nonces set.
+
+        Returns: list of (trader address, txn, raw txn, tx hash), sorted by trader and nonce, i.e. in the
+        order in which each trader's txes are to be broadcast."""
+        if not items:
+            return []
+        start = time.time()
+        if len(items) < self.min_batch or self.pool is None:
+            mode = "inline"
+            signed = self._signInline(items)
+        else:
+            mode = "pool"
+            try:
+                n = -(-len(items) // self.processes)
+                chunks = [items[i:i + n] for i in range(0, len(items), n)]
+                signed = [s for chunk in self.pool.map(_signChunk, chunks) for s in chunk]
+            except:
+                #e.g. a worker died. Sign in this process rather than lose the batch.
+                self.log("Error signing in the worker processes. Signing inline. Msg: {}".format(sys.exc_info()[1]),
+                         level = "error")
+                mode = "inline"
+                signed = self._signInline(items)
+        SIGN_SECONDS.observe(time.time() - start, mode = mode)
+        BATCH_SIZE.observe(len(items))
+
+        out = [(trader_address, txn, raw_txn, txn_hash) for (trader_address, txn), (raw_txn, txn_hash) in zip(items, signed)]
+        out.sort(key = lambda s: (s[0], s[1]['nonce']))
+        return out
+
+    def _signInline(self, items):
+        return _signWith(self.accounts, items)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait = False)
@@ -1,4 +1,9 @@
-import web3, json, time, os, sys
+import web3, eth_abi, json, time, os, sys, threading
+import lib.Multicall, lib.Metrics, lib.ContractRegistry
+
+READ_SECONDS = lib.Metrics.histogram("monitor_read_seconds", "Duration of a batched read of contract states")
+MONITORED = lib.Metrics.gauge("monitored_contracts", "Contracts monitored", ["stale"])
+LAST_BLOCK = lib.Metrics.gauge("monitor_last_block", "Last block whose logs were processed by the monitor")
 
 class ContractMonitor():
     """ Class to monitor the state of tradeProxy.sol contracts. 
@@ -12,117 +17,429 @@ class ContractMonitor():
          'minMinsBtwTrades': 5,
          'owner': '0xB75Af109Ca1A6dB7c6B708E1292ee8fCc5b0B941',
          'trader': '0x4C9DEA94C1A1e81bB79ccC5C301CFeffeA8ADDa8',
-         'tradingStrategyLabel': 'EMA20CO'
+         'tradingStrategyLabel': 'EMA20CO',
+         'stale': False
         }        
+        
+        State is read in batches: the getters of many contracts are aggregated into a few Multicall
+        eth_calls that are all pinned to the same block (see lib.Multicall).
+        
+        State changes are followed incrementally with eth_getLogs: only the contracts that emitted a 
+        state-changing event are re-read. Contracts created by the tradeProxyFactory are picked up from 
+        its tradeProxyCreated events. The block cursor (and the discovered contracts) are persisted to 
+        cursor_fn. A full re-read of every contract is still made every full_update_minutes.
+        
+        Contracts deployed before the enableTrading, feeRate, minMinsBtwTrades and trader events were added
+        to tradeProxy only emit labelUpdate. Until a contract has been seen emitting one of the newer events,
+        it is re-read every legacy_update_minutes instead.
+        
+        The states are kept in an immutable snapshot of (address => state, label => addresses) that is 
+        replaced as a whole whenever the state changes (copy-on-write). Readers on other threads therefore
+        never block on, or race with, the monitoring loop. State dictionaries must not be modified.
+        
+        If snapshot_fn is given, the states are written to it (with the block they were read at) every
+        snapshot_minutes. At startup the snapshot is loaded at once and its states are served right away,
+        marked 'stale': True. The run loop then re-reads every contract in the background and marks the
+        re-read states 'stale': False. Without a snapshot the states are read before __init__ returns.
     """    
-    def __init__(self, w3, contracts_to_monitor_fn, logger):
+    # Version of the snapshot file format. Snapshots of another version are ignored.
+    SNAPSHOT_VERSION = 1
+    
+    # (state field, function signature, output types) of the tradeProxy getters that make up the state
+    GETTERS = [('enableTrading', 'enableTrading()', ['bool']),
+               ('feeRate', 'feeRate()', ['uint256']),
+               ('minMinsBtwTrades', 'minMinsBtwTrades()', ['uint256']),
+               ('trader', 'trader()', ['address']),
+               ('owner', 'owner()', ['address']),
+               ('tradingStrategyLabel', 'tradingStrategyLabel()', ['string'])]
+    
+    # The owner can not be changed, so it is only read when a contract is initialized
+    UPDATE_GETTERS = [g for g in GETTERS if g[0] != 'owner']
+    
+    # Events emitted by tradeProxy when the monitored state changes
+    STATE_EVENTS = ['labelUpdate(string)', 'enableTradingUpdate(bool)', 'feeRateUpdate(uint256)',
+                    'minMinsBtwTradesUpdate(uint256)', 'traderUpdate(address)']
+    STATE_TOPICS = set(web3.Web3.keccak(text = e).hex() for e in STATE_EVENTS)
+    # The events that only the current tradeProxy emits
+    NEW_STATE_TOPICS = set(web3.Web3.keccak(text = e).hex() for e in STATE_EVENTS if e != 'labelUpdate(string)')
+    CREATED_TOPIC = web3.Web3.keccak(text = 'tradeProxyCreated(address)').hex()
+    
+    # Maximum number of blocks requested in a single eth_getLogs call
+    MAX_LOG_BLOCK_RANGE = 2000
+    
+    def __init__(self, w3, contracts_to_monitor_fn, logger, multicall_address = None, batch_size = 300,
+                 factory_address = None, cursor_fn = None, full_update_minutes = 60, snapshot_fn = None,
+                 snapshot_minutes = 10, registry = None, legacy_update_minutes = 5):
         """
         provider: A web3.Web3 instance 
-        initial_addresses_to_monitor: List of contract addresses.
+        contracts_to_monitor_fn: json file with the list of contract addresses to monitor.
+        multicall_address: address of the Multicall contract used to batch reads. If None, each 
+                           getter is read with a separate eth_call.
+        batch_size: the number of getter calls aggregated into a single eth_call.
+        factory_address: address of the tradeProxyFactory. If given, contracts that it creates are
+                         monitored automatically.
+        cursor_fn: json file in which the last processed block is persisted. If None, the cursor is
+                   kept in memory only.
+        full_update_minutes: period of the full re-read of all contracts.
+        snapshot_fn: json file of the state snapshot used for warm starts. If None, no snapshot is kept.
+        snapshot_minutes: period of the snapshot writes.
+        registry: lib.ContractRegistry.ContractRegistry of the contract handles, shared with the TradeExecutor.
+                  A new one is created if None.
+        legacy_update_minutes: period of the re-read of the contracts that were never seen emitting one of
+                               the newer state events.
         """
         self.w3 = w3
-        self.abi = json.load(open("../contracts/abi.json", "r"))
+        self.registry = registry if registry is not None else lib.ContractRegistry.ContractRegistry(w3)
+        self.abi = self.registry.abi
         
         self.log = logger
-                
-        self.contract_state = {}  #address => state dictionary
-        self.contracts = {}       #address => w3.eth.contract instance
+        self.multicall = lib.Multicall.Multicall(w3, multicall_address, batch_size, logger)
+        
+        self._snapshot = ({}, {})   #(address => state dictionary, label => frozenset of addresses)
+        self.contracts = {}         #address => w3.eth.contract instance
+        self._checksums = {}        #address => checksum address, see _checksum()
+        self._write_lock = threading.Lock()
+        MONITORED.setFunction(lambda: sum(1 for d in self._snapshot[0].values() if not d['stale']), stale = "false")
+        MONITORED.setFunction(lambda: sum(1 for d in self._snapshot[0].values() if d['stale']), stale = "true")
+        LAST_BLOCK.setFunction(lambda: self.last_block)
         
         initial_addresses_to_monitor = json.load(open(contracts_to_monitor_fn, "r"))
         
         self.contracts_to_monitor_fn = contracts_to_monitor_fn
         self.contracts_file_last_modify = os.path.getmtime(self.contracts_to_monitor_fn) 
         
-        for _address in initial_addresses_to_monitor:
-            try:
-                self._initializeState(_address)
-                self.log("Contract successfully initialized: {}".format(_address)) 
-            except:
-                self.log("Error initializing contract: {}. Skipping. Msg: {}".format(_address, sys.exc_info()[0])) 
+        self.factory_address = factory_address
+        self.cursor_fn = cursor_fn
+        self.full_update_minutes = full_update_minutes
+        self.last_block = None             #last block for which the logs have been processed
+        self.discovered_addresses = set()  #contracts found from the factory events
+        self.event_addresses = set()       #contracts that emitted one of NEW_STATE_TOPICS
+        self.legacy_update_minutes = legacy_update_minutes
+        self._loadCursor()
+        
+        self.snapshot_fn = snapshot_fn
+        self.snapshot_minutes = snapshot_minutes
+        addresses = initial_addresses_to_monitor + sorted(self.discovered_addresses)
+        self._revalidate = None            #addresses to re-read in the background (after a warm start)
+        if self._loadSnapshot(set(addresses)):
+            self._revalidate = addresses
+        else:
+            self.initializeStates(addresses)
         
+    @property
+    def contract_state(self):
+        """address => state dictionary (read-only snapshot)."""
+        return self._snapshot[0]
+    
     def getContractState(self, address):
-        return self.contract_state.get(address)
+        return self._snapshot[0].get(address)
     
     def getAllMonitoredAddresses(self):
         """
         Returns the addresses of all of the monitored contracts.
         """
-        return list(self.contracts.keys())
+        return list(self._snapshot[0].keys())
     
     def getAddressesThatMatchLabel(self, label):
         """
         Returns a list of all the contract address in which the state field 'tradingStrategyLabel' matches
         the input label.
         """
-        result = []
-        for address, state in self.contract_state.items():
-            if state['tradingStrategyLabel'] == label:
-                result.append(address)
-        return result
+        return list(self._snapshot[1].get(label, ()))
+    
+    def getStatesThatMatchLabel(self, label):
+        """
+        Returns a list of (address, state) for the contracts whose 'tradingStrategyLabel' matches the input
+        label. The addresses and states are taken from the same snapshot.
+        """
+        contract_state, label_index = self._snapshot
+        return [(address, contract_state[address]) for address in label_index.get(label, ())]
         
     
     def addContract(self, address):
         """
         Adds a new contract to monitor.
         """
-        try:
-            self._initializeState(address)
-        except:
-            self.log("Error initializing contract: {}. Skipping. Msg: {}".format(_address, sys.exc_info()[0]))         
+        self.initializeStates([address])
     
     def run(self):
-        UPDATE_PERIOD_MINUTES = 5
-        last_update_ts = 0
+        last_update_ts = last_legacy_update_ts = time.time()
+        if self._revalidate is not None:
+            #warm start: replace the stale states loaded from the snapshot
+            start = time.time()
+            self.initializeStates(self._revalidate)
+            n_stale = sum(1 for d in self._snapshot[0].values() if d['stale'])
+            self.log("Revalidated the snapshot states in {:.1f}s. {} contracts are still stale.".format(
+                time.time() - start, n_stale))
+            self._revalidate = None
+        last_snapshot_ts = 0   #the first snapshot is written after the first pass of the loop
+        
         while 1:
-            # Periodically poll contract state info
-            if time.time() > last_update_ts + 60 * UPDATE_PERIOD_MINUTES:
-                for _address in self.contracts.keys():
-                    self.updateState(_address) 
-                last_update_ts = time.time()
+            # Re-read the contracts that emitted state change events since the last pass
+            try:
+                self.followLogs()
+            except:
+                self.log("Error following contract logs. Msg: {}".format(sys.exc_info()[0]), level = "error")
+            
+            # Safety net: periodically re-read the state of all the contracts
+            if time.time() > last_update_ts + 60 * self.full_update_minutes:
+                self.updateStates(list(self.contracts.keys()))
+                last_update_ts = last_legacy_update_ts = time.time()
+            
+            # The contracts that may not emit all of the state events are re-read more often
+            if time.time() > last_legacy_update_ts + 60 * self.legacy_update_minutes:
+                legacy = [a for a in list(self.contracts) if a not in self.event_addresses]
+                if legacy:
+                    self.updateStates(legacy)
+                last_legacy_update_ts = time.time()
+            
+            if self.snapshot_fn and time.time() > last_snapshot_ts + 60 * self.snapshot_minutes:
+                self.saveSnapshot()
+                last_snapshot_ts = time.time()
                 
             #check whether the file containing the addresses to monitor has been updated, add
-            # or delete from self.contracts and self.contract_state as appropriate
+            # or delete from the monitored contracts as appropriate
             if os.path.getmtime(self.contracts_to_monitor_fn) > self.contracts_file_last_modify:
                 self.contracts_file_last_modify = os.path.getmtime(self.contracts_to_monitor_fn) 
                 addresses = set(json.load(open(self.contracts_to_monitor_fn, "r")))
                 existing_add = set(self.contracts.keys())
                 new_addresses = addresses.difference(existing_add)
-                delete_addresses = existing_add.difference(addresses)
-                for _address in new_addresses:
-                    self._initializeState(_address)
-                for _address in delete_addresses:
-                    del self.contracts[_address]
-                    del self.contract_state[_address]
+                delete_addresses = existing_add.difference(addresses).difference(self.discovered_addresses)
+                self.initializeStates(list(new_addresses))
+                self._removeStates(delete_addresses)
             
             time.sleep(10)
     
+    def followLogs(self):
+        """
+        Processes the logs of all the blocks since the block cursor. Contracts that emitted a state 
+        change event are re-read and contracts created by the factory are added.
+        """
+        latest = self.w3.eth.blockNumber
+        if self.last_block is None:
+            #The state was just read in full, so there is nothing to catch up on
+            self.last_block = latest
+            self._saveCursor()
+            return
+        
+        topics = [list(self.STATE_TOPICS) + [self.CREATED_TOPIC]]
+        #the addresses of the logs are compared in checksum form, whatever the case of the configured ones
+        factory_address = self._checksum(self.factory_address) if self.factory_address else None
+        from_block = self.last_block + 1
+        while from_block <= latest:
+            to_block = min(latest, from_block + self.MAX_LOG_BLOCK_RANGE - 1)
+            logs = self.w3.eth.getLogs({'fromBlock': from_block, 'toBlock': to_block, 'topics': topics})
+            monitored = {self._checksum(a): a for a in list(self.contracts)}   #checksum address => address
+            
+            updated = set(); created = set()
+            for _log in logs:
+                topic = web3.Web3.toHex(_log['topics'][0])
+                log_address = self._checksum(_log['address'])
+                if topic == self.CREATED_TOPIC:
+                    if factory_address and log_address == factory_address:
+                        new_address = eth_abi.decode_abi(['address'], web3.Web3.toBytes(hexstr = _log['data']))[0]
+                        created.add(web3.Web3.toChecksumAddress(new_address))
+                elif log_address in monitored:
+                    updated.add(monitored[log_address])
+                    if topic in self.NEW_STATE_TOPICS:
+                        self.event_addresses.add(monitored[log_address])
+            
+            if updated:
+                self.log("State change events found for contracts: {}".format(sorted(updated)))
+                self.updateStates(list(updated))
+            created = created.difference(monitored)
+            if created:
+                self.log("New tradeProxy contracts created by the factory: {}".format(sorted(created)))
+                self.discovered_addresses.update(created)
+                self.initializeStates(sorted(created))
+            
+            self.last_block = to_block
+            self._saveCursor()
+            from_block = to_block + 1
+    
+    def _checksum(self, address):
+        """Returns the checksum form of the address (memoized, the monitored addresses are converted at each call
+        of followLogs)."""
+        checksum = self._checksums.get(address)
+        if checksum is None:
+            checksum = self._checksums[address] = web3.Web3.toChecksumAddress(address)
+        return checksum
+    
+    def _loadCursor(self):
+        if self.cursor_fn and os.path.exists(self.cursor_fn):
+            d = json.load(open(self.cursor_fn, "r"))
+            self.last_block = d.get('block')
+            self.discovered_addresses = set(d.get('discovered', []))
+            self.event_addresses = set(d.get('emit_events', []))
+    
+    def _saveCursor(self):
+        if not self.cursor_fn:
+            return
+        d = {'block': self.last_block, 'discovered': sorted(self.discovered_addresses),
+             'emit_events': sorted(self.event_addresses)}
+        with open(self.cursor_fn + ".tmp", "w") as f:
+            json.dump(d, f)
+        os.replace(self.cursor_fn + ".tmp", self.cursor_fn)
+    
+    def saveSnapshot(self):
+        """Writes the current states to snapshot_fn (atomically)."""
+        if not self.snapshot_fn or self.last_block is None:
+            return
+        #the states include all of the changes up to the log cursor
+        d = {'version': self.SNAPSHOT_VERSION, 'block': self.last_block, 'ts': time.time(),
+             'states': self._snapshot[0]}
+        try:
+            with open(self.snapshot_fn + ".tmp", "w") as f:
+                json.dump(d, f)
+            os.replace(self.snapshot_fn + ".tmp", self.snapshot_fn)
+        except:
+            self.log("Error writing the state snapshot. Msg: {}".format(sys.exc_info()[0]), level = "error")
+    
+    def _loadSnapshot(self, addresses):
+        """Installs the snapshot states of the addresses, marked as stale. 
+        
+        Returns: True if a snapshot was loaded."""
+        if not self.snapshot_fn or not os.path.exists(self.snapshot_fn):
+            return False
+        try:
+            d = json.load(open(self.snapshot_fn, "r"))
+        except:
+            self.log("Error reading the state snapshot. Msg: {}".format(sys.exc_info()[0]), level = "error")
+            return False
+        if d.get('version') != self.SNAPSHOT_VERSION:
+            self.log("Ignoring state snapshot of version {}".format(d.get('version')))
+            return False
+        
+        states = {}; contracts = {}
+        for _address, state in d['states'].items():
+            if _address in addresses:
+                states[_address] = dict(state, stale = True)
+                contracts[_address] = self.registry.get(_address)
+        self._setStates(states, contracts = contracts)
+        #follow the logs from the snapshot block so the changes made since then are picked up
+        if d['block'] is not None and (self.last_block is None or self.last_block > d['block']):
+            self.last_block = d['block']
+        self.log("Loaded state snapshot of {} contracts at block {} ({:.0f}s old)".format(
+            len(states), d['block'], time.time() - d['ts']))
+        return True
+    
     def updateState(self, contract_address):
-        if contract_address in self.contracts:
-            k = self.contracts[contract_address]
-            d = {}
-            d['enableTrading'] = k.functions.enableTrading().call()
-            d['feeRate'] = k.functions.feeRate().call()
-            d['minMinsBtwTrades'] = k.functions.minMinsBtwTrades().call()
-            d['trader'] = k.functions.trader().call()
-            d['tradingStrategyLabel'] = k.functions.tradingStrategyLabel().call() 
+        self.updateStates([contract_address])
             
-            self.contract_state[contract_address].update(d)
+    def updateStates(self, contract_addresses):
+        """
+        Re-reads the state of already monitored contracts in batches pinned to a single block.
+        """
+        addresses = [a for a in contract_addresses if a in self.contracts]
+        states = self._readStates(addresses, self.UPDATE_GETTERS)
+        new_states = {}
+        for _address, d in states.items():
+            if d is None:
+                self.log("Error updating state of contract: {}. Keeping previous state.".format(_address),
+                         level = "error")
+            else:
+                new_states[_address] = d
+        self._setStates(new_states, update = True)
+    
+    def initializeStates(self, contract_addresses):
+        """
+        Reads the full state of new contracts and starts monitoring them. Contracts for which 
+        any getter fails are skipped.
+        """
+        _contracts = {}
+        for _address in contract_addresses:
+            try:
+                _contracts[_address] = self.registry.get(_address)
+            except:
+                self.log("Error initializing contract: {}. Skipping. Msg: {}".format(_address, sys.exc_info()[0]),
+                         level = "error")
+        
+        states = self._readStates(list(_contracts.keys()), self.GETTERS)
+        new_states = {}
+        for _address, d in states.items():
+            if d is None:
+                self.log("Error initializing contract: {}. Skipping.".format(_address), level = "error")
+                continue
+            new_states[_address] = d
+            self.log("Contract successfully initialized: {}".format(_address))
+        self._setStates(new_states, contracts = _contracts)
             
     def _initializeState(self, contract_address):
+        self.initializeStates([contract_address])
+    
+    def _setStates(self, states, update = False, contracts = None):
+        """
+        Installs new state dictionaries and updates the label index in a new snapshot.
+        
+        update: if True, only the states of contracts that are still monitored are merged into their
+                existing state. Otherwise the states are added.
+        contracts: address => w3.eth.contract instance for added contracts.
+        """
+        if not states:
+            return
+        with self._write_lock:
+            contract_state = dict(self._snapshot[0])
+            label_index = dict(self._snapshot[1])
+            for _address, d in states.items():
+                old = contract_state.get(_address)
+                if update:
+                    if old is None:
+                        continue
+                    d = dict(old, **d)
+                if old is not None:
+                    self._unindex(label_index, old['tradingStrategyLabel'], _address)
+                contract_state[_address] = d
+                label = d['tradingStrategyLabel']
+                label_index[label] = label_index.get(label, frozenset()).union((_address,))
+                if contracts:
+                    self.contracts[_address] = contracts[_address]
+            self._snapshot = (contract_state, label_index)
+    
+    def _removeStates(self, contract_addresses):
+        with self._write_lock:
+            contract_state = dict(self._snapshot[0])
+            label_index = dict(self._snapshot[1])
+            for _address in contract_addresses:
+                old = contract_state.pop(_address, None)
+                if old is not None:
+                    self._unindex(label_index, old['tradingStrategyLabel'], _address)
+                self.contracts.pop(_address, None)
+                self.registry.remove(_address)
+            self._snapshot = (contract_state, label_index)
+    
+    def _unindex(self, label_index, label, address):
+        addresses = label_index.get(label, frozenset()).difference((address,))
+        if addresses:
+            label_index[label] = addresses
+        else:
+            label_index.pop(label, None)
+    
+    def _readStates(self, contract_addresses, getters):
+        """
+        Returns a dictionary of address => state dictionary (or None if any of the getters failed). The 
+        states are marked 'stale': False.
+        """
+        if not contract_addresses:
+            return {}
+        calldata = [(field, lib.Multicall.encodeCall(sig), types) for field, sig, types in getters]
+        calls = [(_address, data, types) for _address in contract_addresses for _field, data, types in calldata]
         try:
-            k = self.w3.eth.contract(address = contract_address, abi = self.abi)
+            with READ_SECONDS.time():
+                block_number, results = self.multicall.aggregate(calls)
         except:
-            return None
-        d = {}
-        d['enableTrading'] = k.functions.enableTrading().call()
-        d['feeRate'] = k.functions.feeRate().call()
-        d['minMinsBtwTrades'] = k.functions.minMinsBtwTrades().call()
-        d['trader'] = k.functions.trader().call()
-        d['owner'] = k.functions.owner().call()
-        d['tradingStrategyLabel'] = k.functions.tradingStrategyLabel().call()        
-        
-        self.contract_state[contract_address] = d    
-        self.contracts[contract_address] = k
+            self.log("Error reading contract states. Msg: {}".format(sys.exc_info()[0]), level = "error")
+            return {_address: None for _address in contract_addresses}
+        
+        states = {}
+        n = len(getters)
+        for i, _address in enumerate(contract_addresses):
+            _results = results[i * n:(i + 1) * n]
+            if any(r is None for r in _results):
+                states[_address] = None
+            else:
+                states[_address] = {g[0]: r[0] for g, r in zip(getters, _results)}
+                states[_address]['stale'] = False
+        return states
         
     
 if __name__ == "__main__":
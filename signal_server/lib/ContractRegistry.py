@@ -0,0 +1,88 @@
+import json, threading
+import eth_abi, web3
+from eth_account import Account
+import lib.Multicall
+
+TRADE_PROXY_ABI_FN = "../contracts/abi.json"
+SYNTH_ABI_FN = "./abis/synth_abi.json"
+
+class ContractRegistry():
+    """ Shared cache of the web3 contract handles of the tradeProxy and synth contracts.
+
+        The ABIs are loaded once and a contract factory is built for each of them, so a handle is created
+        once per address (cheaply, from the factory) and shared by the ContractMonitor and the TradeExecutor.
+    """
+    def __init__(self, w3, abi_fn = TRADE_PROXY_ABI_FN, synth_abi_fn = SYNTH_ABI_FN):
+        """
+        w3: A web3.Web3 instance
+        abi_fn: json file of the tradeProxy ABI
+        synth_abi_fn: json file of the synth ABI
+        """
+        self.w3 = w3
+        self.abi = json.load(open(abi_fn, "r"))
+        self.synth_abi = json.load(open(synth_abi_fn, "r"))
+        self._factories = {'tradeProxy': w3.eth.contract(abi = self.abi),
+                           'synth': w3.eth.contract(abi = self.synth_abi)}
+        self._handles = {}   #(kind, address) => contract instance
+        self._lock = threading.Lock()
+
+    def get(self, address):
+        """Returns the handle of the tradeProxy contract at the address."""
+        return self._get('tradeProxy', address)
+
+    def synth(self, address):
+        """Returns the handle of the synth contract at the address."""
+        return self._get('synth', address)
+
+    def remove(self, address):
+        with self._lock:
+            self._handles.pop(('tradeProxy', address), None)
+
+    def _get(self, kind, address):
+        handle = self._handles.get((kind, address))
+        if handle is None:
+            with self._lock:
+                handle = self._handles.get((kind, address))
+                if handle is None:
+                    handle = self._handles[(kind, address)] = self._factories[kind](address = address)
+        return handle
+
+
+class TradeTxBuilder():
+    """ Builds tradeProxy.trade transactions without web3's ABI encoding.
+
+        The calldata of trade(bytes32,uint256,bytes32,uint256) is static, so it is assembled from the
+        precompiled selector, cached currency keys and the precomputed minFeeRate word. Only the amount, the
+        nonce and the gas price change between transactions.
+    """
+    TRADE_SELECTOR = lib.Multicall.selector('trade(bytes32,uint256,bytes32,uint256)')
+
+    def __init__(self, chain_id, min_fee_rate, gas = 500000):
+        self.template = {'chainId': chain_id, 'gas': gas, 'value': 0}
+        self.min_fee_word = eth_abi.encode_single('uint256', min_fee_rate)
+        self.keys = {}   #synth name => 32 byte currency key
+
+    def currencyKey(self, synth_name):
+        """Returns the bytes32 currency key of the synth. Raises ValueError if the name is longer than 32 bytes."""
+        key = self.keys.get(synth_name)
+        if key is None:
+            key = synth_name.encode()
+            if len(key) > 32:
+                raise ValueError("Synth name {} is longer than 32 bytes".format(synth_name))
+            key = self.keys[synth_name] = key.ljust(32, b"\0")
+        return key
+
+    def calldata(self, from_synth, amount, to_synth):
+        return (self.TRADE_SELECTOR + self.currencyKey(from_synth) + amount.to_bytes(32, "big")
+                + self.currencyKey(to_synth) + self.min_fee_word)
+
+    def build(self, contract_address, from_synth, amount, to_synth, nonce, gas_price):
+        """Returns the unsigned transaction dictionary."""
+        txn = dict(self.template, to = contract_address, nonce = nonce, gasPrice = gas_price)
+        txn['data'] = web3.Web3.toHex(self.calldata(from_synth, amount, to_synth))
+        return txn
+
+    def sign(self, txn, private_key):
+        """Returns (raw transaction bytes, tx hash hex string)."""
+        signed_txn = Account.sign_transaction(txn, private_key)
+        return signed_txn.rawTransaction, web3.Web3.toHex(signed_txn.hash)
@@ -0,0 +1,311 @@
+import threading, time, sys, collections
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from web3.providers.base import JSONBaseProvider
+import lib.BatchingProvider, lib.Metrics
+
+ENDPOINT_REQUESTS = lib.Metrics.counter("rpc_endpoint_requests_total", "Requests sent to each node endpoint",
+                                        ["endpoint", "outcome"])
+ENDPOINT_SECONDS = lib.Metrics.histogram("rpc_endpoint_seconds", "Duration of the requests to each node endpoint", ["endpoint"])
+HEDGED = lib.Metrics.counter("rpc_hedged_requests_total", "Reads duplicated to a second endpoint after the hedge delay")
+BREAKER_OPEN = lib.Metrics.gauge("rpc_endpoint_ejected", "1 while the circuit breaker of an endpoint is open", ["endpoint"])
+EJECTIONS = lib.Metrics.counter("rpc_endpoint_ejections_total", "Times the circuit breaker of an endpoint opened", ["endpoint"])
+
+#methods whose requests are sent to every endpoint rather than to the fastest one
+BROADCAST_METHODS = ('eth_sendRawTransaction',)
+#JSON-RPC errors meaning the endpoint is rate limiting (they count as failures of the endpoint)
+RATE_LIMIT_ERRORS = (-32005,)
+#JSON-RPC errors of a malformed or unsupported request; they are retried on another endpoint, but they don't count
+#as failures of the endpoint
+REQUEST_ERRORS = (-32600, -32601, -32602)
+#JSON-RPC errors of a call that fails in the EVM; every node returns them, so they are not retried on another endpoint
+REVERT_ERRORS = (3,)
+REVERT_MESSAGES = ("revert", "invalid opcode", "out of gas", "gas required exceeds allowance")
+#index of the block parameter of the reads that take one
+BLOCK_PARAMS = {'eth_call': 1, 'eth_estimateGas': 1, 'eth_getBalance': 1, 'eth_getCode': 1,
+                'eth_getTransactionCount': 1, 'eth_getStorageAt': 2, 'eth_getBlockByNumber': 0}
+BLOCK_TAGS = ('latest', 'pending', 'earliest')
+
+
+def isRevert(error):
+    """True if the JSON-RPC error dictionary is the failure of a call in the EVM (e.g. "execution reverted")."""
+    message = str(error.get('message', '')).lower()
+    return error.get('code') in REVERT_ERRORS or any(m in message for m in REVERT_MESSAGES)
+
+def endpointError(response):
+    """Returns the first JSON-RPC error of the response (or list of responses) that is not a revert, e.g. "header
+    not found" from a node that is behind, or None."""
+    responses = response if isinstance(response, list) else [response]
+    for r in responses:
+        error = r.get('error') if isinstance(r, dict) else None
+        if error is not None and not (isinstance(error, dict) and isRevert(error)):
+            return error
+    return None
+
+def isPinned(method, params):
+    """True if the read is pinned to a block number or hash rather than to a tag like "latest"."""
+    params = params or []
+    if method == 'eth_getLogs':
+        log_filter = params[0] if params and isinstance(params[0], dict) else {}
+        return 'blockHash' in log_filter or any(log_filter.get(k, 'latest') not in BLOCK_TAGS
+                                                 for k in ('fromBlock', 'toBlock'))
+    i = BLOCK_PARAMS.get(method)
+    return i is not None and len(params) > i and params[i] not in BLOCK_TAGS
+
+
+def makeProvider(urls, batch_window_ms = 2, pool_size = 16, **pool_options):
+    """Returns a lib.BatchingProvider.BatchingHTTPProvider for a single node URL, or an EndpointPool for a list
+    of URLs. pool_options are passed to the EndpointPool."""
+    if isinstance(urls, str):
+        urls = [urls]
+    if len(urls) == 1:
+        return lib.BatchingProvider.BatchingHTTPProvider(urls[0], batch_window_ms, pool_size = pool_size)
+    return EndpointPool(urls, batch_window_ms, pool_size, **pool_options)
+
+
+class EndpointPool(JSONBaseProvider):
+    """ web3 provider that spreads the requests over several nodes, tracking the latency and the errors of each.
+
+        A read is sent to the fastest available endpoint (lowest moving average of its latency). If it has not
+        answered after the hedge delay (the 95th percentile of that endpoint's recent latencies, clamped to
+        [hedge_min_ms, hedge_max_ms]), a duplicate is sent to the next fastest endpoint and the first response
+        is used. If an endpoint fails, the request is retried on the next one. An available endpoint that has
+        not been measured for probe_secs gets a copy of the next read in the background (its answer is only
+        used for the statistics), so that an endpoint that was slow for a while can become the fastest again.
+
+        A read that returns a JSON-RPC error is also retried on the next endpoint (the error is returned if every
+        endpoint returns one), unless the error is a revert of the call, which is the same on every node.
+
+        Reads pinned to a block (e.g. the aggregated calls of lib.Multicall and the estimates of lib.Preflight)
+        are not hedged or probed: they are sent to the fastest endpoint only, and are only retried on the next
+        one if it fails, e.g. with "header not found" because it is behind.
+
+        Signed transactions (eth_sendRawTransaction) are broadcast to all of the available endpoints in
+        parallel. The first successful response is returned, or the first error if every endpoint returned one.
+        Their error responses (e.g. "already known") don't count as failures of the endpoint.
+
+        Each endpoint has a circuit breaker: after breaker_failures consecutive failures (exceptions, e.g. HTTP
+        errors and timeouts, and error responses other than reverts and invalid requests, e.g. rate limiting) the endpoint is ejected for breaker_cooldown_secs. After the
+        cooldown it is tried again; one more failure ejects it again. If all of the endpoints are ejected, they
+        are all tried.
+
+        Each endpoint is a lib.BatchingProvider.BatchingHTTPProvider, so concurrent requests to one endpoint
+        are still merged into JSON-RPC batches. makeBatchRequest() sends a batch as one (hedged) read.
+    """
+    def __init__(self, endpoint_uris, batch_window_ms = 2, pool_size = 16, hedge_min_ms = 50, hedge_max_ms = 1000,
+                 breaker_failures = 3, breaker_cooldown_secs = 30, latency_window = 200, probe_secs = 10, timeout = 30):
+        """
+        endpoint_uris: the URLs of the nodes
+        batch_window_ms, pool_size, timeout: see lib.BatchingProvider.BatchingHTTPProvider (per endpoint).
+        hedge_min_ms, hedge_max_ms: bounds of the delay before a read is duplicated to a second endpoint.
+        breaker_failures: consecutive failures after which an endpoint is ejected.
+        breaker_cooldown_secs: how long an ejected endpoint is not used.
+        latency_window: the number of recent latencies of an endpoint its 95th percentile is computed from.
+        probe_secs: how long an endpoint may go without a request before it is probed.
+        """
+        super().__init__()
+        self.hedge_min = hedge_min_ms / 1000.
+        self.hedge_max = hedge_max_ms / 1000.
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown_secs
+        self.probe_secs = probe_secs
+        self.endpoints = [_Endpoint("{}:{}".format(i, urlparse(uri).hostname),
+                                    lib.BatchingProvider.BatchingHTTPProvider(uri, batch_window_ms, pool_size = pool_size,
+                                                                              timeout = timeout),
+                                    latency_window)
+                          for i, uri in enumerate(endpoint_uris)]
+        if not self.endpoints:
+            raise ValueError("No node endpoints")
+        self.pool = ThreadPoolExecutor(max_workers = pool_size * len(self.endpoints), thread_name_prefix = "rpc-pool")
+        for endpoint in self.endpoints:
+            BREAKER_OPEN.set(0, endpoint = endpoint.name)
+
+    def __str__(self):
+        return "RPC endpoint pool {}".format([e.name for e in self.endpoints])
+
+    def make_request(self, method, params):
+        if method in BROADCAST_METHODS:
+            return self._broadcast(method, params)
+        return self._hedged('make_request', (method, params), hedge = not isPinned(method, params))
+
+    def makeBatchRequest(self, method_params):
+        """Sends the requests as JSON-RPC batches to one endpoint (hedged like a read, unless one of the requests
+        is pinned to a block).
+
+        Returns: list of the response dictionaries, in the order of method_params."""
+        return self._hedged('makeBatchRequest', (method_params,),
+                            hedge = not any(isPinned(method, params) for method, params in method_params))
+
+    def stats(self):
+        """Returns a list with the latency and the state of each endpoint."""
+        now = time.time()
+        return [{'endpoint': e.name, 'ewma_ms': round(e.ewma * 1000, 1) if e.ewma is not None else None,
+                 'p95_ms': round(e.p95() * 1000, 1) if e.p95() is not None else None,
+                 'failures': e.failures, 'ejected': not e.available(now)} for e in self.endpoints]
+
+    def _ranked(self):
+        """Returns the available endpoints, fastest first (all of the endpoints if none is available). Endpoints
+        without latency samples come first, so that they are measured."""
+        now = time.time()
+        available = [e for e in self.endpoints if e.available(now)] or self.endpoints
+        return sorted(available, key = lambda e: e.ewma if e.ewma is not None else 0)
+
+    def _hedgeDelay(self, endpoint):
+        p95 = endpoint.p95()
+        if p95 is None:
+            return self.hedge_max
+        return min(max(p95, self.hedge_min), self.hedge_max)
+
+    def _hedged(self, fn_name, args, hedge = True):
+        """Sends the request to the fastest endpoint, duplicates it to the next one after the hedge delay if hedge,
+        and fails over to the next one on an exception or an endpoint error response (see endpointError())."""
+        ranked = self._ranked()
+        if hedge:
+            self._probeStale(ranked[1:], fn_name, args)
+        candidates = iter(ranked)
+        futures = {}   #future => endpoint
+        def launch():
+            endpoint = next(candidates, None)
+            if endpoint is not None:
+                futures[self.pool.submit(self._call, endpoint, fn_name, args)] = endpoint
+            return endpoint
+
+        delay = self._hedgeDelay(launch())
+        hedged = not hedge
+        error = None
+        error_response = None
+        while futures:
+            done, _pending = wait(futures, timeout = None if hedged else delay, return_when = FIRST_COMPLETED)
+            if not done:
+                #the endpoint is slower than usual; race it with a duplicate on the next endpoint
+                hedged = True
+                if launch() is not None:
+                    HEDGED.inc()
+                continue
+            for f in done:
+                del futures[f]
+                try:
+                    response = f.result()
+                except:
+                    error = sys.exc_info()[1]
+                    continue
+                if endpointError(response) is None:
+                    return response
+                error_response = response
+            if not futures:
+                #failed over to the next endpoint
+                launch()
+        if error_response is not None:
+            return error_response
+        raise error
+
+    def _probeStale(self, endpoints, fn_name, args):
+        now = time.time()
+        for endpoint in endpoints:
+            if now - endpoint.last_ts > self.probe_secs:
+                endpoint.last_ts = now
+                self.pool.submit(self._probe, endpoint, fn_name, args)
+
+    def _probe(self, endpoint, fn_name, args):
+        try:
+            self._call(endpoint, fn_name, args)
+        except:
+            pass
+
+    def _broadcast(self, method, params):
+        now = time.time()
+        endpoints = [e for e in self.endpoints if e.available(now)] or self.endpoints
+        #the tx pool answers of a node (e.g. "already known" from the nodes the tx reached through their peers
+        #first, or "nonce too low") are not failures of the node
+        futures = [self.pool.submit(self._call, e, 'make_request', (method, params), False) for e in endpoints]
+        error_response = None
+        error = None
+        for f in as_completed(futures):
+            try:
+                response = f.result()
+            except:
+                error = sys.exc_info()[1]
+                continue
+            if 'error' not in response:
+                return response
+            if error_response is None:
+                error_response = response
+        if error_response is not None:
+            return error_response
+        raise error
+
+    def _call(self, endpoint, fn_name, args, node_errors = True):
+        """Makes the request on one endpoint and records its latency, or its failure.
+
+        node_errors: if False, only exceptions (e.g. HTTP errors and timeouts) and rate limit errors count as
+                     failures, not the other error responses (see endpointError())."""
+        start = endpoint.last_ts = time.time()
+        try:
+            response = getattr(endpoint.provider, fn_name)(*args)
+            responses = response if isinstance(response, list) else [response]
+            limited = [r['error'] for r in responses if isinstance(r.get('error'), dict) and r['error'].get('code') in RATE_LIMIT_ERRORS]
+            if limited:
+                raise ValueError("Endpoint {} is rate limiting: {}".format(endpoint.name, limited[0]))
+        except:
+            self._failure(endpoint, "error")
+            raise
+        error = endpointError(response)
+        if node_errors and error is not None and not (isinstance(error, dict) and error.get('code') in REQUEST_ERRORS):
+            #e.g. "header not found": the endpoint is behind, don't let it stay the fastest one
+            self._failure(endpoint, "error_response")
+            return response
+        elapsed = time.time() - start
+        endpoint.success(elapsed)
+        BREAKER_OPEN.set(0, endpoint = endpoint.name)
+        ENDPOINT_REQUESTS.inc(endpoint = endpoint.name, outcome = "ok")
+        ENDPOINT_SECONDS.observe(elapsed, endpoint = endpoint.name)
+        return response
+
+    def _failure(self, endpoint, outcome):
+        ENDPOINT_REQUESTS.inc(endpoint = endpoint.name, outcome = outcome)
+        if endpoint.failure(self.breaker_failures, self.breaker_cooldown):
+            EJECTIONS.inc(endpoint = endpoint.name)
+            BREAKER_OPEN.set(1, endpoint = endpoint.name)
+
+
+class _Endpoint():
+    """Latency statistics and circuit breaker of one node endpoint."""
+    EWMA_ALPHA = 0.2
+
+    def __init__(self, name, provider, latency_window):
+        self.name = name
+        self.provider = provider
+        self.latencies = collections.deque(maxlen = latency_window)
+        self.ewma = None
+        self.last_ts = 0        #time of the last request sent to the endpoint
+        self.failures = 0       #consecutive failures
+        self.open_until = 0     #the endpoint is ejected until this time
+        self._p95 = None        #cached 95th percentile, None when it needs to be recomputed
+        self._lock = threading.Lock()
+
+    def available(self, now):
+        return now >= self.open_until
+
+    def p95(self):
+        with self._lock:
+            if self._p95 is None and self.latencies:
+                ordered = sorted(self.latencies)
+                self._p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+            return self._p95
+
+    def success(self, secs):
+        with self._lock:
+            self.latencies.append(secs)
+            self._p95 = None
+            self.ewma = secs if self.ewma is None else self.ewma + self.EWMA_ALPHA * (secs - self.ewma)
+            self.failures = 0
+            self.open_until = 0
+
+    def failure(self, threshold, cooldown):
+        """Records a failure. Returns True if the endpoint is ejected by it."""
+        with self._lock:
+            self.failures += 1
+            if self.failures >= threshold and time.time() >= self.open_until:
+                self.open_until = time.time() + cooldown
+                return True
+            return False
@@ -0,0 +1,216 @@
+import time, sys
+from concurrent.futures import ThreadPoolExecutor
+import lib.Metrics
+
+FANOUT_SECONDS = lib.Metrics.histogram("fanout_seconds", "Duration of the fan-out of a signal to all of its contracts")
+BROADCAST_SECONDS = lib.Metrics.histogram("fanout_broadcast_seconds",
+                                          "From the start of a fan-out to its first and last broadcast", ["edge"])
+RECEIVE_TO_BROADCAST = lib.Metrics.histogram("signal_receive_to_broadcast_seconds",
+                                             "From the receipt of a signal to its first broadcast (includes the wait "
+                                             "for the execution time of scheduled signals)")
+
+class FanoutExecutor():
+    """ Class to execute a triggered signal on all of its matching contracts concurrently.
+
+        The contracts are grouped by trader address. The contracts of one trader are executed in order on
+        a single worker so that the trader's transactions are broadcast in nonce order, while the groups of
+        different traders run concurrently on up to max_workers threads.
+        
+        Before the fan-out, the balances of all of the (contract, synth) pairs needed by the signal are read
+        in a few aggregated calls (see TradeExecutor.getBalancesBulk). The trades of a type2 signal are then
+        computed for all of the contracts at once (TradeExecutor.planType2Bulk).
+        
+        With a signer (lib.BulkSigner.BulkSigner) or a preflight (lib.Preflight.Preflight), the fan-out runs in
+        stages: the txes of all of the contracts are built (TradeExecutor.planOne), simulated in one batch by
+        the preflight (the txes that would fail are dropped before they are given a nonce), signed in one batch
+        by the signer's worker processes, and then broadcast in nonce order per trader. Without a signer, each
+        tx is signed on its trader's worker thread.
+    """
+    def __init__(self, trade_executor, max_workers, min_fee_rate, logger, journal = None, signer = None,
+                 preflight = None):
+        """
+        trade_executor: lib.TradeExecutor.TradeExecutor instance
+        max_workers: the maximum number of traders whose contracts are executed concurrently.
+        min_fee_rate: the minimum fee rate accepted by this server.
+        journal: optional lib.Journal.Journal in which the start and the end of each contract's execution
+                 are recorded. The starts of a fan-out are committed before its first broadcast.
+        signer: optional lib.BulkSigner.BulkSigner used to sign the txes of a fan-out in one batch.
+        preflight: optional lib.Preflight.Preflight used to simulate the txes of a fan-out before they are signed.
+        """
+        self.te = trade_executor
+        self.min_fee_rate = min_fee_rate
+        self.log = logger
+        self.journal = journal
+        self.signer = signer
+        self.preflight = preflight
+        self.pool = ThreadPoolExecutor(max_workers = max(1, int(max_workers)), thread_name_prefix = "fanout")
+
+    def execute(self, trade_signal, matches):
+        """Executes the signal on the contracts.
+
+        matches: list of (contract_address, contract_state), e.g. from ContractMonitor.getStatesThatMatchLabel
+
+        Returns: list of (contract_address, tx_hashes, broadcast_ts) in the order of matches."""
+        start = time.time()
+        balances = self._prefetchBalances(trade_signal, matches)
+        trades = self._planBulk(trade_signal, balances)
+        
+        groups = {}  #trader address => list of (index, contract_address, contract_state, balances, trades)
+        for i, (contract_address, contract_state) in enumerate(matches):
+            groups.setdefault(contract_state['trader'], []).append(
+                (i, contract_address, contract_state, balances[i], trades[i]))
+        if self.journal is not None and matches:
+            #a contract that was started is not executed again after a crash, so the starts (and the "executing"
+            #status of the signal) must be committed before anything is broadcast. One commit per fan-out.
+            for contract_address, _contract_state in matches:
+                self.journal.executionStarted(trade_signal, contract_address)
+            self.journal.flush()
+
+        if self.signer is not None or self.preflight is not None:
+            planned = self._planGroups(trade_signal, groups)
+            if self.preflight is not None:
+                planned = self._preflightGroups(planned, dict(matches))
+            planned = self._signGroups(planned)
+            futures = [self.pool.submit(self._broadcastGroup, trade_signal, trader_address, group)
+                       for trader_address, group in planned.items()]
+        else:
+            futures = [self.pool.submit(self._executeGroup, trade_signal, group) for group in groups.values()]
+
+        results = [None] * len(matches)
+        for f in futures:
+            for i, contract_address, tx_hashes, ts in f.result():
+                results[i] = (contract_address, tx_hashes, ts)
+
+        broadcast_ts = [ts for _address, tx_hashes, ts in results if tx_hashes]
+        n_txes = sum(len(r[1]) for r in results)
+        FANOUT_SECONDS.observe(time.time() - start)
+        if broadcast_ts:
+            BROADCAST_SECONDS.observe(min(broadcast_ts) - start, edge = "first")
+            BROADCAST_SECONDS.observe(max(broadcast_ts) - start, edge = "last")
+            if 'received_ts' in trade_signal:
+                RECEIVE_TO_BROADCAST.observe(min(broadcast_ts) - trade_signal['received_ts'])
+            self.log("Signal fan-out completed: {}. Contracts: {}, traders: {}, txes: {}. First broadcast: {:.3f}s, "
+                     "last broadcast: {:.3f}s, total: {:.3f}s".format(trade_signal['name'], len(matches), len(groups),
+                     n_txes, min(broadcast_ts) - start, max(broadcast_ts) - start, time.time() - start))
+        else:
+            self.log("Signal fan-out completed: {}. Contracts: {}, no txes broadcast. Total: {:.3f}s".format(
+                trade_signal['name'], len(matches), time.time() - start))
+        self.log("Market data cache: {}".format(self.te.market.stats()))
+        return results
+
+    def _prefetchBalances(self, trade_signal, matches):
+        """Returns a list with a {"synth_name": balance} dictionary for each of the matches. An entry is
+        None if its balances could not be read (executeOne then reads them itself)."""
+        try:
+            synths = self.te.signalSynths(trade_signal)
+            if not synths or not matches:
+                return [None] * len(matches)
+            _block, matrix = self.te.getBalancesBulk([m[0] for m in matches], synths)
+        except:
+            self.log("Error reading the balances for signal {}. Msg: {}".format(trade_signal['name'], sys.exc_info()[0]),
+                     level = "error")
+            return [None] * len(matches)
+        return [dict(zip(synths, row)) if None not in row else None for row in matrix]
+    
+    def _planBulk(self, trade_signal, balances):
+        """Returns a list with the precomputed trades of each contract, or None where executeOne computes them."""
+        if trade_signal['type'] == "type2" and any(b is not None for b in balances):
+            try:
+                return self.te.planType2Bulk(trade_signal, balances)
+            except:
+                self.log("Error computing the type2 trades for signal {}. Msg: {}".format(trade_signal['name'], sys.exc_info()[0]),
+                         level = "error")
+        return [None] * len(balances)
+    
+    def _executeGroup(self, trade_signal, group):
+        out = []
+        for i, contract_address, contract_state, balances, trades in group:
+            try:
+                tx_hashes = self.te.executeOne(trade_signal, contract_address, contract_state, self.min_fee_rate,
+                                               balances, trades)
+            except:
+                self.log("Error executing signal {} for contract {}. Msg: {}".format(
+                    trade_signal['name'], contract_address, sys.exc_info()[0]), level = "error")
+                tx_hashes = []
+            if self.journal is not None:
+                self.journal.executionDone(trade_signal, contract_address, tx_hashes)
+            out.append((i, contract_address, tx_hashes, time.time()))
+        return out
+
+    def _planGroups(self, trade_signal, groups):
+        """Builds the txes of all of the contracts, without nonces.
+        
+        Returns: trader address => list of (index, contract_address, txns)."""
+        planned = {}
+        for trader_address, group in groups.items():
+            for i, contract_address, contract_state, balances, trades in group:
+                try:
+                    txns = self.te.planOne(trade_signal, contract_address, contract_state, self.min_fee_rate,
+                                           balances, trades)
+                except:
+                    self.log("Error executing signal {} for contract {}. Msg: {}".format(
+                        trade_signal['name'], contract_address, sys.exc_info()[0]), level = "error")
+                    txns = []
+                planned.setdefault(trader_address, []).append((i, contract_address, txns))
+        return planned
+    
+    def _preflightGroups(self, planned, states):
+        """Simulates all of the planned txes in one batch and drops the txes that would fail.
+        
+        states: contract_address => contract_state"""
+        items = [(contract_address, states[contract_address], txn) for trader_address, group in planned.items()
+                 for _i, contract_address, txns in group for txn in txns]
+        checked = iter(self.preflight.check(items))
+        return {trader_address: [(i, contract_address, [txn for txn in [next(checked) for _txn in txns] if txn is not None])
+                                 for i, contract_address, txns in group]
+                for trader_address, group in planned.items()}
+    
+    def _signGroups(self, planned):
+        """Allocates the nonces of the planned txes and, with a signer, signs them in one batch.
+        
+        Returns: trader address => list of (index, contract_address, list of (txn, raw txn, tx hash)). Without
+        a signer, the raw txns and the tx hashes are None (the txes are signed when they are sent)."""
+        if self.signer is None:
+            return {trader_address: [(i, contract_address, [(txn, None, None) for txn in txns])
+                                     for i, contract_address, txns in group]
+                    for trader_address, group in planned.items()}
+        
+        planned = {trader_address: [(i, contract_address, self.te.allocateNonces(txns, trader_address))
+                                    for i, contract_address, txns in group]
+                   for trader_address, group in planned.items()}
+        items = [(trader_address, txn) for trader_address, group in planned.items()
+                 for _i, _contract_address, txns in group for txn in txns]
+        signed = {(trader_address, txn['nonce']): (raw_txn, txn_hash)
+                  for trader_address, txn, raw_txn, txn_hash in self.signer.sign(items)}
+        return {trader_address: [(i, contract_address, [(txn,) + signed[(trader_address, txn['nonce'])] for txn in txns])
+                                 for i, contract_address, txns in group]
+                for trader_address, group in planned.items()}
+    
+    def _broadcastGroup(self, trade_signal, trader_address, group):
+        """Broadcasts the pre-signed txes of one trader in nonce order. After a tx fails (the node rejected it, 
+        or does not have it after a timeout, see TradeExecutor.broadcastSigned), the failed tx and the trader's 
+        later txes are re-signed with new nonces (their pre-signed nonces would leave a gap). Txes that are not 
+        pre-signed are signed and sent with sendTransaction."""
+        out = []
+        presigned = self.signer is not None
+        for i, contract_address, signed in group:
+            tx_hashes = []
+            for txn, raw_txn, txn_hash in signed:
+                if presigned:
+                    try:
+                        tx_hashes.append(self.te.broadcastSigned(txn, trader_address, raw_txn, txn_hash))
+                        continue
+                    except:
+                        self.log("Error broadcasting tx of signal {} for contract {}. Re-signing the trader's "
+                                 "remaining txes. Msg: {}".format(trade_signal['name'], contract_address, sys.exc_info()[1]),
+                                 level = "error")
+                        presigned = False
+                try:
+                    tx_hashes.append(self.te.sendTransaction(txn, trader_address))
+                except:
+                    self.log("Error executing signal {} for contract {}. Msg: {}".format(
+                        trade_signal['name'], contract_address, sys.exc_info()[0]), level = "error")
+            if self.journal is not None:
+                self.journal.executionDone(trade_signal, contract_address, tx_hashes)
+            out.append((i, contract_address, tx_hashes, time.time()))
+        return out
@@ -0,0 +1,43 @@
+import hashlib, bisect
+
+class HashRing():
+    """ Consistent hash ring that maps keys (e.g. trader addresses) to nodes (e.g. shard workers).
+
+        Each node is placed on the ring at vnodes points, and a key belongs to the first node point at or
+        after the hash of the key. When a node joins or leaves, only the keys of the ring segments it takes
+        over or gives up change owner (about 1/N of the keys).
+    """
+    def __init__(self, nodes = (), vnodes = 100):
+        self.vnodes = vnodes
+        self.nodes = set()
+        self._points = []   #sorted hashes of the node points
+        self._owners = []   #node of each point
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        self._rebuild()
+
+    def remove(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        self._rebuild()
+
+    def node(self, key):
+        """Returns the node that owns the key, or None if the ring is empty."""
+        if not self._points:
+            return None
+        i = bisect.bisect_left(self._points, self._hash(key))
+        return self._owners[i % len(self._points)]
+
+    def _rebuild(self):
+        points = sorted((self._hash("{}#{}".format(node, i)), node) for node in self.nodes for i in range(self.vnodes))
+        self._points = [p for p, _node in points]
+        self._owners = [node for _p, node in points]
+
+    def _hash(self, key):
+        return int.from_bytes(hashlib.sha1(str(key).lower().encode()).digest()[:8], "big")
@@ -0,0 +1,177 @@
+import sqlite3, json, threading, queue, time, uuid, sys
+
+class Journal():
+    """ Crash-safe journal of the server's runtime state, in an SQLite database in WAL mode.
+
+        It records the signals that are received (and whether they are pending, executing, done or expired),
+        the contracts of a fan-out that were started and done, and the transactions that were broadcast and
+        their receipts. After a crash or a restart, recover() returns what is needed to resume: the pending
+        signals, the signals whose fan-out was interrupted (with the contracts already executed) and the
+        transactions that are still in flight. getState/setState store small json values (e.g. the state of
+        a signal generator).
+
+        Writes never block the caller: they are queued and committed in batches by a background thread,
+        every commit_ms at most. flush() waits until the writes queued before it are committed (e.g. the
+        starts of a fan-out, before its first broadcast).
+
+        A signal is identified by its "id" field if it has one, otherwise by a generated key. The key is
+        stored in the signal under Journal.KEY.
+    """
+    KEY = "journal_key"
+
+    SCHEMA = ["CREATE TABLE IF NOT EXISTS signals (key TEXT PRIMARY KEY, signal TEXT, status TEXT, ts REAL)",
+              "CREATE TABLE IF NOT EXISTS executions (signal_key TEXT, contract TEXT, status TEXT, tx_hashes TEXT, "
+              "ts REAL, PRIMARY KEY (signal_key, contract))",
+              "CREATE TABLE IF NOT EXISTS txs (tx_hash TEXT PRIMARY KEY, contract TEXT, trader TEXT, nonce INTEGER, "
+              "txn TEXT, status TEXT, block INTEGER, ts REAL)",
+              "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT)"]
+
+    def __init__(self, fn, logger, commit_ms = 50, max_batch = 1000):
+        """
+        fn: the database file
+        commit_ms: how long queued writes may wait for other writes to join their commit.
+        max_batch: the maximum number of writes in one commit.
+        """
+        self.fn = fn
+        self.log = logger
+        self.commit_window = commit_ms / 1000.
+        self.max_batch = max_batch
+        self.writes = queue.Queue()
+
+        conn = self._connect()
+        for sql in self.SCHEMA:
+            conn.execute(sql)
+        conn.commit()
+        conn.close()
+
+        t = threading.Thread(target = self._writeLoop, daemon = True)
+        t.start()
+
+    # -- signals
+
+    def signalAdded(self, signal):
+        """Records a scheduled signal. Returns its journal key."""
+        key = signal.get(self.KEY) or signal.get('id') or uuid.uuid4().hex
+        signal[self.KEY] = key
+        self._write("INSERT OR REPLACE INTO signals VALUES (?, ?, 'pending', ?)", (key, json.dumps(signal), time.time()))
+        return key
+
+    def signalStatus(self, signal, status):
+        """status: "executing", "done" or "expired" """
+        if signal.get(self.KEY):
+            self._write("UPDATE signals SET status = ?, ts = ? WHERE key = ?", (status, time.time(), signal[self.KEY]))
+
+    # -- fan-out
+
+    def executionStarted(self, signal, contract):
+        if signal.get(self.KEY):
+            self._write("INSERT OR REPLACE INTO executions VALUES (?, ?, 'started', NULL, ?)",
+                        (signal[self.KEY], contract, time.time()))
+
+    def executionDone(self, signal, contract, tx_hashes):
+        if signal.get(self.KEY):
+            self._write("INSERT OR REPLACE INTO executions VALUES (?, ?, 'done', ?, ?)",
+                        (signal[self.KEY], contract, json.dumps(list(tx_hashes)), time.time()))
+
+    # -- transactions
+
+    def txSent(self, tx_hash, contract, trader, nonce, txn):
+        self._write("INSERT OR REPLACE INTO txs VALUES (?, ?, ?, ?, ?, 'pending', NULL, ?)",
+                    (tx_hash, contract, trader, nonce, json.dumps(txn), time.time()))
+
+    def txDone(self, tx_hash, status, block_number = None):
+        """status: "success", "failed", "replaced" (another tx with the same nonce was included) or "dropped"
+        (the nonce was used by a tx that is not tracked)."""
+        self._write("UPDATE txs SET status = ?, block = ?, ts = ? WHERE tx_hash = ?",
+                    (status, block_number, time.time(), tx_hash))
+
+    # -- key/value state
+
+    def setState(self, key, value):
+        self._write("INSERT OR REPLACE INTO kv VALUES (?, ?)", (key, json.dumps(value)))
+
+    def getState(self, key, default = None):
+        """Returns the committed value of the key (see flush)."""
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        finally:
+            conn.close()
+        return json.loads(row[0]) if row else default
+
+    # -- recovery
+
+    def recover(self):
+        """Reads the state to resume from.
+
+        Returns: a dictionary of
+            'pending': list of the signals that were scheduled but not triggered,
+            'executing': list of (signal, set of contract addresses) of the signals whose fan-out was not
+                         completed. A contract that was started is included even if it was not done, so that
+                         it is never traded twice.
+            'txs': list of {'tx_hash', 'contract', 'trader', 'nonce', 'txn', 'ts'} of the txes in flight,
+            'ids': the "id" fields of the signals received in the last day (for duplicate detection)."""
+        conn = self._connect()
+        try:
+            pending = [json.loads(s) for (s,) in conn.execute(
+                "SELECT signal FROM signals WHERE status = 'pending' ORDER BY ts")]
+            executing = []
+            for key, s in conn.execute("SELECT key, signal FROM signals WHERE status = 'executing' ORDER BY ts").fetchall():
+                contracts = set(c for (c,) in conn.execute("SELECT contract FROM executions WHERE signal_key = ?", (key,)))
+                executing.append((json.loads(s), contracts))
+            txs = [{'tx_hash': h, 'contract': c, 'trader': t, 'nonce': n, 'txn': json.loads(txn), 'ts': ts}
+                   for h, c, t, n, txn, ts in conn.execute(
+                       "SELECT tx_hash, contract, trader, nonce, txn, ts FROM txs WHERE status = 'pending' ORDER BY ts")]
+            ids = [json.loads(s).get('id') for (s,) in conn.execute(
+                "SELECT signal FROM signals WHERE ts > ? ORDER BY ts", (time.time() - 24 * 3600,))]
+        finally:
+            conn.close()
+        self.log("Journal recovery: {} pending signals, {} interrupted fan-outs, {} txes in flight".format(
+            len(pending), len(executing), len(txs)))
+        return {'pending': pending, 'executing': executing, 'txs': txs, 'ids': [i for i in ids if i is not None]}
+
+    def flush(self):
+        """Blocks until all of the writes queued before the call are committed."""
+        committed = threading.Event()
+        self.writes.put((None, committed))
+        committed.wait()
+
+    def _write(self, sql, params):
+        self.writes.put((sql, params))
+
+    def _connect(self):
+        conn = sqlite3.connect(self.fn, timeout = 30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _writeLoop(self):
+        conn = self._connect()
+        while True:
+            batch = [self.writes.get()]
+            time.sleep(self.commit_window)   #let other writes join the commit
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.writes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with conn:
+                    for sql, params in batch:
+                        if sql is not None:
+                            conn.execute(sql, params)
+            except:
+                #the batch was rolled back. Write the entries one at a time so only the bad one is lost.
+                for sql, params in batch:
+                    if sql is None:
+                        continue
+                    try:
+                        with conn:
+                            conn.execute(sql, params)
+                    except:
+                        self.log("Error writing journal entry: {} {}. Msg: {}".format(sql, params, sys.exc_info()[1]),
+                                 level = "error")
+            for sql, params in batch:
+                if sql is None:
+                    params.set()    #flush() marker
+                self.writes.task_done()
@@ -0,0 +1,126 @@
+import web3, threading, time, sys
+import lib.Multicall, lib.Utils
+
+class MarketDataCache():
+    """ Block-keyed cache of the Synthetix market data used when executing trades.
+
+        The gas price limit, the node's gas price and the exchange rates are fetched at most once per block and shared by all
+        executions in that block. Synth addresses rarely change, so they are kept for synth_ttl_secs.
+        The current block number itself is re-read at most every block_poll_secs.
+
+        A block-keyed entry is served for ttl_blocks blocks (1 = only in the block it was fetched in) and 
+        is evicted after that. The hit, miss and eviction counters are available from stats().
+    """
+    def __init__(self, w3, synthetix_contract, multicall, logger, block_poll_secs = 2, ttl_blocks = 1,
+                 synth_ttl_secs = 3600):
+        """
+        w3: A web3.Web3 instance
+        synthetix_contract: w3.eth.contract instance of the Synthetix contract
+        multicall: lib.Multicall.Multicall instance used to fetch the rates of several synths at once
+        """
+        self.w3 = w3
+        self.synthetix_contract = synthetix_contract
+        self.multicall = multicall
+        self.log = logger
+        self.block_poll_secs = block_poll_secs
+        self.ttl_blocks = ttl_blocks
+        self.synth_ttl_secs = synth_ttl_secs
+
+        self.entries = {}            #key => (block_number, timestamp, value)
+        self.block_number = None
+        self.block_ts = 0
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._lock = threading.RLock()
+
+    def currentBlock(self):
+        """Returns the latest block number, re-read from the node at most every block_poll_secs."""
+        with self._lock:
+            if self.block_number is None or time.time() - self.block_ts > self.block_poll_secs:
+                block_number = self.w3.eth.blockNumber
+                self.block_ts = time.time()
+                if block_number != self.block_number:
+                    self.block_number = block_number
+                    self._evict()
+            return self.block_number
+
+    def gasPriceLimit(self):
+        """Returns the gas price limit of the Synthetix contract for the current block."""
+        block_number = self.currentBlock()
+        return self._get(('gasPriceLimit',), block_number, lambda: self.synthetix_contract.functions.gasPriceLimit().call(
+            block_identifier = block_number))
+
+    def gasPrice(self):
+        """Returns the node's gas price (eth_gasPrice) for the current block."""
+        return self._get(('gasPrice',), self.currentBlock(), lambda: self.w3.eth.gasPrice)
+
+    def synthAddress(self, synth_name):
+        """Returns the address of the synth contract (cached for synth_ttl_secs)."""
+        currKey = lib.Utils.nameToKey(synth_name)
+        return self._get(('synth', synth_name), None, lambda: self.synthetix_contract.functions.synths(currKey).call(),
+                         self.synth_ttl_secs)
+
+    def rates(self, synth_names):
+        """Returns a dictionary of {"synth_name": rate} for the current block, where rate is the value of one
+        unit of the synth in sUSD (18 decimals)."""
+        block_number = self.currentBlock()
+        with self._lock:
+            rates = {}; missing = []
+            for synth in synth_names:
+                entry = self._lookup(('rate', synth), block_number)
+                if entry is not None:
+                    rates[synth] = entry
+                else:
+                    missing.append(synth)
+            self.counters['hits'] += len(rates)
+            self.counters['misses'] += len(missing)
+            if missing:
+                sUSD_key = web3.Web3.toBytes(hexstr = lib.Utils.nameToKey("sUSD"))
+                calls = [(self.synthetix_contract.address,
+                          lib.Multicall.encodeCall('effectiveValue(bytes32,uint256,bytes32)', ['bytes32', 'uint256', 'bytes32'],
+                                                   [web3.Web3.toBytes(hexstr = lib.Utils.nameToKey(synth)), 10**18, sUSD_key]),
+                          ['uint256']) for synth in missing]
+                _block, results = self.multicall.aggregate(calls, block_number)
+                for synth, r in zip(missing, results):
+                    if r is None:
+                        raise ValueError("Could not read the exchange rate of {}".format(synth))
+                    rates[synth] = r[0]
+                    self.entries[('rate', synth)] = (block_number, time.time(), r[0])
+            return rates
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, entries = len(self.entries), block = self.block_number)
+
+    def _get(self, key, block_number, fetch, ttl_secs = None):
+        with self._lock:
+            value = self._lookup(key, block_number, ttl_secs)
+            if value is not None:
+                self.counters['hits'] += 1
+                return value
+            self.counters['misses'] += 1
+            value = fetch()
+            self.entries[key] = (block_number, time.time(), value)
+            return value
+
+    def _lookup(self, key, block_number, ttl_secs = None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        _block, ts, value = entry
+        if block_number is not None and (_block is None or block_number - _block >= self.ttl_blocks):
+            return None
+        if ttl_secs is not None and time.time() - ts > ttl_secs:
+            return None
+        return value
+
+    def _evict(self):
+        """Drops the block-keyed entries that are too old and the expired entries."""
+        now = time.time()
+        for key, (_block, ts, _value) in list(self.entries.items()):
+            if _block is None:
+                expired = now - ts > self.synth_ttl_secs
+            else:
+                expired = self.block_number - _block >= self.ttl_blocks
+            if expired:
+                del self.entries[key]
+                self.counters['evictions'] += 1
@@ -0,0 +1,270 @@
+"""Counters, gauges and latency histograms of the signal pipeline, exposed in the Prometheus text format.
+
+Metrics are created (or looked up) by name in a process-wide registry:
+
+    SIGNALS = lib.Metrics.counter("signals_received_total", "Signals received", ["status"])
+    SIGNALS.inc(status = "accepted")
+    with lib.Metrics.histogram("trade_execute_seconds", "executeOne duration", ["type"]).time(type = "type3"):
+        ...
+
+startServer() serves the metrics on http://<address>:<port>/metrics. If the profiler is enabled,
+/profile?seconds=N samples the stacks of all threads for N seconds and returns the hottest stacks, so hot
+spots can be found in a running process without restarting it.
+
+rpcMiddleware is a web3 middleware that times every JSON-RPC method.
+"""
+import threading, time, sys, collections, traceback
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BLOCK_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class _Metric():
+    TYPE = None
+
+    def __init__(self, name, help_text, label_names = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.label_names)
+
+    def _labelText(self, key, extra = ()):
+        pairs = list(zip(self.label_names, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(n, v.replace('\\', '\\\\').replace('"', '\\"')) for n, v in pairs) + "}"
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.TYPE)]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    TYPE = "counter"
+
+    def __init__(self, name, help_text, label_names = ()):
+        _Metric.__init__(self, name, help_text, label_names)
+        self.values = {}
+
+    def inc(self, n = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+    def _samples(self):
+        with self._lock:
+            return ["{}{} {}".format(self.name, self._labelText(k), v) for k, v in sorted(self.values.items())]
+
+
+class Gauge(_Metric):
+    TYPE = "gauge"
+
+    def __init__(self, name, help_text, label_names = ()):
+        _Metric.__init__(self, name, help_text, label_names)
+        self.values = {}
+        self.functions = {}
+
+    def set(self, value, **labels):
+        with self._lock:
+            self.values[self._key(labels)] = value
+
+    def inc(self, n = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+    def dec(self, n = 1, **labels):
+        self.inc(-n, **labels)
+
+    def setFunction(self, fn, **labels):
+        """The value is read from fn() when the metrics are rendered (no sample if it returns None)."""
+        with self._lock:
+            self.functions[self._key(labels)] = fn
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self.values)
+            functions = dict(self.functions)
+        for key, fn in functions.items():
+            try:
+                values[key] = fn()
+            except:
+                pass
+        return ["{}{} {}".format(self.name, self._labelText(k), v) for k, v in sorted(values.items()) if v is not None]
+
+
+class Histogram(_Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, help_text, label_names = (), buckets = LATENCY_BUCKETS):
+        _Metric.__init__(self, name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}    #label key => [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            v = self.values.get(key)
+            if v is None:
+                v = self.values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    v[i] += 1
+                    break
+            v[-2] += value
+            v[-1] += 1
+
+    def time(self, **labels):
+        """Context manager that observes the duration of its block (in seconds)."""
+        return _Timer(self, labels)
+
+    def _samples(self):
+        lines = []
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self.values.items())
+        for key, v in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, v):
+                cumulative += n
+                lines.append("{}_bucket{} {}".format(self.name, self._labelText(key, [("le", repr(float(bound)))]), cumulative))
+            lines.append("{}_bucket{} {}".format(self.name, self._labelText(key, [("le", "+Inf")]), v[-1]))
+            lines.append("{}_sum{} {}".format(self.name, self._labelText(key), v[-2]))
+            lines.append("{}_count{} {}".format(self.name, self._labelText(key), v[-1]))
+        return lines
+
+
+class _Timer():
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+        return False
+
+
+class Registry():
+    def __init__(self):
+        self.metrics = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cls, name, help_text, label_names, **kwargs):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help_text, label_names, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError("Metric {} is already registered as a {}".format(name, metric.TYPE))
+            return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+def counter(name, help_text, label_names = ()):
+    return REGISTRY.get(Counter, name, help_text, label_names)
+
+def gauge(name, help_text, label_names = ()):
+    return REGISTRY.get(Gauge, name, help_text, label_names)
+
+def histogram(name, help_text, label_names = (), buckets = LATENCY_BUCKETS):
+    return REGISTRY.get(Histogram, name, help_text, label_names, buckets = buckets)
+
+
+RPC_SECONDS = histogram("rpc_request_seconds", "Duration of JSON-RPC requests made through web3", ["method"])
+RPC_ERRORS = counter("rpc_errors_total", "JSON-RPC requests that returned an error or raised", ["method"])
+
+def rpcMiddleware(make_request, w3):
+    """web3 middleware that times every JSON-RPC request by method."""
+    def middleware(method, params):
+        start = time.time()
+        try:
+            response = make_request(method, params)
+        except:
+            RPC_ERRORS.inc(method = method)
+            raise
+        finally:
+            RPC_SECONDS.observe(time.time() - start, method = method)
+        if isinstance(response, dict) and 'error' in response:
+            RPC_ERRORS.inc(method = method)
+        return response
+    return middleware
+
+
+class SamplingProfiler():
+    """ Samples the stacks of all threads every interval_ms and counts the collapsed stacks
+        ("file:function;file:function ..."), in the format of flame graph tools.
+    """
+    def __init__(self, interval_ms = 5):
+        self.interval = interval_ms / 1000.
+        self._lock = threading.Lock()   #one profile at a time
+
+    def profile(self, seconds, top = 50):
+        """Samples for the given number of seconds (in the calling thread).
+
+        Returns: the text of the top stacks with their sample counts, hottest first."""
+        with self._lock:
+            me = threading.get_ident()
+            stacks = collections.Counter()
+            n_samples = 0
+            end = time.time() + seconds
+            while time.time() < end:
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == me:
+                        continue
+                    stack = ["{}:{}".format(f.filename.rsplit("/", 1)[-1], f.name) for f in traceback.extract_stack(frame)]
+                    stacks[";".join(stack)] += 1
+                n_samples += 1
+                time.sleep(self.interval)
+        lines = ["# {} samples over {}s".format(n_samples, seconds)]
+        lines.extend("{} {}".format(stack, n) for stack, n in stacks.most_common(top))
+        return "\n".join(lines) + "\n"
+
+
+def startServer(port, address = "127.0.0.1", profiler = False, registry = REGISTRY):
+    """Serves /metrics (and /profile if profiler is True) in a background thread. Returns the server."""
+    sampler = SamplingProfiler() if profiler else None
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/metrics":
+                body = registry.render()
+                content_type = "text/plain; version=0.0.4"
+            elif url.path == "/profile" and sampler is not None:
+                query = parse_qs(url.query)
+                seconds = min(float(query.get('seconds', ['10'])[0]), 300)
+                body = sampler.profile(seconds, int(query.get('top', ['50'])[0]))
+                content_type = "text/plain"
+            else:
+                self.send_error(404)
+                return
+            data = body.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+    server = ThreadingHTTPServer((address, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
@@ -0,0 +1,84 @@
+import web3, eth_abi, json, os, sys
+
+MULTICALL_ABI_FN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "abis", "multicall_abi.json")
+
+def selector(signature):
+    """Returns the 4 byte function selector (as bytes) for a signature such as "balanceOf(address)". """
+    return bytes(web3.Web3.keccak(text = signature)[:4])
+
+def encodeCall(signature, arg_types = (), args = ()):
+    """Returns the calldata (bytes) for a call of the function signature with the given arguments."""
+    return selector(signature) + eth_abi.encode_abi(list(arg_types), list(args))
+
+
+class Multicall():
+    """ Aggregates many constant calls into a few eth_calls against a deployed Multicall contract
+        (https://github.com/makerdao/multicall).
+
+        A call is a tuple of (target_address, calldata, output_types). For example:
+        ("0x7C34D8bB789C354fD7Ed1B32466cF8c84F360602", encodeCall("feeRate()"), ["uint256"])
+
+        All of the batches of one aggregate() call are pinned to the same block number. A single failing
+        call reverts a whole Multicall batch, so when a batch fails the calls in that batch are retried
+        one at a time with a plain eth_call. If no multicall address is given, every call is made
+        individually (but still pinned to one block).
+    """
+    def __init__(self, w3, multicall_address, batch_size, logger):
+        """
+        w3: A web3.Web3 instance
+        multicall_address: address of the Multicall contract, or None to disable aggregation.
+        batch_size: the maximum number of calls aggregated into a single eth_call.
+        """
+        self.w3 = w3
+        self.batch_size = max(1, int(batch_size))
+        self.log = logger
+
+        self.multicall_contract = None
+        if multicall_address:
+            self.multicall_contract = self.w3.eth.contract(address = multicall_address,
+                                                           abi = json.load(open(MULTICALL_ABI_FN, "r")))
+
+    def aggregate(self, calls, block_number = None):
+        """Execute the calls.
+
+        block_number: block to pin the calls to. The latest block is used if None.
+
+        Returns: a tuple of (block_number, results), where results[i] is the decoded output tuple of
+        calls[i], or None if that call failed."""
+        if block_number is None:
+            block_number = self.w3.eth.blockNumber
+
+        results = []
+        for i in range(0, len(calls), self.batch_size):
+            batch = calls[i:i + self.batch_size]
+            results.extend(self._aggregateBatch(batch, block_number))
+        return block_number, results
+
+    def _aggregateBatch(self, batch, block_number):
+        if self.multicall_contract is not None:
+            try:
+                _calls = [(target, calldata) for target, calldata, _types in batch]
+                _block, return_data = self.multicall_contract.functions.aggregate(_calls).call(
+                    block_identifier = block_number)
+                return [self._decode(_types, data) for (_t, _c, _types), data in zip(batch, return_data)]
+            except:
+                self.log("Multicall batch of {} calls failed, falling back to single calls. Msg: {}".format(
+                    len(batch), sys.exc_info()[0]))
+
+        return [self._callOne(target, calldata, _types, block_number) for target, calldata, _types in batch]
+
+    def _callOne(self, target, calldata, output_types, block_number):
+        try:
+            data = self.w3.eth.call({'to': target, 'data': web3.Web3.toHex(calldata)}, block_number)
+        except:
+            return None
+        return self._decode(output_types, data)
+
+    def _decode(self, output_types, data):
+        """Decodes return data. Addresses are returned checksummed, as web3 contract calls do."""
+        try:
+            values = eth_abi.decode_abi(list(output_types), bytes(data))
+        except:
+            return None
+        return tuple(web3.Web3.toChecksumAddress(v) if t == 'address' else v
+                     for t, v in zip(output_types, values))
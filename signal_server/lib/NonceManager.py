@@ -0,0 +1,98 @@
+import threading, time
+
+class NonceManager():
+    """ Class to hand out transaction nonces for the trader accounts without a round trip to the node.
+
+        The nonce of an account is synced with the node's pending transaction count the first time it is
+        used, after an account has been idle for resync_secs, and whenever a send fails. In between, nonces
+        are handed out locally, so several transactions from the same trader can be broadcast back-to-back
+        before the first one is mined.
+    """
+    # Substrings of node error messages indicating that the local nonce is behind the node
+    NONCE_ERRORS = ["nonce too low", "replacement transaction underpriced"]
+    # Substrings of node error messages indicating that the node already has this exact transaction (it was sent
+    # before, e.g. by another endpoint). The send succeeded; the nonce is not out of sync.
+    KNOWN_TX_ERRORS = ["already known", "known transaction"]
+
+    def __init__(self, w3, logger, resync_secs = 60):
+        """
+        w3: A web3.Web3 instance
+        resync_secs: an account that has been idle this long is re-synced before its next nonce is
+                     handed out. This recovers gaps from dropped transactions.
+        """
+        self.w3 = w3
+        self.log = logger
+        self.resync_secs = resync_secs
+
+        self.next_nonce = {}     #address => next nonce to hand out
+        self.last_used = {}      #address => timestamp of the last nonce handed out
+        self.locks = {}          #address => lock
+        self._locks_lock = threading.Lock()
+
+    def sync(self, address):
+        """Sets the next nonce of the account to the node's pending transaction count."""
+        with self._lock(address):
+            self._sync(address)
+
+    def syncAll(self, addresses):
+        for address in addresses:
+            try:
+                self.sync(address)
+            except:
+                self.log("Error syncing the nonce of account: {}".format(address), level = "error")
+
+    def allocate(self, address):
+        """Returns the next nonce for the account."""
+        with self._lock(address):
+            if address not in self.next_nonce or time.time() - self.last_used[address] > self.resync_secs:
+                self._sync(address)
+            nonce = self.next_nonce[address]
+            self.next_nonce[address] = nonce + 1
+            self.last_used[address] = time.time()
+            return nonce
+
+    def forget(self, address):
+        """Drops the local nonce of the account, so it is re-synced before its next nonce is handed out
+        (e.g. after another process may have sent txes from it)."""
+        with self._lock(address):
+            self.next_nonce.pop(address, None)
+
+    def reportError(self, address, nonce, error):
+        """Must be called when a transaction using an allocated nonce could not be sent.
+
+        Returns: True if the error indicates that the local nonce was out of sync with the node (so the
+        transaction may be retried with a newly allocated nonce)."""
+        with self._lock(address):
+            if self.isNonceError(error):
+                self.log("Nonce {} of account {} is out of sync. Re-syncing. Msg: {}".format(nonce, address, error))
+                self._sync(address)
+                return True
+
+            if self.next_nonce.get(address) == nonce + 1:
+                #the failed nonce was the last one handed out; simply hand it out again
+                self.next_nonce[address] = nonce
+            else:
+                #later nonces were handed out, so there is a gap. Re-sync with the node.
+                try:
+                    self._sync(address)
+                except:
+                    self.next_nonce.pop(address, None)
+            return False
+
+    def isNonceError(self, error):
+        msg = str(error).lower()
+        return any(e in msg for e in self.NONCE_ERRORS)
+
+    def isKnownTransaction(self, error):
+        msg = str(error).lower()
+        return any(e in msg for e in self.KNOWN_TX_ERRORS)
+
+    def _sync(self, address):
+        self.next_nonce[address] = self.w3.eth.getTransactionCount(address, 'pending')
+        self.last_used[address] = time.time()
+
+    def _lock(self, address):
+        with self._locks_lock:
+            if address not in self.locks:
+                self.locks[address] = threading.Lock()
+            return self.locks[address]
@@ -0,0 +1,135 @@
+import time, sys
+import web3
+import lib.Multicall, lib.Utils, lib.Metrics
+
+PREFLIGHT_SECONDS = lib.Metrics.histogram("preflight_seconds", "Duration of the simulation of the txes of a fan-out")
+DROPPED = lib.Metrics.counter("preflight_dropped_total", "Trade txes dropped because their simulation failed", ["reason"])
+AT_RISK = lib.Metrics.counter("preflight_at_risk_total", "Later trade txes of a contract that revert if they are "
+                              "mined in the same block as the contract's previous trade")
+
+#JSON-RPC errors meaning the node cannot simulate the txes (rather than that a tx would revert)
+UNSUPPORTED_ERRORS = (-32601, -32602)
+
+class Preflight():
+    """ Simulates the trade txes of a fan-out before they are signed, so that txes that would revert are not sent.
+
+        All of the simulations are pinned to one block: isTradeEligible() of every contract is read in a few
+        aggregated calls (see lib.Multicall), and every tx is simulated with eth_estimateGas in a single
+        JSON-RPC batch (see lib.Utils.batchRequest). Txes of an ineligible contract, and txes whose estimate
+        fails, are dropped. The gas limit of the other txes is set to the estimate plus gas_margin_pct percent.
+
+        Each tx is simulated against the state of the block, so a later tx of the same contract does not see
+        the effects of an earlier one. A trade sets the contract's lastTradeTS, after which isTradeEligible()
+        is false for minMinsBtwTrades minutes (and for the rest of the block if it is 0). So the trades of a
+        contract after its first one are dropped if its minMinsBtwTrades is above 0 (and logged per contract, so
+        that the signal can be issued again once the contract is eligible), and counted as at risk otherwise
+        (they only succeed if they are mined in a later block than the previous trade).
+
+        If the node does not support eth_estimateGas, a warning is logged and the estimates are skipped (the
+        gas limits are unchanged) for unsupported_retry_secs. If the eligibility cannot be read, the txes are
+        kept unchecked.
+    """
+    def __init__(self, w3, multicall, logger, gas_margin_pct = 20, unsupported_retry_secs = 3600):
+        """
+        w3: A web3.Web3 instance
+        multicall: lib.Multicall.Multicall instance, e.g. the one of the TradeExecutor.
+        gas_margin_pct: the gas limit of a tx is its estimate plus this percentage.
+        unsupported_retry_secs: how long the estimates are skipped after the node did not support them.
+        """
+        self.w3 = w3
+        self.multicall = multicall
+        self.log = logger
+        self.gas_margin = 1 + gas_margin_pct / 100.
+        self.unsupported_retry_secs = unsupported_retry_secs
+        self.unsupported_until = 0
+        self.warned = set()    #providers for which the missing eth_estimateGas support was logged
+
+    def check(self, items):
+        """
+        items: list of (contract_address, contract_state, txn), where txn is an unsigned trade txn (see
+               lib.ContractRegistry.TradeTxBuilder). The txns of a contract are in trade order.
+
+        Returns: a list with, for each of the items, the txn with its gas limit set from the estimate, or None
+        if the txn would fail."""
+        if not items:
+            return []
+        start = time.time()
+        try:
+            block_number, eligible = self._eligible(sorted(set(item[0] for item in items)))
+        except:
+            self.log("Error simulating the trade txes, sending them unchecked. Msg: {}".format(sys.exc_info()[1]),
+                     level = "error")
+            return [txn for _contract_address, _contract_state, txn in items]
+
+        out = [None] * len(items)
+        dropped = {'not_eligible': 0, 'min_time_between_trades': 0, 'reverted': 0}
+        simulate = []
+        seen = set()
+        later = {}   #contract_address => (minMinsBtwTrades, the later trade txns dropped)
+        for j, (contract_address, contract_state, txn) in enumerate(items):
+            if eligible.get(contract_address) is False:
+                dropped['not_eligible'] += 1
+                continue
+            if contract_address in seen:
+                if contract_state.get('minMinsBtwTrades', 0) > 0:
+                    dropped['min_time_between_trades'] += 1
+                    later.setdefault(contract_address, (contract_state['minMinsBtwTrades'], []))[1].append(txn)
+                    continue
+                AT_RISK.inc()
+            seen.add(contract_address)
+            out[j] = txn
+            simulate.append(j)
+
+        if simulate and time.time() >= self.unsupported_until:
+            try:
+                self._estimate(items, simulate, block_number, out, dropped)
+            except:
+                self.log("Error estimating the gas of the trade txes, sending them with the default gas limit. "
+                         "Msg: {}".format(sys.exc_info()[1]), level = "error")
+
+        for contract_address, (minutes, txns) in later.items():
+            self.log("Contract {} makes one trade per {} minutes (minMinsBtwTrades). Dropped its later trades: {}".format(
+                contract_address, minutes, "; ".join(self._describe(txn) for txn in txns)))
+        for reason, n in dropped.items():
+            DROPPED.inc(n, reason = reason)
+        PREFLIGHT_SECONDS.observe(time.time() - start)
+        return out
+
+    def _estimate(self, items, simulate, block_number, out, dropped):
+        """Estimates the gas of items[j] for j in simulate, and sets out[j] to the txn with its gas limit, or to
+        None if it would fail."""
+        responses = lib.Utils.batchRequest(self.w3, [('eth_estimateGas', [self._callParams(*items[j]), hex(block_number)])
+                                                     for j in simulate])
+        unsupported = [r['error'] for r in responses if isinstance(r.get('error'), dict) and r['error'].get('code') in UNSUPPORTED_ERRORS]
+        if unsupported:
+            self.unsupported_until = time.time() + self.unsupported_retry_secs
+            provider = str(self.w3.provider)
+            if provider not in self.warned:
+                self.warned.add(provider)
+                self.log("WARNING: the node does not support eth_estimateGas at a block ({}). Trade txes are sent "
+                         "with the default gas limit, and only checked with isTradeEligible().".format(unsupported[0]))
+            return
+        for j, response in zip(simulate, responses):
+            contract_address, _contract_state, txn = items[j]
+            if 'error' in response:
+                self.log("Trade tx of contract {} would fail: {}".format(contract_address, response['error'].get('message')))
+                dropped['reverted'] += 1
+                out[j] = None
+            else:
+                out[j] = dict(txn, gas = int(int(response['result'], 16) * self.gas_margin))
+
+    def _eligible(self, contract_addresses):
+        """Returns (block number, {contract_address: isTradeEligible() or None if the call failed})."""
+        calldata = lib.Multicall.encodeCall("isTradeEligible()")
+        block_number, results = self.multicall.aggregate([(a, calldata, ["bool"]) for a in contract_addresses])
+        return block_number, {a: r[0] if r is not None else None for a, r in zip(contract_addresses, results)}
+
+    def _describe(self, txn):
+        """Returns "<amount> <from synth> => <to synth>" for a trade txn."""
+        data = bytes.fromhex(txn['data'][2:])
+        key = lambda b: b.rstrip(b"\0").decode(errors = "replace")
+        return "{} {} => {}".format(int.from_bytes(data[36:68], "big"), key(data[4:36]), key(data[68:100]))
+
+    def _callParams(self, contract_address, contract_state, txn):
+        return {'from': contract_state['trader'], 'to': contract_address, 'data': txn['data'],
+                'value': web3.Web3.toHex(txn['value'])}
@@ -0,0 +1,227 @@
+import json, threading, time, sys, collections
+import lib.Utils, lib.Metrics
+
+INCLUDED = lib.Metrics.counter("txs_included_total", "Txes included in a block", ["status"])
+REPLACED = lib.Metrics.counter("txs_replaced_total", "Stuck txes replaced with a higher gas price")
+DROPPED = lib.Metrics.counter("txs_dropped_total", "Txes given up because their nonce was used by another tx")
+PENDING = lib.Metrics.gauge("txs_pending", "Txes broadcast and not yet included")
+INCLUSION_BLOCKS = lib.Metrics.histogram("tx_inclusion_blocks", "Blocks from the broadcast of a tx to its inclusion", [],
+                                         lib.Metrics.BLOCK_BUCKETS)
+INCLUSION_SECONDS = lib.Metrics.histogram("tx_inclusion_seconds", "Seconds from the broadcast of a tx to its inclusion", [],
+                                          (5, 15, 30, 60, 120, 300, 600, 1800, 3600))
+RECEIPT_CHECK_SECONDS = lib.Metrics.histogram("receipt_check_seconds", "Duration of one pass of the receipt checks")
+
+class ReceiptTracker():
+    """ Class to track broadcast transactions until they are included in a block.
+
+        The run method should be called (in its own thread) to start the tracking loop. The loop wakes up once
+        per new block and fetches the receipts of all of the outstanding transactions in one batch request.
+
+        A transaction that is still pending replace_after_blocks blocks after it was broadcast is replaced
+        by a transaction with the same nonce and a gas price bumped by gas_bump_pct, capped at the Synthetix
+        gasPriceLimit. Trade txes are sent at the node's gas price (see TradeExecutor.tradeGasPrice), so they
+        can be bumped up to the limit; a tx that can not be bumped by the nodes' minimum of 10% without exceeding
+        the limit is left as is (and logged once). The pending transactions are
+        indexed by (trader, nonce), so when any of the versions of a transaction is included the others are
+        dropped. If a replacement fails because the nonce was used ("nonce too low") and no version has a
+        receipt, the transaction is dropped.
+
+        Inclusion latencies (in blocks and seconds) are available from stats(). If a journal is given, the 
+        outcome of each transaction is recorded in it, and restore() resumes tracking after a restart.
+    """
+    # Nodes reject a replacement whose gas price is not at least this factor above the replaced tx's
+    MIN_REPLACEMENT_BUMP = 1.1
+
+    def __init__(self, w3, trade_executor, logger, replace_after_blocks = 20, gas_bump_pct = 12.5, poll_secs = 1,
+                 journal = None):
+        """
+        w3: A web3.Web3 instance
+        trade_executor: lib.TradeExecutor.TradeExecutor instance that broadcast the transactions
+        replace_after_blocks: number of blocks after which a pending transaction is replaced. 0 disables.
+        gas_bump_pct: gas price increase of a replacement, in percent. Nodes require at least 10%.
+        poll_secs: how often the block number is polled.
+        journal: optional lib.Journal.Journal
+        """
+        self.w3 = w3
+        self.te = trade_executor
+        self.log = logger
+        self.replace_after_blocks = replace_after_blocks
+        self.gas_bump_pct = gas_bump_pct
+        self.poll_secs = poll_secs
+        self.journal = journal
+
+        self.pending = {}        #tx_hash => entry dictionary
+        self.by_nonce = {}       #(trader, nonce) => set of tx_hashes
+        self.latencies = collections.deque(maxlen = 1000)   #(blocks, seconds) of included txes
+        self.block_number = None
+        self._lock = threading.Lock()
+        PENDING.setFunction(self.pendingCount)
+
+    def add(self, tx_hash, signal, broadcast_ts):
+        """Starts tracking a transaction broadcast by the trade executor."""
+        sent = self.te.popSentTransaction(tx_hash) or {}
+        entry = {'tx_hash': tx_hash, 'signal': signal, 'ts': broadcast_ts, 'block': self.block_number,
+                 'first_ts': broadcast_ts, 'first_block': self.block_number,
+                 'txn': sent.get('txn'), 'trader': sent.get('trader'), 'nonce': sent.get('nonce')}
+        with self._lock:
+            self._addEntry(entry)
+
+    def restore(self, txs):
+        """Resumes the tracking of the txes in flight, as returned by lib.Journal.Journal.recover()."""
+        with self._lock:
+            for tx in txs:
+                self._addEntry({'tx_hash': tx['tx_hash'], 'signal': None, 'ts': tx['ts'], 'block': None,
+                                'first_ts': tx['ts'], 'first_block': None,
+                                'txn': tx['txn'], 'trader': tx['trader'], 'nonce': tx['nonce']})
+    
+    def pendingCount(self):
+        with self._lock:
+            return len(self.pending)
+
+    def run(self):
+        last_stats_ts = time.time()
+        while 1:
+            try:
+                block_number = self.w3.eth.blockNumber
+                if block_number != self.block_number:
+                    self.block_number = block_number
+                    with RECEIPT_CHECK_SECONDS.time():
+                        self.checkReceipts(block_number)
+            except:
+                self.log("Error checking tx receipts. Msg: {}".format(sys.exc_info()[0]), level = "error")
+
+            if time.time() - last_stats_ts > 600:
+                self.log("Tx inclusion stats: {}".format(self.stats()))
+                last_stats_ts = time.time()
+            time.sleep(self.poll_secs)
+
+    def checkReceipts(self, block_number):
+        """Fetches the receipts of all the pending transactions and replaces the stuck ones."""
+        with self._lock:
+            entries = list(self.pending.values())
+        if not entries:
+            return
+
+        responses = lib.Utils.batchRequest(self.w3, [('eth_getTransactionReceipt', [e['tx_hash']]) for e in entries])
+        for entry, response in zip(entries, responses):
+            if entry['block'] is None:
+                entry['block'] = entry['first_block'] = block_number
+            r = response.get('result')
+            if r:
+                self._completed(entry, lib.Utils.formatReceipt(r), block_number)
+
+        if self.replace_after_blocks:
+            with self._lock:
+                stuck = [e for e in self.pending.values()
+                         if e['txn'] is not None and e['block'] + self.replace_after_blocks <= block_number
+                         and self._isLatest(e)]
+            for entry in stuck:
+                self._replace(entry, block_number)
+
+    def stats(self):
+        """Returns the inclusion latency statistics of the last included transactions."""
+        with self._lock:
+            latencies = list(self.latencies)
+            n_pending = len(self.pending)
+        if not latencies:
+            return {'count': 0, 'pending': n_pending}
+        blocks = sorted(l[0] for l in latencies)
+        secs = sorted(l[1] for l in latencies)
+        pct = lambda v, p: v[min(len(v) - 1, int(p * len(v)))]
+        return {'count': len(latencies), 'pending': n_pending,
+                'blocks_mean': sum(blocks) / float(len(blocks)), 'blocks_p50': pct(blocks, 0.5), 'blocks_p95': pct(blocks, 0.95),
+                'secs_mean': sum(secs) / len(secs), 'secs_p50': pct(secs, 0.5), 'secs_p95': pct(secs, 0.95)}
+
+    def _completed(self, entry, d, block_number):
+        if d['status'] == 1:
+            self.log("Success TX Included in Block: " + json.dumps(d))
+        else:
+            self.log("Failed TX Included in Block: " + json.dumps(d))
+
+        with self._lock:
+            #drop every version of the transaction (the original and its replacements)
+            for tx_hash in self.by_nonce.pop((entry['trader'], entry['nonce']), set([entry['tx_hash']])):
+                self.pending.pop(tx_hash, None)
+                if self.journal is not None and tx_hash != entry['tx_hash']:
+                    self.journal.txDone(tx_hash, 'replaced')
+            self.pending.pop(entry['tx_hash'], None)
+            if self.journal is not None:
+                self.journal.txDone(entry['tx_hash'], 'success' if d['status'] == 1 else 'failed', d['blockNumber'])
+            INCLUDED.inc(status = "success" if d['status'] == 1 else "failed")
+            if entry['first_block'] is not None:
+                self.latencies.append((d['blockNumber'] - entry['first_block'], time.time() - entry['first_ts']))
+                INCLUSION_BLOCKS.observe(d['blockNumber'] - entry['first_block'])
+                INCLUSION_SECONDS.observe(time.time() - entry['first_ts'])
+
+    def _replace(self, entry, block_number):
+        gas_price = entry['txn']['gasPrice']
+        try:
+            gas_price_limit = self.te.market.gasPriceLimit()
+        except:
+            self.log("Error reading the gas price limit. Msg: {}".format(sys.exc_info()[0]), level = "error")
+            return
+        new_gas_price = min(int(gas_price * (1 + self.gas_bump_pct / 100.)), gas_price_limit)
+        if new_gas_price < gas_price * self.MIN_REPLACEMENT_BUMP:
+            self._notBumped(entry, block_number, "its gas price {} is too close to the gas price limit {}".format(
+                gas_price, gas_price_limit))
+            return
+        try:
+            new_hash = self.te.resendTransaction(entry['txn'], entry['trader'], new_gas_price)
+        except:
+            error = sys.exc_info()[1]
+            if "nonce too low" in str(error).lower():
+                self.log("Error replacing stuck tx {}. Msg: {}".format(entry['tx_hash'], error), level = "error")
+                #the nonce was used, by a version of this tx (included in the meantime) or by another tx
+                self._nonceUsed(entry, block_number)
+            elif "replacement transaction underpriced" in str(error).lower():
+                self._notBumped(entry, block_number, "the node rejected the replacement as underpriced")
+            else:
+                self.log("Error replacing stuck tx {}. Msg: {}".format(entry['tx_hash'], error), level = "error")
+                entry['block'] = block_number
+            return
+
+        REPLACED.inc()
+        self.log("Replaced stuck tx {} (nonce {}) with tx {}. Gas price {} => {}".format(
+            entry['tx_hash'], entry['nonce'], new_hash, gas_price, new_gas_price))
+        new_entry = dict(entry, tx_hash = new_hash, block = block_number, ts = time.time(), not_bumped = False,
+                         txn = dict(entry['txn'], gasPrice = new_gas_price))
+        with self._lock:
+            self._addEntry(new_entry)
+
+    def _notBumped(self, entry, block_number, reason):
+        """Leaves a stuck tx that can not be replaced as is; it is checked again after replace_after_blocks blocks
+        (the gas price limit may have been raised). Logged once per tx."""
+        entry['block'] = block_number
+        if not entry.get('not_bumped'):
+            entry['not_bumped'] = True
+            self.log("Tx {} is stuck but can not be replaced: {}.".format(entry['tx_hash'], reason))
+
+    def _nonceUsed(self, entry, block_number):
+        """Completes the tx with the receipt of whichever of its versions was included, or drops all of its
+        versions if none has a receipt."""
+        with self._lock:
+            versions = [self.pending[h] for h in self.by_nonce.get((entry['trader'], entry['nonce']), ()) if h in self.pending]
+        responses = lib.Utils.batchRequest(self.w3, [('eth_getTransactionReceipt', [v['tx_hash']]) for v in versions])
+        for version, response in zip(versions, responses):
+            if response.get('result'):
+                self._completed(version, lib.Utils.formatReceipt(response['result']), block_number)
+                return
+        self.log("Dropping tx {} (nonce {} of {}): the nonce was used by another tx".format(
+            entry['tx_hash'], entry['nonce'], entry['trader']))
+        DROPPED.inc()
+        with self._lock:
+            for tx_hash in self.by_nonce.pop((entry['trader'], entry['nonce']), set([entry['tx_hash']])):
+                self.pending.pop(tx_hash, None)
+                if self.journal is not None:
+                    self.journal.txDone(tx_hash, 'dropped')
+            self.pending.pop(entry['tx_hash'], None)
+
+    def _addEntry(self, entry):
+        self.pending[entry['tx_hash']] = entry
+        if entry['trader'] is not None:
+            self.by_nonce.setdefault((entry['trader'], entry['nonce']), set()).add(entry['tx_hash'])
+
+    def _isLatest(self, entry):
+        """True if the entry is the highest priced version of its transaction."""
+        versions = [self.pending[h] for h in self.by_nonce.get((entry['trader'], entry['nonce']), ()) if h in self.pending]
+        return all(v['txn']['gasPrice'] <= entry['txn']['gasPrice'] for v in versions)
@@ -0,0 +1,304 @@
+"""Sharded deployment of the signal server: a router process and N worker processes.
+
+The router (signal_router.py) receives, validates, de-duplicates and schedules the signals like the single
+process server. When a signal is due, it is published to the workers on a PUB socket. Each worker
+(trade_signal_server.py --worker N) executes the signal on its slice of the matching contracts: the contracts
+whose trader address belongs to the worker on a consistent hash ring of the live workers. All of the txes of
+a trader are sent by one worker, so its nonces are allocated in one place.
+
+Workers send a heartbeat with their health to the router every SHARD_HEARTBEAT_SECS. A worker is live from
+its first heartbeat until it misses SHARD_TIMEOUT_SECS of them. Whenever the live set changes, the router
+publishes the new membership and the workers rebuild the ring, which moves about 1/N of the traders.
+
+Each published signal is stamped with the membership it was published under ("shard": {"epoch", "workers"}),
+and every worker decides which traders it owns on the ring of that membership, not on its current one. So
+during a membership change all of the workers split the traders of a signal the same way, and no trader is
+traded by two workers. When a worker is expired, the signals published to it within SHARD_TIMEOUT_SECS before
+its last heartbeat are published again as takeovers ("takeover": {"worker", "workers"}): each live worker
+executes them on the traders it owns that belonged to the expired worker. A worker that was only slow may have
+executed them in part; the repeated trades of contracts with a minMinsBtwTrades are then dropped by the preflight
+check of isTradeEligible() (see lib/Preflight.py).
+
+Messages on the PUB socket are [topic, json]: b"signal" (a trade signal) or b"members"
+({"epoch", "workers"}; the epoch increases with each change). Heartbeats are json ({"worker", "ts", "epoch", ...health}).
+"""
+import json, threading, time, sys, collections
+import lib.HashRing, lib.Metrics, lib.Journal
+
+WORKERS = lib.Metrics.gauge("shard_workers_live", "Shard workers with a recent heartbeat")
+WORKER_HEALTH = lib.Metrics.gauge("shard_worker_health", "Values reported in the heartbeats of the shard workers",
+                                  ["worker", "key"])
+MEMBERSHIP_CHANGES = lib.Metrics.counter("shard_membership_changes_total", "Shard workers that joined or left", ["event"])
+PUBLISHED = lib.Metrics.counter("shard_signals_published_total", "Signals published to the shard workers")
+TAKEOVERS = lib.Metrics.counter("shard_signal_takeovers_total", "Signals published again for the traders of an expired worker")
+
+TOPIC_SIGNAL = b"signal"
+TOPIC_MEMBERS = b"members"
+
+
+def workerFile(fn, worker_id):
+    """Returns the name of a worker's copy of a state file: "journal.db" => "journal.w1.db"."""
+    if not fn:
+        return fn
+    base, dot, ext = fn.rpartition(".")
+    if not dot:
+        return "{}.{}".format(fn, worker_id)
+    return "{}.{}.{}".format(base, worker_id, ext)
+
+
+class ShardRouter():
+    """ Router side: publishes the signals to the workers and tracks the live workers from their heartbeats.
+
+        Signals published while no worker is live are held and published when a worker joins. The signals
+        published in the last few SHARD_TIMEOUT_SECS are kept, so that they can be published again as takeovers
+        when a worker is expired.
+    """
+    def __init__(self, pub_socket, heartbeat_socket, logger, heartbeat_secs = 1, timeout_secs = 5):
+        """
+        pub_socket: zmq address the signals and the membership are published on, e.g. "tcp://*:6239"
+        heartbeat_socket: zmq address the heartbeats are received on, e.g. "tcp://*:6240"
+        """
+        import zmq
+        self.log = logger
+        self.heartbeat_secs = heartbeat_secs
+        self.timeout = timeout_secs
+        context = zmq.Context.instance()
+        self.pub = context.socket(zmq.PUB)
+        self.pub.bind(pub_socket)
+        self.heartbeats = context.socket(zmq.PULL)
+        self.heartbeats.bind(heartbeat_socket)
+
+        self.workers = {}   #worker id => last heartbeat
+        self.epoch = int(time.time())   #membership version; keeps increasing across restarts of the router
+        self.held = []      #signals published while no worker was live
+        self.published = collections.deque()   #(timestamp, signal, workers) of the recently published signals
+        self._lock = threading.Lock()   #the PUB socket is used by the caller's thread and by run()
+        WORKERS.setFunction(lambda: len(self.workers))
+
+    def publish(self, signal):
+        """Publishes a due signal to the workers."""
+        with self._lock:
+            if not self.workers:
+                self.log("No live shard workers. Holding signal {} until a worker joins.".format(signal['name']))
+                self.held.append(signal)
+                return
+            self._publish(signal)
+
+    def members(self):
+        with self._lock:
+            return sorted(self.workers)
+
+    def run(self):
+        """Receives the heartbeats, expires the silent workers and re-publishes the membership periodically
+        (for workers that missed a change)."""
+        import zmq
+        poller = zmq.Poller()
+        poller.register(self.heartbeats, zmq.POLLIN)
+        last_announce = 0
+        while True:
+            try:
+                if poller.poll(self.heartbeat_secs * 1000):
+                    while True:
+                        try:
+                            self._heartbeat(json.loads(self.heartbeats.recv(zmq.NOBLOCK)))
+                        except zmq.Again:
+                            break
+                self._expire()
+                if time.time() - last_announce >= self.heartbeat_secs:
+                    with self._lock:
+                        self._announce()
+                    last_announce = time.time()
+            except:
+                self.log("Error in the shard router. Msg: {}".format(sys.exc_info()[1]), level = "error")
+
+    def _heartbeat(self, hb):
+        worker = hb['worker']
+        with self._lock:
+            joined = worker not in self.workers
+            self.workers[worker] = time.time()
+            if joined:
+                self.log("Shard worker joined: {}. Live workers: {}".format(worker, sorted(self.workers)))
+                MEMBERSHIP_CHANGES.inc(event = "joined")
+                self.epoch = max(self.epoch + 1, int(time.time()))
+                self._announce()
+                held, self.held = self.held, []
+                for signal in held:
+                    self._publish(signal)
+        for key, value in hb.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and key != 'ts':
+                WORKER_HEALTH.set(value, worker = worker, key = key)
+        if not joined and hb.get('epoch', self.epoch) < self.epoch - 1:
+            self.log("Shard worker {} is behind on the membership (epoch {} < {})".format(worker, hb.get('epoch'), self.epoch))
+
+    def _expire(self):
+        with self._lock:
+            now = time.time()
+            dead = {w: ts for w, ts in self.workers.items() if now - ts > self.timeout}
+            for worker in dead:
+                del self.workers[worker]
+                self.log("Shard worker left (no heartbeat for {}s): {}. Live workers: {}".format(
+                    self.timeout, worker, sorted(self.workers)))
+                MEMBERSHIP_CHANGES.inc(event = "left")
+            if dead:
+                self.epoch = max(self.epoch + 1, int(time.time()))
+                self._announce()
+                self._takeOver(dead)
+
+    def _takeOver(self, dead):
+        """Publishes again the signals that the dead workers ({worker: last heartbeat}) may not have executed
+        (with self._lock held)."""
+        for ts, signal, workers in list(self.published):
+            for worker, last_heartbeat in sorted(dead.items()):
+                if worker not in workers or ts < last_heartbeat - self.timeout:
+                    continue
+                TAKEOVERS.inc()
+                if not self.workers:
+                    #the next worker to join owns all of the traders, so it executes the whole signal
+                    self.log("No live shard workers. Holding signal {} of worker {} until a worker joins.".format(
+                        signal['name'], worker))
+                    if not any(held is signal for held in self.held):
+                        self.held.append(signal)
+                    continue
+                self.log("Publishing signal {} again for the traders of worker {}".format(signal['name'], worker))
+                #the takeover is a separate signal in the journals of the workers
+                key = "{}#{}@{}".format(signal.get(lib.Journal.Journal.KEY) or signal.get('id') or ts, worker, self.epoch)
+                takeover = dict(signal, **{lib.Journal.Journal.KEY: key})
+                self._publish(takeover, {'worker': worker, 'workers': workers})
+
+    def _publish(self, signal, takeover = None):
+        """Publishes the signal stamped with the current membership (with self._lock held)."""
+        shard = {'epoch': self.epoch, 'workers': sorted(self.workers)}
+        if takeover is not None:
+            shard['takeover'] = takeover
+        self._send(TOPIC_SIGNAL, dict(signal, shard = shard))
+        PUBLISHED.inc()
+        now = time.time()
+        if takeover is None:
+            self.published.append((now, signal, shard['workers']))
+        #a worker is expired at most 2 timeouts after the signals it may have missed were published
+        while self.published and self.published[0][0] < now - 3 * self.timeout:
+            self.published.popleft()
+
+    def _announce(self):
+        self._send(TOPIC_MEMBERS, {'epoch': self.epoch, 'workers': sorted(self.workers)})
+
+    def _send(self, topic, value):
+        self.pub.send_multipart([topic, json.dumps(value).encode()])
+
+
+class ShardWorker():
+    """ Worker side: receives the signals and the membership from the router and sends heartbeats.
+
+        Received signals are scheduled on the worker's SignalManager (the router has already validated and
+        de-duplicated them). owned() keeps the matches whose trader belongs to this worker.
+    """
+    def __init__(self, worker_id, sub_socket, heartbeat_socket, signal_manager, logger, health = None,
+                 on_rebalance = None, heartbeat_secs = 1, vnodes = 100):
+        """
+        sub_socket: zmq address of the router's PUB socket, e.g. "tcp://127.0.0.1:6239"
+        heartbeat_socket: zmq address of the router's heartbeat socket, e.g. "tcp://127.0.0.1:6240"
+        health: optional function returning a dictionary of values sent with each heartbeat.
+        on_rebalance: optional function(old ring, new ring) called when the live workers changed.
+        """
+        self.id = worker_id
+        self.sub_socket = sub_socket
+        self.heartbeat_socket = heartbeat_socket
+        self.sm = signal_manager
+        self.log = logger
+        self.health = health
+        self.on_rebalance = on_rebalance
+        self.heartbeat_secs = heartbeat_secs
+        self.vnodes = vnodes
+        self.ring = lib.HashRing.HashRing(vnodes = vnodes)
+        self.rings = {}   #tuple of the workers => ring, see _ring()
+        self.epoch = -1
+        self.joined = threading.Event()   #set when the router lists this worker as live
+
+    def owns(self, trader_address):
+        return self.ring.node(trader_address) == self.id
+
+    def owned(self, signal, matches):
+        """Returns the matches owned by this worker on the ring of the membership the signal was published
+        under. For a takeover, only the traders of the expired worker are owned.
+
+        matches: list of (contract_address, contract_state)"""
+        shard = signal.get('shard')
+        if shard is None:
+            ring = self.ring
+        else:
+            if shard['epoch'] > self.epoch:
+                #the membership message has not arrived yet
+                self._membership(shard)
+            ring = self._ring(shard['workers'])
+        owned = [m for m in matches if ring.node(m[1]['trader']) == self.id]
+        takeover = shard.get('takeover') if shard is not None else None
+        if takeover is not None:
+            previous = self._ring(takeover['workers'])
+            owned = [m for m in owned if previous.node(m[1]['trader']) == takeover['worker']]
+        return owned
+
+    def _ring(self, workers):
+        """Returns the ring of the workers (the rings of the recent memberships are cached)."""
+        key = tuple(sorted(workers))
+        ring = self.rings.get(key)
+        if ring is None:
+            if len(self.rings) > 10:
+                self.rings.clear()
+            ring = self.rings[key] = lib.HashRing.HashRing(workers, self.vnodes)
+        return ring
+
+    def run(self):
+        import zmq
+        context = zmq.Context.instance()
+        sub = context.socket(zmq.SUB)
+        sub.connect(self.sub_socket)
+        sub.setsockopt(zmq.SUBSCRIBE, TOPIC_SIGNAL)
+        sub.setsockopt(zmq.SUBSCRIBE, TOPIC_MEMBERS)
+        heartbeats = context.socket(zmq.PUSH)
+        heartbeats.setsockopt(zmq.SNDHWM, 10)
+        heartbeats.connect(self.heartbeat_socket)
+
+        poller = zmq.Poller()
+        poller.register(sub, zmq.POLLIN)
+        last_heartbeat = 0
+        while True:
+            try:
+                if time.time() - last_heartbeat >= self.heartbeat_secs:
+                    heartbeats.send(json.dumps(self._heartbeat()).encode(), zmq.NOBLOCK)
+                    last_heartbeat = time.time()
+                if poller.poll(self.heartbeat_secs * 1000):
+                    topic, message = sub.recv_multipart()
+                    if topic == TOPIC_MEMBERS:
+                        self._membership(json.loads(message))
+                    elif topic == TOPIC_SIGNAL:
+                        signal = json.loads(message)
+                        #the router coalesced the signals; a takeover has the content of an earlier signal
+                        if not self.sm.addSignal(signal, coalesce = False):
+                            self.log("Signal from the router was not scheduled: {}".format(signal))
+            except zmq.Again:
+                pass    #the router is not reachable; the heartbeat is dropped
+            except:
+                self.log("Error in the shard worker. Msg: {}".format(sys.exc_info()[1]), level = "error")
+
+    def _heartbeat(self):
+        hb = {'worker': self.id, 'ts': time.time(), 'epoch': self.epoch}
+        if self.health is not None:
+            try:
+                hb.update(self.health())
+            except:
+                self.log("Error reading the health of the shard worker. Msg: {}".format(sys.exc_info()[1]),
+                         level = "error")
+        return hb
+
+    def _membership(self, members):
+        if members['epoch'] < self.epoch or (members['epoch'] == self.epoch and set(members['workers']) == self.ring.nodes):
+            return
+        ring = self._ring(members['workers'])
+        old, self.ring = self.ring, ring
+        self.epoch = members['epoch']
+        if self.id in ring.nodes:
+            self.joined.set()
+        if old.nodes != ring.nodes:
+            self.log("Shard membership changed (epoch {}): {}".format(self.epoch, members['workers']))
+            if self.on_rebalance is not None:
+                self.on_rebalance(old, ring)
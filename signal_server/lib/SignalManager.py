@@ -1,58 +1,312 @@
-import time, json, threading
+import time, json, threading, heapq, itertools, collections, hashlib, sys
 import dateutil.parser, pytz, datetime, os.path
+import lib.SignalSchema, lib.Metrics
+
+SIGNALS = lib.Metrics.counter("signals_total", "Trade signals by outcome", ["status"])
+PENDING = lib.Metrics.gauge("signals_pending", "Trade signals scheduled and not yet triggered")
+ZMQ_BATCH = lib.Metrics.histogram("zmq_recv_batch_size", "Messages read from a zmq socket in one pass", [],
+                                  lib.Metrics.SIZE_BUCKETS)
+COALESCED = lib.Metrics.counter("signals_coalesced_total",
+                                "Signals dropped because an identical signal was received within the coalescing window",
+                                ["name"])
+TRIGGER_LAG = lib.Metrics.histogram("signal_trigger_lag_seconds", "Delay between a signal's execution time and its trigger")
 
 class SignalManager():
-    """ Class to manage and provide the reading of trade signals."""
-    def __init__(self, cfg, logger):
-        self.signals = []  #list of pending trade signals
+    """ Class to manage and provide the reading of trade signals.
+
+        Pending signals are kept in a min-heap keyed on their execution time (a UTC timestamp that is parsed
+        once, when the signal is received). waitForSignals() wakes up at the exact time the next signal is
+        due, or as soon as a "NOW" signal is added.
+        
+        Signals are received on a zmq PULL socket and, optionally, on a ROUTER socket that acknowledges each 
+        signal back to the sender. The sockets are drained in batches and each signal is validated against 
+        the schema of its type (lib.SignalSchema). At most MAX_PENDING_SIGNALS signals are pending; when 
+        full, the sockets are not read until signals are taken out (backpressure to the senders).
+        
+        Signals may carry an "id" field. A signal with the id of a recently received signal is dropped as
+        a duplicate.
+        
+        Signals are also coalesced by content: a signal with the same name, type and params as a signal
+        received less than SIGNAL_COALESCE_SECS earlier is dropped (whatever its id and execution time), so
+        copies pushed by several generators, or re-sent by a flapping generator, are executed once.
         
-        if cfg.zmqPullSocket:
+        If a journal (lib.Journal.Journal) is given, the scheduled signals and their status are recorded in
+        it, and restore() re-schedules the signals that were pending before a restart.
+    """
+    # Number of recent signal ids remembered for duplicate detection
+    RECENT_IDS = 10000
+    # _schedule result of a signal that was coalesced with a recent identical signal
+    COALESCED = "coalesced with an identical signal received within the coalescing window"
+    
+    def __init__(self, cfg, logger, journal = None, sockets = True):
+        """
+        sockets: bind the zmq sockets of cfg. A shard worker (lib.Sharding.ShardWorker) receives its signals
+                 from the router instead.
+        """
+        self.log = logger
+        self.journal = journal
+        self.signals = []  #heap of pending trade signals: (execution timestamp, sequence number, signal)
+        self.cond = threading.Condition()
+        self._seq = itertools.count()
+        self.max_behind_mins = cfg.MAX_MINS_BEHIND
+        self.max_pending = cfg.MAX_PENDING_SIGNALS
+        self.recv_batch = cfg.ZMQ_RECV_BATCH
+        self.recent_ids = collections.OrderedDict()
+        self.coalesce_window = cfg.SIGNAL_COALESCE_SECS
+        self.recent_keys = collections.OrderedDict()   #coalescing key => receive timestamp, oldest first
+        PENDING.setFunction(self.pendingCount)
+
+        self.receiver = None; self.router = None
+        if sockets and (cfg.zmqPullSocket or cfg.zmqRouterSocket):
             import zmq
             context = zmq.Context()
-            self.receiver = context.socket(zmq.PULL)
-            self.receiver.bind(cfg.zmqPullSocket) 
-            
+            if cfg.zmqPullSocket:
+                self.receiver = context.socket(zmq.PULL)
+                self.receiver.bind(cfg.zmqPullSocket)
+            if cfg.zmqRouterSocket:
+                self.router = context.socket(zmq.ROUTER)
+                self.router.bind(cfg.zmqRouterSocket)
+
             t = threading.Thread(target=self._zmqReceive) #start thread to receive zmq signals
-            t.start()   
-        else:
+            t.start()
+        elif sockets:
             self.log("zmq socket was not configured. Signals will not be received by the trade_signal_server.")
+
+    def addSignal(self, signal, block = True, coalesce = True):
+        """Validates and schedules a trade signal. Signals whose execution time is more than max_behind_mins
+        in the past are rejected.
         
-        self.log = logger
+        block: if the pending signals are full, wait until there is room. Otherwise the signal is rejected.
+        coalesce: drop the signal if an identical signal was received within the coalescing window.
+
+        Returns: True if the signal was scheduled."""
+        return self._schedule(signal, block, coalesce) is None
+    
+    def _schedule(self, signal, block, coalesce = True):
+        """Returns: None if the signal was scheduled, or the reason it was rejected."""
+        err = lib.SignalSchema.validate(signal)
+        if err:
+            self.log("Invalid trade signal: {}. {}".format(err, signal))
+            SIGNALS.inc(status = "rejected")
+            return err
+        try:
+            deadline = self._executionTimestamp(signal)
+        except (ValueError, OverflowError):
+            self.log("Trade signal execution time could not be parsed. {}".format(signal))
+            SIGNALS.inc(status = "rejected")
+            return "execution_time could not be parsed"
+        if deadline < time.time() - 60 * self.max_behind_mins:
+            self.log("Trade signal execution time is too far in the past. {}".format(signal))
+            SIGNALS.inc(status = "rejected")
+            return "execution_time is too far in the past"
+        signal.setdefault('received_ts', time.time())   #for the receive-to-broadcast latency
+
+        with self.cond:
+            if coalesce and not self._coalesce(signal):
+                self.log("Trade signal coalesced with an identical recent signal: {}".format(signal))
+                SIGNALS.inc(status = "coalesced")
+                COALESCED.inc(name = signal['name'])
+                return self.COALESCED
+            if len(self.signals) >= self.max_pending:
+                if not block:
+                    SIGNALS.inc(status = "rejected")
+                    return "too many pending signals"
+                self.log("Pending signals are full ({}). Waiting.".format(len(self.signals)))
+                while len(self.signals) >= self.max_pending:
+                    self.cond.wait()
+            heapq.heappush(self.signals, (deadline, next(self._seq), signal))
+            if self.journal is not None:
+                self.journal.signalAdded(signal)
+            self.cond.notify_all()
+        SIGNALS.inc(status = "scheduled")
+        return None
+    
+    def restore(self, recovered):
+        """Re-schedules the pending signals and remembers the ids of the recent signals.
         
+        recovered: the dictionary returned by lib.Journal.Journal.recover()"""
+        with self.cond:
+            for signal_id in recovered['ids']:
+                self.recent_ids[signal_id] = True
+            while len(self.recent_ids) > self.RECENT_IDS:
+                self.recent_ids.popitem(last = False)
+            for signal in recovered['pending']:
+                try:
+                    deadline = self._executionTimestamp(signal)
+                except (ValueError, OverflowError):
+                    continue
+                heapq.heappush(self.signals, (deadline, next(self._seq), signal))
+                self._coalesce(signal)
+            self.cond.notify_all()
+
+    def waitForSignals(self, timeout):
+        """Blocks until a signal is due or until timeout seconds have passed."""
+        end = time.time() + timeout
+        with self.cond:
+            while True:
+                now = time.time()
+                if self.signals and self.signals[0][0] <= now:
+                    return
+                wait = end - now
+                if self.signals:
+                    wait = min(wait, self.signals[0][0] - now)
+                if wait <= 0:
+                    return
+                self.cond.wait(wait)
+
     def triggeredSignals(self, max_behind_mins):
-        """Returns a list of signals that have been triggered based on the execution_time field. Triggered 
+        """Returns a list of signals that have been triggered based on the execution_time field. Triggered
         signals are removed from self.signals.
-        
-        max_behind_mins: if the scheduled execution time for a signal is more than this number of minutes in the 
+
+        max_behind_mins: if the scheduled execution time for a signal is more than this number of minutes in the
                          past, the signal is not executed.
         """
-        triggered = []; errors = []; _signals = []
-        for s in self.signals:
-            if s['execution_time'] == "NOW" or s['execution_time'] == "":
-                triggered.append(s)
-            else:
-                signal_dt = dateutil.parser.parse(s['execution_time'])
-                if datetime.datetime.now(pytz.timezone("utc")) - datetime.timedelta(minutes = max_behind_mins) > signal_dt:
+        triggered = []; errors = []
+        now = time.time()
+        with self.cond:
+            while self.signals and self.signals[0][0] <= now:
+                deadline, _seq, s = heapq.heappop(self.signals)
+                TRIGGER_LAG.observe(now - deadline)
+                if deadline < now - 60 * max_behind_mins:
                     self.log("Trade signal execution time is too far in the past. {}".format(s))
+                    SIGNALS.inc(status = "expired")
                     errors.append(s)
-                elif datetime.datetime.now(pytz.timezone("utc")) > signal_dt:
-                    triggered.append(s)
+                    if self.journal is not None:
+                        self.journal.signalStatus(s, "expired")
                 else:
-                    _signals.append(s)
-        self.signals = _signals
+                    SIGNALS.inc(status = "triggered")
+                    triggered.append(s)
+                    if self.journal is not None:
+                        self.journal.signalStatus(s, "executing")
+            if triggered or errors:
+                self.cond.notify_all()   #room for blocked senders
         return triggered, errors
-        
+
+    def coalesceKey(self, signal):
+        """Returns the (name, type, hash of params) key under which identical signals are coalesced."""
+        params = json.dumps(signal.get('params'), sort_keys = True, separators = (",", ":"))
+        return (signal['name'], signal['type'], hashlib.sha1(params.encode()).hexdigest())
+
+    def _coalesce(self, signal):
+        """Records the signal's coalescing key (with self.cond held).
+
+        Returns: False if an identical signal was received within the coalescing window."""
+        if not self.coalesce_window:
+            return True
+        received = signal.get('received_ts', time.time())
+        while self.recent_keys:
+            key, ts = next(iter(self.recent_keys.items()))
+            if ts > received - self.coalesce_window:
+                break
+            del self.recent_keys[key]
+        key = self.coalesceKey(signal)
+        if key in self.recent_keys:
+            return False
+        self.recent_keys[key] = received
+        return True
+
+    def pendingCount(self):
+        with self.cond:
+            return len(self.signals)
+
+    def isExpired(self, signal, max_behind_mins):
+        """True if the execution time of the signal (its receipt time for "NOW" signals) is more than
+        max_behind_mins minutes in the past, e.g. for a signal whose fan-out is resumed after a restart."""
+        if signal['execution_time'] == "NOW" or signal['execution_time'] == "":
+            deadline = signal.get('received_ts', time.time())
+        else:
+            try:
+                deadline = self._executionTimestamp(signal)
+            except (ValueError, OverflowError):
+                return True
+        return deadline < time.time() - 60 * max_behind_mins
+    
+    def _executionTimestamp(self, signal):
+        """Returns the execution time of the signal as a UTC timestamp ("NOW" and "" are due immediately)."""
+        if signal['execution_time'] == "NOW" or signal['execution_time'] == "":
+            return time.time()
+        signal_dt = dateutil.parser.parse(signal['execution_time'])
+        if signal_dt.tzinfo is None:
+            signal_dt = pytz.timezone("utc").localize(signal_dt)
+        return signal_dt.timestamp()
+
     def _zmqReceive(self):
+        import zmq
+        poller = zmq.Poller()
+        for socket in (self.receiver, self.router):
+            if socket is not None:
+                poller.register(socket, zmq.POLLIN)
         while 1:
-            s = self.receiver.recv()
-            signal = json.loads(s)
-            if 'execution_time' in signal and 'params' in signal and \
-            'name' in signal and 'type' in signal:    #check valid signal
-                self.signals.append(signal)
-            else:
-                self.log("Invalid trade signal received via zmq")
-            time.sleep(1)
-        
+            ready = dict(poller.poll())
+            if self.receiver in ready:
+                for frames in self._drain(self.receiver):
+                    try:
+                        self._ingest(frames[-1])
+                    except:
+                        self.log("Error receiving a trade signal via zmq. Msg: {}".format(sys.exc_info()[1]),
+                                 level = "error")
+            if self.router in ready:
+                for frames in self._drain(self.router):
+                    #frames are [identity, (empty delimiter,) signal]. The ack is sent back on the same envelope.
+                    try:
+                        status = self._ingest(frames[-1])
+                    except:
+                        self.log("Error receiving a trade signal via zmq. Msg: {}".format(sys.exc_info()[1]),
+                                 level = "error")
+                        status = {'id': None, 'status': 'rejected', 'error': 'internal error'}
+                    self.router.send_multipart(frames[:-1] + [json.dumps(status).encode()])
+    
+    def _drain(self, socket):
+        """Returns up to recv_batch messages (lists of frames) that are waiting on the socket."""
+        import zmq
+        messages = []
+        while len(messages) < self.recv_batch:
+            try:
+                messages.append(socket.recv_multipart(zmq.NOBLOCK))
+            except zmq.Again:
+                break
+        ZMQ_BATCH.observe(len(messages))
+        return messages
     
+    def _ingest(self, message):
+        """Parses, de-duplicates and schedules a received signal.
+        
+        Returns: the acknowledgement, {"id": .., "status": "accepted" | "duplicate" | "rejected", "error": ..}"""
+        try:
+            signal = json.loads(message)
+        except ValueError:
+            self.log("Invalid trade signal received via zmq")
+            SIGNALS.inc(status = "rejected")
+            return {'id': None, 'status': 'rejected', 'error': 'signal is not valid json'}
+        err = lib.SignalSchema.validateId(signal)
+        if err:
+            self.log("Invalid trade signal received via zmq: {}".format(err))
+            SIGNALS.inc(status = "rejected")
+            return {'id': None, 'status': 'rejected', 'error': err}
+        signal_id = signal.get('id') if isinstance(signal, dict) else None
+        
+        if signal_id is not None:
+            with self.cond:   #recent_ids is also filled by restore() on the main thread
+                duplicate = signal_id in self.recent_ids
+                if not duplicate:
+                    self.recent_ids[signal_id] = True
+                    if len(self.recent_ids) > self.RECENT_IDS:
+                        self.recent_ids.popitem(last = False)
+            if duplicate:
+                self.log("Duplicate trade signal received via zmq: {}".format(signal_id))
+                SIGNALS.inc(status = "duplicate")
+                return {'id': signal_id, 'status': 'duplicate', 'error': None}
+        
+        err = self._schedule(signal, True) if isinstance(signal, dict) else "signal must be an object"
+        if err == self.COALESCED:
+            return {'id': signal_id, 'status': 'duplicate', 'error': err}
+        if err:
+            if signal_id is not None:
+                with self.cond:   #a corrected signal may be sent again with the same id
+                    self.recent_ids.pop(signal_id, None)
+            return {'id': signal_id, 'status': 'rejected', 'error': err}
+        return {'id': signal_id, 'status': 'accepted', 'error': None}
+
+
 if __name__ == "__main__":
     pass
\ No newline at end of file
@@ -0,0 +1,96 @@
+"""Validation of trade signals (see trade_signal_format.md).
+
+The schema of each signal type is compiled once, at import, into a validator function. validate() returns
+an error message, or None if the signal is valid.
+"""
+import math
+
+NUMBER = (int, float)
+
+# Fields that all signals must have
+COMMON_SCHEMA = {'type': str, 'name': str, 'execution_time': str, 'params': dict}
+
+# Fields that signals may have, checked if present
+OPTIONAL_SCHEMA = {'id': (str, int)}
+
+# Schema of the params field of each signal type. A list holds the schema of its elements.
+PARAMS_SCHEMAS = {
+    'type1': {'trades': [{'from': str, 'to': str, 'percent': NUMBER}]},
+    'type2': {'synths': [str], 'weights': [NUMBER]},
+    'type3': {'pairs': [[str]]},
+}
+
+# Additional checks on the params of each signal type: list of (check function, error message)
+PARAMS_CHECKS = {
+    'type1': [(lambda p: all(0 <= t['percent'] <= 100 for t in p['trades']), "percent must be between 0 and 100")],
+    'type2': [(lambda p: len(p['synths']) == len(p['weights']), "synths and weights must have the same length"),
+              (lambda p: all(math.isfinite(w) and w >= 0 for w in p['weights']), "weights must be finite and not negative"),
+              (lambda p: len(p['synths']) > 0 and sum(p['weights']) > 0, "weights must sum to more than zero")],
+    'type3': [(lambda p: all(len(pair) == 2 for pair in p['pairs']), "each pair must have two synths"),
+              (lambda p: all(pair[0] != pair[1] for pair in p['pairs']), "the synths of a pair must differ")],
+}
+
+
+def _compile(schema, path):
+    """Returns a function(value) that returns an error message for the value, or None."""
+    if isinstance(schema, dict):
+        fields = [(key, _compile(sub, path + "." + key)) for key, sub in schema.items()]
+        def check(value):
+            if not isinstance(value, dict):
+                return "{} must be an object".format(path)
+            for key, check_field in fields:
+                if key not in value:
+                    return "{}.{} is missing".format(path, key)
+                err = check_field(value[key])
+                if err:
+                    return err
+            return None
+    elif isinstance(schema, list):
+        check_element = _compile(schema[0], path + "[]")
+        def check(value):
+            if not isinstance(value, list):
+                return "{} must be an array".format(path)
+            for v in value:
+                err = check_element(v)
+                if err:
+                    return err
+            return None
+    else:
+        def check(value):
+            if not isinstance(value, schema) or isinstance(value, bool):
+                return "{} has the wrong type".format(path)
+            return None
+    return check
+
+
+_check_common = _compile(COMMON_SCHEMA, "signal")
+_check_optional = {key: _compile(schema, "signal." + key) for key, schema in OPTIONAL_SCHEMA.items()}
+_check_params = {t: _compile(schema, "params") for t, schema in PARAMS_SCHEMAS.items()}
+
+
+def validateId(signal):
+    """Returns an error message if the signal has an id that is not a string or an integer, or None."""
+    if isinstance(signal, dict) and signal.get('id') is not None:
+        return _check_optional['id'](signal['id'])
+    return None
+
+
+def validate(signal):
+    """Returns an error message describing why the signal is invalid, or None if it is valid."""
+    err = _check_common(signal)
+    if err:
+        return err
+    for key, check in _check_optional.items():
+        if signal.get(key) is not None:
+            err = check(signal[key])
+            if err:
+                return err
+    if signal['type'] not in _check_params:
+        return "unknown signal type: {}".format(signal['type'])
+    err = _check_params[signal['type']](signal['params'])
+    if err:
+        return err
+    for check, msg in PARAMS_CHECKS[signal['type']]:
+        if not check(signal['params']):
+            return msg
+    return None
@@ -1,29 +1,52 @@
-import web3, json, time
+import web3, json, time, sys, threading
+import lib.NonceManager, lib.Multicall, lib.MarketDataCache, lib.Utils, lib.Metrics, lib.ContractRegistry, lib.Type2Engine
+
+EXECUTE_SECONDS = lib.Metrics.histogram("trade_execute_seconds", "Duration of executeOne for an eligible contract", ["type"])
+SKIPPED = lib.Metrics.counter("trade_skipped_total", "Contracts skipped by executeOne", ["reason"])
+SEND_SECONDS = lib.Metrics.histogram("tx_send_seconds", "Duration of building, signing and broadcasting a trade tx")
+TXS_SENT = lib.Metrics.counter("txs_sent_total", "Trade txes broadcast", ["kind"])
 
 class TradeExecutor():
     """ Class to submit synthetix.exchange txes to the blockchain. 
     
     """    
-    def __init__(self, w3, synthetix_contract_address, signing_accounts, network, min_fee_rate, logger):
+    def __init__(self, w3, synthetix_contract_address, signing_accounts, network, min_fee_rate, logger,
+                 multicall_address = None, batch_size = 300, journal = None, registry = None, type2_dust_usd = 10):
         """
         w3: A web3.Web3 instance 
         synthetix_contract_address: address of the synthetix contract
         signing_accounts: dictionary of address=> private key that are to be used when signing exchange transactions 
         network: "mainnet" or "kovan"
+        multicall_address: address of the Multicall contract used by getBalancesBulk. If None, each 
+                           balance is read with a separate eth_call.
+        batch_size: the number of calls aggregated into a single eth_call.
+        journal: optional lib.Journal.Journal in which the broadcast transactions are recorded.
+        registry: lib.ContractRegistry.ContractRegistry shared with the ContractMonitor. A new one is created
+                  if None.
+        type2_dust_usd: type2 rebalancing trades worth less than this (in sUSD) are not made.
         """
         self.w3 = w3
-        self.abi = json.load(open("../contracts/abi.json", "r"))
-        self.synth_abi = json.load(open("./abis/synth_abi.json", "r"))
+        self.registry = registry if registry is not None else lib.ContractRegistry.ContractRegistry(w3)
         self.log = logger
+        self.journal = journal
         
         self.synthetix_contract = self.w3.eth.contract(address = synthetix_contract_address,
                                                        abi = json.load(open("./abis/synthetix_abi.json", "r")))
         
         self.synths = {}  #synth_name => synth contract instance
-        self.contracts = {}
+        self.sent_txns = {}  #tx_hash => {'txn', 'trader', 'nonce'} of broadcast txes, see popSentTransaction
+        self._sent_lock = threading.Lock()
+        self.multicall = lib.Multicall.Multicall(self.w3, multicall_address, batch_size, logger)
+        
+        #gas price limit, synth addresses and exchange rates, fetched once per block
+        self.market = lib.MarketDataCache.MarketDataCache(self.w3, self.synthetix_contract, self.multicall, logger)
         
         self.signing_accounts = signing_accounts
         self.min_fee_rate = min_fee_rate
+        
+        #Nonces are handed out locally. Sync them with the node at startup.
+        self.nonces = lib.NonceManager.NonceManager(self.w3, logger)
+        self.nonces.syncAll(self.signing_accounts.keys())
         if network == "mainnet":
             self.chainId = 1
         elif network == "kovan":
@@ -31,110 +54,138 @@ class TradeExecutor():
         else:
             raise ValueError("Unknown network name")
         
+        #trade txes are built from a template with precomputed calldata (see lib.ContractRegistry)
+        self.tx_builder = lib.ContractRegistry.TradeTxBuilder(self.chainId, self.min_fee_rate)
+        self.type2 = lib.Type2Engine.Type2Engine(type2_dust_usd)
         
-    def executeOne(self, trade_signal, contract_address, contract_state, min_fee_rate = 0):
+        
+    def executeOne(self, trade_signal, contract_address, contract_state, min_fee_rate = 0, balances = None,
+                   trades = None):
         """Call the trade method on a single contract.
         
         min_fee_rate: the minimum fee rate accepted by this server.
+        balances: optional dictionary of {"synth_name": balance} for the synths of the signal, e.g. a row
+                  of getBalancesBulk. If None, the balances are read from the chain.
+        trades: optional list of (from_synth, amount, to_synth) computed beforehand, e.g. by planType2Bulk. 
+                If given, the balances are not used.
         
         Returns: iterable of the tx_hashes of the transactions. Returns [] if an error."""
-        if not contract_address in self.contracts:
-            self.contracts[contract_address] = self.w3.eth.contract(address = contract_address, abi = self.abi)
-        k = self.contracts[contract_address]
+        start = time.time()
+        trades = self._planTrades(trade_signal, contract_address, contract_state, min_fee_rate, balances, trades)
+        if trades is None:
+            return []
+        
+        k, gpl, trades = trades
+        txn_hashes = []
+        try:
+            for from_synth, amt, to_synth in trades:
+                txn_hashes.append(self._sendTrade(k, contract_state['trader'], from_synth, amt, to_synth, gpl))
+        except:
+            self.log("Error executing {} trade signal: {}. Msg: {}".format(trade_signal['type'], trade_signal, 
+                                                                          sys.exc_info()[1]), level = "error")
+        EXECUTE_SECONDS.observe(time.time() - start, type = trade_signal['type'])
+        return txn_hashes
+    
+    def planOne(self, trade_signal, contract_address, contract_state, min_fee_rate = 0, balances = None,
+                trades = None):
+        """Like executeOne, but the trade txes are only built, not signed nor sent. Their nonces are None: 
+        they are to be allocated with allocateNonces (e.g. after the txes are simulated by lib.Preflight), 
+        or by sendTransaction.
+        
+        Returns: list of the unsigned txns, in trade order. Returns [] if an error."""
+        trades = self._planTrades(trade_signal, contract_address, contract_state, min_fee_rate, balances, trades)
+        if trades is None:
+            return []
+        k, gpl, trades = trades
+        return [self.tx_builder.build(k.address, from_synth, amt, to_synth, None, gpl) for from_synth, amt, to_synth in trades]
+    
+    def allocateNonces(self, txns, trader_address):
+        """Returns copies of the txns with consecutive nonces of the trader allocated. They are to be signed by
+        a lib.BulkSigner.BulkSigner and broadcast with broadcastSigned."""
+        return [dict(txn, nonce = self.nonces.allocate(trader_address)) for txn in txns]
+    
+    def _planTrades(self, trade_signal, contract_address, contract_state, min_fee_rate, balances, trades = None):
+        """Checks the contract state and computes the trades of the signal.
+        
+        Returns: (contract instance, gas price, list of (from_synth, amount, to_synth)), or None if 
+        the contract is skipped or an error."""
+        k = self.registry.get(contract_address)
         
         #Check that contract state info satisfies constraints
         if not contract_state['enableTrading']: 
             self.log("Trading is not enabled for the contract: {}".format(contract_address))
-            return []
+            SKIPPED.inc(reason = "trading_disabled")
+            return None
         if contract_state['feeRate'] < min_fee_rate: 
             self.log("Minimum fee rate of the contract is too low. Contract: {}".format(contract_address))
-            return []   
+            SKIPPED.inc(reason = "fee_rate")
+            return None
         
-        #Get current gas price limit that is allowed by the synthetix contract
-        gpl = self.synthetix_contract.functions.gasPriceLimit().call()     
+        #Gas price of the trade txes, at most the gas price limit that is allowed by the synthetix contract
+        gpl = self.tradeGasPrice()
         
-        if trade_signal['type'] == "type1":
-            try:
-                txn_hashes = self._executeType1(trade_signal, k, contract_state, gpl)
-            except:
-                self.log("Error executing Type1 trade signal: {}".format(trade_signal))
-                txn_hashes = []
-        elif trade_signal['type'] == "type2":
-            try:
-                txn_hashes = self._executeType2(trade_signal, k)
-            except:
-                self.log("Error executing Type2 trade signal: {}".format(trade_signal))            
-                txn_hashes = []
-        elif trade_signal['type'] == "type3":
-            try:
-                txn_hashes = self._executeType3(trade_signal, k, contract_state, gpl)
-            except:
-                self.log("Error executing Type3 trade signal: {}".format(trade_signal))            
-                txn_hashes = []
-        else:
+        if trades is not None:
+            return k, gpl, trades
+        plan = {"type1": self._planType1, "type2": self._planType2, "type3": self._planType3}.get(trade_signal['type'])
+        if plan is None:
             self.log('Trade signal *type* field was not recognized.')
-            txn_hashes = []
-        return txn_hashes
+            return None
+        try:
+            return k, gpl, plan(trade_signal, k, balances)
+        except:
+            self.log("Error executing {} trade signal: {}".format(trade_signal['type'].capitalize(), trade_signal),
+                     level = "error")
+            return None
     
-    def _executeType1(self, trade_signal, k, contract_state, gpl):
-        all_synths = set()
-        for t in trade_signal["params"]["trades"]:
-            all_synths.add(t['from'])
-            
-        balances = self.getBalances(k, all_synths)
+    def _planType1(self, trade_signal, k, balances = None):
+        if balances is None:
+            balances = self.getBalances(k, self.signalSynths(trade_signal))
         
-        txn_hashes = []
+        trades = []
         for t in trade_signal['params']['trades']:
             balance = balances.get(t['from'])
             if balance != None and balance > 0: 
                 amt = int(balance * t['percent'] / 100)
                 amt = min(balance, amt)
-            
-                src_curr_key = self._nameToKey(t['from'])
-                dst_curr_key = self._nameToKey(t['to'])
+                trades.append((t['from'], amt, t['to']))
                 
-                #Build and send transaction
-                trader_address = contract_state['trader']
-                nonce = self.w3.eth.getTransactionCount(trader_address)  
-                
-                #Build a transaction that invokes this contract's function, called transfer
-                options = {'chainId': self.chainId, 'gas': 500000, 'gasPrice': gpl, 'nonce': nonce}
-                
-                txn = k.functions.trade(src_curr_key, amt, dst_curr_key, self.min_fee_rate).buildTransaction(options)
-                
-                signed_txn = self.w3.eth.account.sign_transaction(txn, private_key=self.signing_accounts[trader_address])
-                
-                self.w3.eth.sendRawTransaction(signed_txn.rawTransaction)  
-                txn_hash = self.w3.toHex(self.w3.keccak(signed_txn.rawTransaction))   
-                txn_hashes.append(txn_hash)
-                
-        return txn_hashes
+        return trades
     
-    def _executeType2(self, trade_signal, k):
-        #TODO - this trade type requires the current exchange rates
-        raise NotImplementedError
-        #all_synths = set()
-        #for synth in trade_signal["params"]["synths"]:
-            #all_synths.add(t['from'])
-            
-        #balances = self.getBalances(k, all_synths)
+    def _planType2(self, trade_signal, k, balances = None):
+        if balances is None:
+            balances = self.getBalances(k, self.signalSynths(trade_signal))
+        return self.planType2Bulk(trade_signal, [balances])[0]
+    
+    def planType2Bulk(self, trade_signal, balances):
+        """Computes the rebalancing trades of a type2 signal for many contracts at once (see lib.Type2Engine).
+        The exchange rates are read once, for the current block.
         
-        #balance_total = sum(list(balances.values()))
-        #weight_total = float(sum(trade_signal["params"]["weights"]))
+        balances: list of {"synth_name": balance} dictionaries (or None), one per contract.
         
-        #desired_balances = {}
-        #for synth in trade_signal["params"]["synths"]:
-            #desired_balances[synth] = 
+        Returns: a list with the list of (from_synth, amount, to_synth) trades of each contract, or None for
+        the contracts whose balances are None."""
+        synths = trade_signal["params"]["synths"]
+        weights = trade_signal["params"]["weights"]
+        rows = [i for i, b in enumerate(balances) if b is not None]
+        rates = self.market.rates(synths)
+        unpriced = [synth for synth in synths if not rates[synth] > 0]
+        if unpriced:
+            self.log("No exchange rate for synths {}. They are left out of the rebalance of signal {}.".format(
+                unpriced, trade_signal['name']))
         
-    def _executeType3(self, trade_signal, k, contract_state, gpl):
-        all_synths = set()
-        for arr in trade_signal["params"]["pairs"]:
-            all_synths.add(arr[0])
-            all_synths.add(arr[1])
-            
-        balances = self.getBalances(k, all_synths)
+        trades = [None] * len(balances)
+        for i in rows:
+            trades[i] = []
+        for row, from_idx, amt, to_idx in self.type2.plan(weights, [[balances[i][s] for s in synths] for i in rows],
+                                                          [rates[s] for s in synths]):
+            trades[rows[row]].append((synths[from_idx], amt, synths[to_idx]))
+        return trades
         
-        txn_hashes = []
+    def _planType3(self, trade_signal, k, balances = None):
+        if balances is None:
+            balances = self.getBalances(k, self.signalSynths(trade_signal))
+        
+        trades = []
         for arr in trade_signal["params"]["pairs"]:
             synth1 = arr[0]; synth2 = arr[1]
             if balances[synth1] > balances[synth2]:
@@ -145,27 +196,149 @@ class TradeExecutor():
                 to_synth = synth1
                 
             if balances[from_synth] != None and balances[from_synth] > 0: 
-                amt = int(balance)
-            
-                src_curr_key = self._nameToKey(from_synth)
-                dst_curr_key = self._nameToKey(to_synth)
-                
-                #Build and send transaction
-                trader_address = contract_state['trader']
-                nonce = self.w3.eth.getTransactionCount(trader_address)  
+                amt = int(balances[from_synth])
+                trades.append((from_synth, amt, to_synth))
                 
-                #Build a transaction that invokes this contract's function, called transfer
-                options = {'chainId': self.chainId, 'gas': 500000, 'gasPrice': gpl, 'nonce': nonce}
-                
-                txn = k.functions.trade(src_curr_key, amt, dst_curr_key, self.min_fee_rate).buildTransaction(options)
-                
-                signed_txn = self.w3.eth.account.sign_transaction(txn, private_key=self.signing_accounts[trader_address])
-                
-                self.w3.eth.sendRawTransaction(signed_txn.rawTransaction)  
-                txn_hash = self.w3.toHex(self.w3.keccak(signed_txn.rawTransaction))   
-                txn_hashes.append(txn_hash)
+        return trades
+    
+    def tradeGasPrice(self):
+        """Returns the gas price of new trade txes: the node's gas price, capped at the gas price limit of the 
+        Synthetix contract. Starting below the limit leaves room to replace a stuck tx at a higher gas price 
+        (see lib.ReceiptTracker)."""
+        gas_price_limit = self.market.gasPriceLimit()
+        try:
+            return min(self.market.gasPrice(), gas_price_limit)
+        except:
+            self.log("Error reading the gas price. Using the gas price limit. Msg: {}".format(sys.exc_info()[1]),
+                     level = "error")
+            return gas_price_limit
+    
+    def _sendTrade(self, k, trader_address, from_synth, amt, to_synth, gpl):
+        """Builds, signs and sends a trade transaction. The nonce is allocated locally by self.nonces.
+        
+        Returns: the tx hash."""
+        #Build a transaction that invokes the trade function of this contract
+        txn = self.tx_builder.build(k.address, from_synth, amt, to_synth, None, gpl)
+        return self.sendTransaction(txn, trader_address)
+    
+    def sendTransaction(self, txn, trader_address):
+        """Signs and sends the transaction with a newly allocated nonce (any nonce of txn is replaced). If 
+        the nonce was out of sync, it is retried once with a re-synced nonce.
+        
+        Returns: the tx hash."""
+        start = time.time()
+        for attempt in range(2):
+            nonce = self.nonces.allocate(trader_address)
+            raw_txn = None
+            try:
+                txn = dict(txn, nonce = nonce)
+                raw_txn, _txn_hash = self.tx_builder.sign(txn, self.signing_accounts[trader_address])
                 
-        return txn_hashes
+                txn_hash = self._sendRaw(raw_txn)
+                self._recordSent(txn_hash, txn, trader_address)
+                SEND_SECONDS.observe(time.time() - start)
+                TXS_SENT.inc(kind = "trade")
+                return txn_hash
+            except:
+                error = sys.exc_info()[1]
+                txn_hash = web3.Web3.keccak(raw_txn).hex() if raw_txn is not None else None
+                if txn_hash is not None and not self.isRejection(error) and self._confirmSent(txn_hash, txn, trader_address):
+                    SEND_SECONDS.observe(time.time() - start)
+                    TXS_SENT.inc(kind = "trade")
+                    return txn_hash
+                #retry once with a re-synced nonce if the nonce was out of sync
+                if not self.nonces.reportError(trader_address, nonce, error) or attempt == 1:
+                    raise
+    
+    def broadcastSigned(self, txn, trader_address, raw_txn, txn_hash):
+        """Broadcasts a transaction planned by planOne and signed by a BulkSigner. If it cannot be sent, the 
+        error is reported to the nonce manager and raised; the later pre-signed txes of the trader should 
+        then be sent with sendTransaction (new nonces) instead. If the request failed without an answer 
+        from the node (e.g. a timeout), the node is asked for the tx first: if it has it, the tx was sent.
+        
+        Returns: the tx hash."""
+        try:
+            txn_hash = self._sendRaw(raw_txn)
+        except:
+            error = sys.exc_info()[1]
+            if not self.isRejection(error) and self._confirmSent(txn_hash, txn, trader_address):
+                TXS_SENT.inc(kind = "trade")
+                return txn_hash
+            self.nonces.reportError(trader_address, txn['nonce'], error)
+            raise
+        self._recordSent(txn_hash, txn, trader_address)
+        TXS_SENT.inc(kind = "trade")
+        return txn_hash
+    
+    def popSentTransaction(self, txn_hash):
+        """Returns (and forgets) the {'txn', 'trader', 'nonce'} record of a transaction broadcast by this 
+        executor, or None."""
+        with self._sent_lock:
+            return self.sent_txns.pop(txn_hash, None)
+    
+    def resendTransaction(self, txn, trader_address, gas_price):
+        """Re-signs the transaction (same nonce) with a new gas price and broadcasts it. Used to replace a 
+        transaction that is stuck.
+        
+        Returns: the tx hash of the replacement."""
+        txn = dict(txn, gasPrice = gas_price)
+        raw_txn, _txn_hash = self.tx_builder.sign(txn, self.signing_accounts[trader_address])
+        txn_hash = self._sendRaw(raw_txn)
+        if self.journal is not None:
+            self.journal.txSent(txn_hash, txn['to'], trader_address, txn['nonce'], txn)
+        TXS_SENT.inc(kind = "replacement")
+        return txn_hash
+    
+    def _sendRaw(self, raw_txn):
+        """Broadcasts a signed transaction. A node that already has the transaction counts as a success.
+        
+        Returns: the tx hash (the keccak of the raw transaction)."""
+        try:
+            self.w3.eth.sendRawTransaction(raw_txn)
+        except:
+            if not self.nonces.isKnownTransaction(sys.exc_info()[1]):
+                raise
+            self.log("Transaction is already known by the node: {}".format(web3.Web3.keccak(raw_txn).hex()))
+        return web3.Web3.keccak(raw_txn).hex()
+    
+    def isRejection(self, error):
+        """True if the node answered a send with an error, so the tx was not accepted. Otherwise (e.g. a timeout
+        or a connection reset) the node may or may not have received the tx."""
+        return isinstance(error, ValueError) and len(error.args) > 0 and isinstance(error.args[0], dict)
+    
+    def _confirmSent(self, txn_hash, txn, trader_address):
+        """After a send failed without an answer from the node, checks whether the node has the tx anyway. If
+        it has, the tx is recorded as sent.
+        
+        Returns: True if the node has the tx."""
+        try:
+            found = self.w3.eth.getTransaction(txn_hash) is not None
+        except:
+            found = False
+        if found:
+            self.log("Transaction was received by the node despite the send error: {}".format(txn_hash))
+            self._recordSent(txn_hash, txn, trader_address)
+        return found
+    
+    def _recordSent(self, txn_hash, txn, trader_address):
+        with self._sent_lock:
+            self.sent_txns[txn_hash] = {'txn': txn, 'trader': trader_address, 'nonce': txn['nonce']}
+        if self.journal is not None:
+            self.journal.txSent(txn_hash, txn['to'], trader_address, txn['nonce'], txn)
+    
+    def signalSynths(self, trade_signal):
+        """Returns a sorted list of the synths whose balances are needed to execute the trade signal."""
+        all_synths = set()
+        if trade_signal['type'] == "type1":
+            for t in trade_signal["params"]["trades"]:
+                all_synths.add(t['from'])
+        elif trade_signal['type'] == "type2":
+            all_synths.update(trade_signal["params"]["synths"])
+        elif trade_signal['type'] == "type3":
+            for arr in trade_signal["params"]["pairs"]:
+                all_synths.add(arr[0])
+                all_synths.add(arr[1])
+        return sorted(all_synths)
     
     def getBalances(self, contract_instance, synths):
         """
@@ -177,19 +350,40 @@ class TradeExecutor():
         """
         d = {}
         for synth in synths:
-            synth_k = self.synths.get(synth)
-            if not synth_k:
-                synth_k = self.synths[synth] = self._instantiate_synth(synth)
-                self.synths[synth] = synth_k
+            synth_k = self._getSynth(synth)
             balance = synth_k.functions.balanceOf(contract_instance.address).call()
             d[synth] = balance
         return d
+    
+    def getBalancesBulk(self, contract_addresses, synths, block_number = None):
+        """
+        Reads the balances of all the (contract, synth) pairs in a few aggregated calls pinned to one block.
+        
+        contract_addresses: list of the tradeProxy contract addresses.
+        synths: list of the synth names.
+        block_number: block to read the balances at. The latest block is used if None.
+        
+        Return: a tuple of (block_number, matrix), where matrix[i][j] is the balance (in wei) of synths[j] 
+        held by contract_addresses[i], or None if that balance could not be read.
+        """
+        synth_addresses = [self.market.synthAddress(synth) for synth in synths]
+        calls = [(synth_address, lib.Multicall.encodeCall('balanceOf(address)', ['address'], [contract_address]), ['uint256'])
+                 for contract_address in contract_addresses for synth_address in synth_addresses]
+        block_number, results = self.multicall.aggregate(calls, block_number)
+        
+        n = len(synths)
+        matrix = [[r[0] if r is not None else None for r in results[i * n:(i + 1) * n]]
+                  for i in range(len(contract_addresses))]
+        return block_number, matrix
+    
+    def _getSynth(self, synth_name):
+        synth_k = self.synths.get(synth_name)
+        if not synth_k or synth_k.address != self.market.synthAddress(synth_name):
+            synth_k = self.synths[synth_name] = self._instantiate_synth(synth_name)
+        return synth_k
                 
     def _instantiate_synth(self, synth_name):
-        currKey = self._nameToKey(synth_name)
-        address = self.synthetix_contract.functions.synths(currKey).call()
-        k = self.w3.eth.contract(address = address, abi = self.synth_abi)
-        return k
+        return self.registry.synth(self.market.synthAddress(synth_name))
     
     def _currKeyToString(self, key):
         chars = [key[i:i+2] for i in range(0, len(key), 2)][1:]
@@ -198,13 +392,7 @@ class TradeExecutor():
     
     def _nameToKey(self, synth_name):
         """Returns a 32 byte hex string ("0x54...") representing the input. """
-        s = ""
-        for i in range(32):
-            if i < len(synth_name):
-                s += hex(ord(synth_name[i]))[2:]
-            else:
-                s += "00"
-        return "0x" + s    
+        return lib.Utils.nameToKey(synth_name)
             
 if __name__ == "__main__":
     #url = """ <A URL GOES HERE>"""
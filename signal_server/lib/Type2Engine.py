@@ -0,0 +1,78 @@
+import numpy as np
+
+class Type2Engine():
+    """ Computes the rebalancing trades of a type2 signal for many contracts in one vectorized pass.
+
+        The balances of the contracts are a (contracts x synths) matrix and the rates a vector of the sUSD
+        value of one unit of each synth. For each contract, the total value is split by the weights into
+        target values. Synths above their target are sold and synths below it are bought.
+
+        The sold and bought values are matched in synth order: the cumulative sums of the surpluses and of
+        the deficits are merged, and each interval between two consecutive breakpoints is one trade from
+        the synth whose surplus covers it to the synth whose deficit covers it. This gives at most
+        (sellers + buyers - 1) trades per contract. Trades worth less than dust_usd are dropped. The trades of a
+        contract are ordered by value, largest first: a contract with a minMinsBtwTrades only makes its first
+        trade (see lib.Preflight), so that trade moves it closest to its targets.
+
+        Synths whose rate is not positive and finite can not be valued; they are left out of the rebalance
+        (they are neither sold nor bought, and their weight is ignored).
+    """
+    def __init__(self, dust_usd = 10):
+        """
+        dust_usd: the minimum value of a trade, in sUSD.
+        """
+        self.dust = dust_usd * 1e18
+
+    def plan(self, weights, balances, rates):
+        """
+        weights: the relative weights of the synths (m)
+        balances: the balances in wei (n x m), e.g. the matrix of TradeExecutor.getBalancesBulk
+        rates: the value in sUSD wei of one unit (10**18 wei) of each synth (m)
+
+        Returns: list of the trades (contract index, from synth index, amount in wei of the from synth,
+        to synth index), ordered by contract. The amounts sold of a synth never exceed its balance, and a
+        synth whose weight is 0 is sold in full."""
+        weights = np.asarray(weights, dtype = float)
+        rates = np.asarray(rates, dtype = float)
+        m = len(weights)
+        priced = np.isfinite(rates) & (rates > 0)
+        weights = np.where(priced, weights, 0)
+        rates = np.where(priced, rates, 1e18)
+        values = np.where(priced, np.asarray(balances, dtype = float).reshape(-1, m) * rates / 1e18, 0)
+        n = values.shape[0]
+        if n == 0 or weights.sum() <= 0:
+            return []
+
+        targets = values.sum(axis = 1, keepdims = True) * (weights / weights.sum())
+        surplus = np.maximum(values - targets, 0)
+        deficit = np.maximum(targets - values, 0)
+
+        cum_surplus = np.cumsum(surplus, axis = 1)
+        cum_deficit = np.cumsum(deficit, axis = 1)
+        total = np.minimum(cum_surplus[:, -1], cum_deficit[:, -1])[:, None]
+        ends = np.minimum(np.sort(np.concatenate([cum_surplus, cum_deficit], axis = 1), axis = 1), total)
+        starts = np.concatenate([np.zeros((n, 1)), ends[:, :-1]], axis = 1)
+        mids = (starts + ends) / 2
+        sellers = np.minimum((mids[:, :, None] >= cum_surplus[:, None, :]).sum(axis = 2), m - 1)
+        buyers = np.minimum((mids[:, :, None] >= cum_deficit[:, None, :]).sum(axis = 2), m - 1)
+
+        rows, cols = np.nonzero(ends - starts >= self.dust)
+        order = np.lexsort((-(ends - starts)[rows, cols], rows))   #by contract, then largest trade first
+        rows, cols = rows[order], cols[order]
+        from_idx = sellers[rows, cols]
+        to_idx = buyers[rows, cols]
+        #the position of each trade within the surplus of its synth, in wei of the synth. Amounts are the
+        #differences of the (rounded, capped) positions, so the trades of a synth add up to at most its balance
+        offset = np.concatenate([np.zeros((n, 1)), cum_surplus[:, :-1]], axis = 1)[rows, from_idx]
+        start_wei = (starts[rows, cols] - offset) * 1e18 / rates[from_idx]
+        end_wei = (ends[rows, cols] - offset) * 1e18 / rates[from_idx]
+        sold_out = (weights[from_idx] == 0) & (ends[rows, cols] >= cum_surplus[rows, from_idx] * (1 - 1e-12))
+
+        trades = []
+        for r, f, t, s, e, all_out in zip(rows.tolist(), from_idx.tolist(), to_idx.tolist(), start_wei.tolist(),
+                                          end_wei.tolist(), sold_out.tolist()):
+            balance = int(balances[r][f])
+            amount = (balance if all_out else min(max(int(e), 0), balance)) - min(max(int(s), 0), balance)
+            if amount > 0:
+                trades.append((r, f, amount, t))
+        return trades
@@ -1,17 +1,46 @@
 import web3, json
+
+def nameToKey(synth_name):
+    """Returns the 32 byte hex string ("0x54...") of the Synthetix currency key of the synth name. """
+    return "0x" + synth_name.encode().ljust(32, b"\0")[:32].hex()
+
+def batchRequest(w3, method_params):
+    """Makes the raw JSON-RPC requests, as a single batch if the provider supports it 
+    (see lib.BatchingProvider).
+    
+    method_params: list of (method, params) tuples
+    
+    Return: list of the response dictionaries ({'result': ...} or {'error': ...}), in order.
+    """
+    provider = w3.provider
+    if hasattr(provider, 'makeBatchRequest'):
+        return provider.makeBatchRequest(method_params)
+    return [provider.make_request(method, params) for method, params in method_params]
+
+RECEIPT_KEYS = ['blockHash', 'blockNumber', 'contractAddress', 'cumulativeGasUsed', 'from', 'gasUsed', 'status', 'to', 'transactionHash', 'transactionIndex']
+RECEIPT_INT_KEYS = ['blockNumber', 'cumulativeGasUsed', 'gasUsed', 'status', 'transactionIndex']
+
+def formatReceipt(r):
+    """Returns a json serializable dictionary of the main fields of a receipt. The receipt can be a web3 
+    receipt or a raw JSON-RPC receipt (with hex encoded quantities)."""
+    d = {k:r.get(k) for k in RECEIPT_KEYS}
+    for k in ['blockHash', 'transactionHash']:
+        if not isinstance(d[k], str):
+            d[k] = d[k].hex()
+    for k in RECEIPT_INT_KEYS:
+        if isinstance(d[k], str):
+            d[k] = int(d[k], 16)
+    return d
+
 def checkTxHashes(pending_tx_hashes, w3, log):
     """Fetches the status of the tx_hashes.
     
     Return: a tuple of still_pending, completed iterable.
     """
-    keys = ['blockHash', 'blockNumber', 'contractAddress', 'cumulativeGasUsed', 'from', 'gasUsed', 'status', 'to', 'transactionHash', 'transactionIndex']
     still_pending = []; completed = []
     for tx_hash, _signal, _ts in pending_tx_hashes:
         try:
-            r = w3.eth.getTransactionReceipt(tx_hash)
-            d = {k:r[k] for k in keys}
-            d['blockHash'] = d['blockHash'].hex()
-            d['transactionHash'] = d['transactionHash'].hex()
+            d = formatReceipt(w3.eth.getTransactionReceipt(tx_hash))
             if d['status'] == 1:
                 log("Success TX Included in Block: " + json.dumps(d))  
             else:
@@ -20,4 +49,4 @@ def checkTxHashes(pending_tx_hashes, w3, log):
         except web3.exceptions.TransactionNotFound:   #tx not mined yet
             still_pending.append((tx_hash, _signal, _ts))
 
-    return still_pending, completed
\ No newline at end of file
+    return still_pending, completed
@@ -7,6 +7,31 @@
 # Configure channels over which trade signals are received.
 # zmqPullSocket   => enter the socket info; set to None if not used.
 zmqPullSocket = "tcp://*:6237"
+# zmqRouterSocket => optional ROUTER socket. Each signal received on it is acknowledged back to the sender
+#                    (see trade_signal_format.md). Set to None if not used.
+zmqRouterSocket = "tcp://*:6238"
+
+#Sharded deployment (see lib/Sharding.py). signal_router.py receives the signals on the sockets above and publishes
+#them on zmqShardPubSocket to the workers, started with "python trade_signal_server.py --worker N" (N = 0, 1, ...).
+#Each worker executes the contracts whose trader it owns on a consistent hash ring (SHARD_VNODES points per worker)
+#of the live workers, and sends a heartbeat every SHARD_HEARTBEAT_SECS. A worker that is silent for
+#SHARD_TIMEOUT_SECS is dropped from the ring. Worker N serves its metrics on SHARD_METRICS_PORT_BASE + N.
+zmqShardPubSocket = "tcp://*:6239"
+zmqShardHeartbeatSocket = "tcp://*:6240"
+zmqShardSubSocket = "tcp://127.0.0.1:6239"          #address of the router's sockets, as seen from the workers
+zmqShardHeartbeatConnect = "tcp://127.0.0.1:6240"
+SHARD_HEARTBEAT_SECS = 1
+SHARD_TIMEOUT_SECS = 5
+SHARD_VNODES = 100
+SHARD_METRICS_PORT_BASE = 9110
+
+#Maximum number of pending (scheduled) signals. When full, no more signals are read from the sockets.
+MAX_PENDING_SIGNALS = 10000
+#Maximum number of messages read from a socket in one batch
+ZMQ_RECV_BATCH = 100
+#A signal with the same name, type and params as a signal received less than SIGNAL_COALESCE_SECS earlier is
+#dropped, so it is executed once. 0 disables.
+SIGNAL_COALESCE_SECS = 60
 
 #The contracts (addresses) that are to be monitored are stored in a json file
 contracts_to_monitor_fn = "contracts_to_monitor.json"
@@ -14,9 +39,67 @@ contracts_to_monitor_fn = "contracts_to_monitor.json"
 #The possible accounts for the Trader. Dictionary of address => priv_key
 signing_accounts = {"ADDRESS_GOES_HERE":"PRIV_KEY"}
 
+#Contract state and balances are read in batches through a Multicall contract (https://github.com/makerdao/multicall).
+#This is the number of getter calls that are aggregated into a single eth_call.
+MULTICALL_BATCH_SIZE = 300
+
+#Contract state changes are followed from the event logs of the monitored contracts, starting at a block 
+#cursor that is persisted to this file. Every FULL_UPDATE_MINUTES all contracts are re-read as a safety net.
+monitor_cursor_fn = "monitor_cursor.json"
+FULL_UPDATE_MINUTES = 60
+#Contracts deployed from an older tradeProxy.sol only emit labelUpdate, so they are re-read every
+#LEGACY_UPDATE_MINUTES until they have been seen emitting one of the other state events.
+LEGACY_UPDATE_MINUTES = 5
+
+#The contract states are snapshotted to this file every SNAPSHOT_MINUTES. At startup the snapshot is served at
+#once (marked stale) while the contracts are re-read in the background. None to disable.
+monitor_snapshot_fn = "monitor_snapshot.json"
+SNAPSHOT_MINUTES = 10
+
+#Maximum number of trader accounts whose contracts are executed concurrently when a signal is triggered.
+#The contracts of a single trader are always executed in order (nonce order).
+MAX_FANOUT_WORKERS = 16
+
+#The txes of a fan-out are signed in one batch by SIGNING_PROCESSES worker processes (None = number of cpus,
+#0 = sign each tx on its fan-out thread). Batches smaller than BULK_SIGN_MIN_BATCH are signed in the server process.
+SIGNING_PROCESSES = None
+BULK_SIGN_MIN_BATCH = 16
+
+#If PREFLIGHT_ENABLED, the txes of a fan-out are simulated in one batch (isTradeEligible and eth_estimateGas, pinned
+#to the latest block) before they are signed. Txes that would revert are dropped, and the gas limit of the others is
+#their estimate plus GAS_LIMIT_MARGIN_PCT percent.
+PREFLIGHT_ENABLED = True
+GAS_LIMIT_MARGIN_PCT = 20
+
+#A trade tx that is not included within REPLACE_AFTER_BLOCKS blocks is replaced by a tx with the same nonce and
+#a gas price that is GAS_PRICE_BUMP_PCT percent higher (capped at the Synthetix gasPriceLimit). 0 disables. Trade txes
+#are first sent at the node's gas price (at most the gasPriceLimit), so there is room to bump them.
+REPLACE_AFTER_BLOCKS = 20
+GAS_PRICE_BUMP_PCT = 12.5
+
+#The scheduled signals, the progress of each fan-out and the txes in flight are journaled to this SQLite file
+#and recovered at startup (None to disable). Journal writes are committed in batches every JOURNAL_COMMIT_MS.
+journal_fn = "journal.db"
+JOURNAL_COMMIT_MS = 50
+
+#Metrics (Prometheus text format) are served on http://127.0.0.1:METRICS_PORT/metrics (None to disable).
+#If PROFILER_ENABLED, http://127.0.0.1:METRICS_PORT/profile?seconds=10 samples the stacks of the running server.
+METRICS_PORT = 9101
+PROFILER_ENABLED = False
+
+#Log records are written as JSON lines to log_fn, which is rotated at LOG_MAX_MB (LOG_BACKUPS files are kept).
+#The node's view of a broadcast tx (eth_getTransaction) is logged for a LOG_TX_SAMPLE fraction of the txes.
+log_fn = "logger.jsonl"
+LOG_MAX_MB = 50
+LOG_BACKUPS = 5
+LOG_TX_SAMPLE = 0.01
+
 #the minimum fee rate that is accepted by the server (in units of basis points * 10000; e.g. 0.02% fee rate = 200)
 MIN_FEE_RATE = 0
 
+#type2 (weighted rebalancing) trades worth less than TYPE2_DUST_USD sUSD are not made
+TYPE2_DUST_USD = 10
+
 #if the scheduled execution time for a signal is more than this number of minutes 
 #in the  past, the signal is not executed.
 MAX_MINS_BEHIND= 5
@@ -26,20 +109,48 @@ MAX_MINS_BEHIND= 5
 #
 # network = "mainnet" or "kovan"
 network = "mainnet"
+# A url can also be a list of node urls. Reads are then sent to the fastest endpoint (and duplicated to the next one
+# if the answer takes longer than the endpoint's p95 latency, within RPC_HEDGE_MIN_MS..RPC_HEDGE_MAX_MS), signed txes
+# are broadcast to all of them, and an endpoint is ejected for RPC_BREAKER_COOLDOWN_SECS after RPC_BREAKER_FAILURES
+# consecutive failures. See lib/EndpointPool.py.
 kovan_url = """KOVAN NODE URL GOES HERE"""    #kovan url, if connecting via HTTP to kovan
 main_url =  """mainnet NODE URL GOES HERE"""
+#
+# Requests made by the server threads within RPC_BATCH_WINDOW_MS of each other are merged into one JSON-RPC
+# batch request (set to 0 to disable). RPC_POOL_SIZE is the number of keep-alive HTTP connections (per node).
+RPC_BATCH_WINDOW_MS = 2
+RPC_POOL_SIZE = 16
+RPC_HEDGE_MIN_MS = 50
+RPC_HEDGE_MAX_MS = 1000
+RPC_BREAKER_FAILURES = 3
+RPC_BREAKER_COOLDOWN_SECS = 30
 def getWeb3Instance():
-    import web3
+    import web3, lib.EndpointPool, lib.Metrics
     if network == "kovan":
-        provider = web3.Web3.HTTPProvider(kovan_url)
+        url = kovan_url
     elif network == "mainnet":
-        provider = web3.Web3.HTTPProvider(main_url)
+        url = main_url
+    provider = lib.EndpointPool.makeProvider(url, RPC_BATCH_WINDOW_MS, RPC_POOL_SIZE, hedge_min_ms = RPC_HEDGE_MIN_MS,
+                                             hedge_max_ms = RPC_HEDGE_MAX_MS, breaker_failures = RPC_BREAKER_FAILURES,
+                                             breaker_cooldown_secs = RPC_BREAKER_COOLDOWN_SECS)
     w3 = web3.Web3(provider)        
+    w3.middleware_onion.add(lib.Metrics.rpcMiddleware, "metrics")
     return w3  
 def getSynthetixAddress():
     """Address of the synthetix contract"""
     if network == "kovan":
         return  "0x22f1ba6dB6ca0A065e1b7EAe6FC22b7E675310EF"
     elif network == "mainnet":
-        return "0xC011A72400E58ecD99Ee497CF89E3775d4bd732F"    
-    
+        return "0xC011A72400E58ecD99Ee497CF89E3775d4bd732F"
+def getMulticallAddress():
+    """Address of the Multicall contract. Return None to read contract state without aggregation."""
+    if network == "kovan":
+        return "0x2cc8688C5f75E365aaEEb4ea8D6a480405A48D2A"
+    elif network == "mainnet":
+        return "0xeefBa1e63905eF1D7ACbA5a8513c70307C1cE441"
+def getTradeProxyFactoryAddress():
+    """Address of the tradeProxyFactory. Contracts created by the factory are monitored automatically."""
+    if network == "kovan":
+        return "0x1F211b8Ea061F6b90153e9d4B2FBE3808b574aA8"
+    elif network == "mainnet":
+        return None
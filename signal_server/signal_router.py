@@ -0,0 +1,50 @@
+import threading, sys
+import lib.SignalManager, lib.Journal, lib.Metrics, lib.AsyncLogger, lib.Sharding
+import server_config as cfg
+
+# Front process of a sharded deployment (see lib/Sharding.py). It receives the signals on the zmq sockets of the
+# server (zmqPullSocket, zmqRouterSocket) and publishes each signal to the shard workers when it is due. The
+# workers are started with: python trade_signal_server.py --worker N
+
+#log records are written to a rotating JSON lines file by a background thread
+log = lib.AsyncLogger.AsyncLogger(lib.Sharding.workerFile(cfg.log_fn, "router"), cfg.LOG_MAX_MB, cfg.LOG_BACKUPS)
+
+
+def main():
+    if cfg.METRICS_PORT:
+        lib.Metrics.startServer(cfg.METRICS_PORT, profiler = cfg.PROFILER_ENABLED)
+
+    # The journal keeps the scheduled signals across restarts of the router.
+    journal = lib.Journal.Journal(lib.Sharding.workerFile(cfg.journal_fn, "router"), log, cfg.JOURNAL_COMMIT_MS) \
+              if cfg.journal_fn else None
+    recovered = journal.recover() if journal is not None else None
+
+    # ShardRouter publishes the signals to the workers and tracks the live workers from their heartbeats.
+    router = lib.Sharding.ShardRouter(cfg.zmqShardPubSocket, cfg.zmqShardHeartbeatSocket, log,
+                                      cfg.SHARD_HEARTBEAT_SECS, cfg.SHARD_TIMEOUT_SECS)
+    threading.Thread(target=router.run).start()
+
+    # SignalManager receives, validates, de-duplicates and schedules the signals, as in the single process server.
+    sm = lib.SignalManager.SignalManager(cfg, log, journal)
+    if recovered:
+        sm.restore(recovered)
+        #a signal marked executing may or may not have been published before the restart. It is not re-published,
+        #so that no contract is traded twice.
+        for signal, _executed in recovered['executing']:
+            log("Signal may not have been published before the restart: {}".format(signal))
+
+    while True:
+        #wakes up when a signal is due
+        sm.waitForSignals(5)
+        triggered_signals, error_signals = sm.triggeredSignals(cfg.MAX_MINS_BEHIND)
+        for signal in triggered_signals:
+            router.publish(signal)
+            if journal is not None:
+                journal.signalStatus(signal, "done")
+            log("Signal published to the shard workers: {}".format(signal['name']), workers = router.members())
+
+if __name__ == "__main__":
+    try:
+        main()
+    except:
+        log("Unhandled error - SHUTTING DOWN: {}".format(sys.exc_info()[0]), level = "error")
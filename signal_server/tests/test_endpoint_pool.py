@@ -0,0 +1,84 @@
+import time, unittest
+import web3
+from eth_account import Account
+import lib.EndpointPool
+from bench.rpc_standin import RPCStandIn, contractAddress
+
+FEE_RATE = web3.Web3.keccak(text = "feeRate()")[:4].hex()
+
+class EndpointPoolTest(unittest.TestCase):
+    """Runs an EndpointPool against three stand-in nodes."""
+    def setUp(self):
+        self.standins = [RPCStandIn(2, 1).start() for _ in range(3)]
+        self.pool = lib.EndpointPool.EndpointPool([s.url for s in self.standins], batch_window_ms = 0, pool_size = 2,
+                                                  hedge_min_ms = 20, hedge_max_ms = 20, breaker_failures = 2,
+                                                  breaker_cooldown_secs = 60, timeout = 5)
+        self.w3 = web3.Web3(self.pool)
+
+    def tearDown(self):
+        for s in self.standins:
+            s.stop()
+
+    def calls(self, method):
+        return [s.counters.get(method, 0) for s in self.standins]
+
+    def test_failover_on_http_error(self):
+        self.standins[0].http_status = 503
+        self.assertEqual(self.w3.eth.blockNumber, 1000)
+        self.assertEqual(self.standins[0].counters.get('http_errors'), 1)
+
+    def test_failover_on_error_response(self):
+        self.standins[0].rpc_error = "header not found"
+        self.assertEqual(self.w3.eth.call({'to': contractAddress(0), 'data': FEE_RATE}, 1000), (100).to_bytes(32, 'big'))
+        self.assertEqual(self.calls('eth_call')[0], 1)
+        self.assertEqual(self.pool.stats()[0]['failures'], 2)    #eth_chainId and eth_call
+
+    def test_error_response_of_every_endpoint_is_returned(self):
+        for s in self.standins:
+            s.rpc_error = "header not found"
+        with self.assertRaises(ValueError):
+            self.w3.eth.blockNumber
+        self.assertTrue(all(self.calls('eth_blockNumber')))
+
+    def test_revert_is_not_retried(self):
+        with self.assertRaises(ValueError):
+            self.w3.eth.call({'to': contractAddress(0), 'data': '0x12345678'}, 1000)
+        self.assertEqual(sum(self.calls('eth_call')), 1)
+
+    def test_pinned_read_is_not_hedged(self):
+        for s in self.standins:
+            s.rtt = 0.1
+        self.w3.eth.call({'to': contractAddress(0), 'data': FEE_RATE}, 1000)
+        time.sleep(0.3)
+        self.assertEqual(sum(self.calls('eth_call')), 1)
+        self.w3.eth.call({'to': contractAddress(0), 'data': FEE_RATE})
+        time.sleep(0.3)
+        self.assertGreaterEqual(sum(self.calls('eth_call')), 3)
+
+    def test_ejection(self):
+        self.standins[0].http_status = 503
+        for _ in range(3):
+            self.w3.eth.blockNumber
+        self.assertEqual(self.standins[0].counters.get('http_errors'), 2)
+        self.assertEqual([e['ejected'] for e in self.pool.stats()], [True, False, False])
+
+    def signed(self, nonce):
+        key = next(iter(self.standins[0].trader_keys.values()))
+        return Account.sign_transaction({'to': contractAddress(0), 'value': 0, 'gas': 21000, 'gasPrice': 10**9,
+                                         'nonce': nonce, 'chainId': 1}, key).rawTransaction
+
+    def test_broadcast(self):
+        raw = self.signed(0)
+        self.standins[2].http_status = 503
+        tx_hash = self.w3.eth.sendRawTransaction(raw)
+        self.pool.pool.shutdown(wait = True)    #the pool returns after the first endpoint accepted the tx
+        self.assertEqual([[h for _ts, h in s.sent] for s in self.standins], [[tx_hash.hex()], [tx_hash.hex()], []])
+
+    def test_tx_pool_errors_are_not_failures(self):
+        self.standins[1].rpc_error = self.standins[2].rpc_error = "already known"
+        for nonce in range(5):
+            self.w3.eth.sendRawTransaction(self.signed(nonce))
+        self.pool.pool.shutdown(wait = True)
+        self.assertEqual(self.calls('eth_sendRawTransaction'), [5, 5, 5])
+        self.assertEqual([e['ejected'] for e in self.pool.stats()], [False, False, False])
+        self.assertEqual([e['failures'] for e in self.pool.stats()], [0, 0, 0])
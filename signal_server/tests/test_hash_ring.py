@@ -0,0 +1,31 @@
+import unittest
+import lib.HashRing
+
+KEYS = ["0x{:040x}".format(i * 7919) for i in range(5000)]
+
+class HashRingTest(unittest.TestCase):
+    def owners(self, ring):
+        return {key: ring.node(key) for key in KEYS}
+
+    def test_empty(self):
+        self.assertIsNone(lib.HashRing.HashRing().node(KEYS[0]))
+
+    def test_add_moves_keys_to_the_new_node_only(self):
+        ring = lib.HashRing.HashRing(range(4))
+        before = self.owners(ring)
+        ring.add(4)
+        moved = [key for key, node in self.owners(ring).items() if node != before[key]]
+        self.assertTrue(all(ring.node(key) == 4 for key in moved))
+        self.assertLess(abs(len(moved) / len(KEYS) - 1 / 5.), 0.08)
+
+    def test_remove_moves_the_keys_of_the_node_only(self):
+        ring = lib.HashRing.HashRing(range(5))
+        before = self.owners(ring)
+        ring.remove(2)
+        after = self.owners(ring)
+        self.assertEqual([key for key in KEYS if after[key] != before[key]], [key for key in KEYS if before[key] == 2])
+        self.assertNotIn(2, after.values())
+
+    def test_keys_are_case_insensitive(self):
+        ring = lib.HashRing.HashRing(range(5))
+        self.assertTrue(all(ring.node(key.upper()) == ring.node(key) for key in KEYS[:100]))
@@ -0,0 +1,69 @@
+import os, shutil, sqlite3, tempfile, unittest
+import lib.Journal, lib.FanoutExecutor
+
+SIGNAL = {'type': "type3", 'name': "ETH20SMACO", 'execution_time': "NOW", 'params': {'pairs': [["sUSD", "sETH"]]}}
+TRADER = "0x00000000000000000000000000000000000000aa"
+
+class _Market():
+    def stats(self):
+        return {}
+
+class _TradeExecutor():
+    """Checks, when a contract is executed, which starts of the fan-out are committed."""
+    def __init__(self, fn):
+        self.fn = fn
+        self.market = _Market()
+        self.committed = []
+    def signalSynths(self, trade_signal):
+        return []
+    def executeOne(self, trade_signal, contract_address, contract_state, min_fee_rate, balances, trades):
+        conn = sqlite3.connect(self.fn)
+        try:
+            self.committed.append(set(c for (c,) in conn.execute("SELECT contract FROM executions WHERE status = 'started'")))
+        finally:
+            conn.close()
+        return ["0x" + contract_address[2:].rjust(64, "0")]
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.dir, "journal.db")
+        self.journal = lib.Journal.Journal(self.fn, lambda s, **fields: None, commit_ms = 20)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_recover(self):
+        pending = dict(SIGNAL, id = "pending")
+        executing = dict(SIGNAL, id = "executing")
+        expired = dict(SIGNAL, id = "expired")
+        done = dict(SIGNAL, id = "done")
+        for s in (pending, executing, expired, done):
+            self.journal.signalAdded(s)
+        self.journal.signalStatus(executing, "executing")
+        self.journal.executionStarted(executing, "0x1")
+        self.journal.executionDone(executing, "0x1", ["0xaa"])
+        self.journal.executionStarted(executing, "0x2")    #interrupted before it was done
+        self.journal.signalStatus(expired, "expired")
+        self.journal.signalStatus(done, "executing")
+        self.journal.signalStatus(done, "done")
+        self.journal.txSent("0xaa", "0x1", TRADER, 3, {'nonce': 3})
+        self.journal.txSent("0xbb", "0x3", TRADER, 4, {'nonce': 4})
+        self.journal.txDone("0xbb", "success", 100)
+        self.journal.flush()
+
+        recovered = lib.Journal.Journal(self.fn, lambda s, **fields: None).recover()
+        self.assertEqual([s['id'] for s in recovered['pending']], ["pending"])
+        self.assertEqual([(s['id'], contracts) for s, contracts in recovered['executing']], [("executing", {"0x1", "0x2"})])
+        self.assertEqual([(t['tx_hash'], t['nonce'], t['txn']) for t in recovered['txs']], [("0xaa", 3, {'nonce': 3})])
+        self.assertEqual(sorted(recovered['ids']), ["done", "executing", "expired", "pending"])
+
+    def test_starts_are_committed_before_the_first_broadcast(self):
+        te = _TradeExecutor(self.fn)
+        fe = lib.FanoutExecutor.FanoutExecutor(te, 2, 0, lambda s, **fields: None, self.journal)
+        matches = [("0x{}".format(i), {'trader': TRADER}) for i in range(5)]
+        signal = dict(SIGNAL)
+        self.journal.signalAdded(signal)
+        results = fe.execute(signal, matches)
+        self.assertEqual(len([r for r in results if r[1]]), 5)
+        self.assertEqual(te.committed[0], set(m[0] for m in matches))
@@ -0,0 +1,64 @@
+import time, unittest
+import lib.NonceManager
+
+TRADER = "0x00000000000000000000000000000000000000aa"
+
+class _Eth():
+    """The pending transaction count of the node."""
+    def __init__(self):
+        self.count = 5
+        self.calls = 0
+    def getTransactionCount(self, address, block_identifier):
+        self.calls += 1
+        return self.count
+
+class _W3():
+    def __init__(self):
+        self.eth = _Eth()
+
+class NonceManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.w3 = _W3()
+        self.nm = lib.NonceManager.NonceManager(self.w3, lambda s, **fields: None)
+
+    def test_allocation_is_local_after_the_first_sync(self):
+        self.assertEqual([self.nm.allocate(TRADER) for _ in range(3)], [5, 6, 7])
+        self.assertEqual(self.w3.eth.calls, 1)
+
+    def test_idle_account_is_resynced(self):
+        self.nm.resync_secs = 0
+        self.nm.allocate(TRADER)
+        self.w3.eth.count = 9
+        time.sleep(0.01)
+        self.assertEqual(self.nm.allocate(TRADER), 9)
+
+    def test_nonce_error_resyncs(self):
+        nonce = self.nm.allocate(TRADER)
+        self.w3.eth.count = 8
+        self.assertTrue(self.nm.reportError(TRADER, nonce, ValueError({'code': -32000, 'message': 'nonce too low'})))
+        self.assertEqual(self.nm.allocate(TRADER), 8)
+
+    def test_failed_last_nonce_is_reused(self):
+        nonce = self.nm.allocate(TRADER)
+        self.assertFalse(self.nm.reportError(TRADER, nonce, ConnectionError("timeout")))
+        self.assertEqual(self.nm.allocate(TRADER), nonce)
+        self.assertEqual(self.w3.eth.calls, 1)
+
+    def test_gap_resyncs(self):
+        first = self.nm.allocate(TRADER)
+        self.nm.allocate(TRADER)
+        self.w3.eth.count = 6    #only the second tx reached the node's pool
+        self.assertFalse(self.nm.reportError(TRADER, first, ConnectionError("timeout")))
+        self.assertEqual(self.nm.allocate(TRADER), 6)
+
+    def test_known_transaction_is_not_a_nonce_error(self):
+        error = ValueError({'code': -32000, 'message': 'already known'})
+        self.assertTrue(self.nm.isKnownTransaction(error))
+        self.assertFalse(self.nm.isNonceError(error))
+        self.assertTrue(self.nm.isNonceError(ValueError({'code': -32000, 'message': 'replacement transaction underpriced'})))
+
+    def test_forget(self):
+        self.nm.allocate(TRADER)
+        self.w3.eth.count = 7
+        self.nm.forget(TRADER)
+        self.assertEqual(self.nm.allocate(TRADER), 7)
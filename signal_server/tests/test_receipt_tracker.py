@@ -0,0 +1,57 @@
+import unittest
+import lib.ReceiptTracker
+
+TRADER = "0x00000000000000000000000000000000000000aa"
+GWEI = 10**9
+
+class _Market():
+    def gasPriceLimit(self):
+        return 10 * GWEI
+
+class _TradeExecutor():
+    def __init__(self, error = None):
+        self.market = _Market()
+        self.error = error
+        self.resent = []
+    def resendTransaction(self, txn, trader, gas_price):
+        self.resent.append(gas_price)
+        if self.error is not None:
+            raise ValueError({'code': -32000, 'message': self.error})
+        return "0x{:064x}".format(len(self.resent))
+
+class ReceiptTrackerTest(unittest.TestCase):
+    def tracker(self, te):
+        self.lines = []
+        return lib.ReceiptTracker.ReceiptTracker(None, te, lambda s, **fields: self.lines.append(s), replace_after_blocks = 2, gas_bump_pct = 12.5)
+
+    def entry(self, tracker, gas_price):
+        entry = {'tx_hash': "0x01", 'signal': None, 'ts': 0, 'block': 100, 'first_ts': 0, 'first_block': 100,
+                 'trader': TRADER, 'nonce': 3, 'txn': {'nonce': 3, 'gasPrice': gas_price}}
+        tracker._addEntry(entry)
+        return entry
+
+    def test_bump(self):
+        te = _TradeExecutor()
+        rt = self.tracker(te)
+        rt._replace(self.entry(rt, 4 * GWEI), 102)
+        self.assertEqual(te.resent, [int(4.5 * GWEI)])
+        self.assertEqual(rt.pendingCount(), 2)
+
+    def test_no_replacement_below_the_minimum_bump(self):
+        te = _TradeExecutor()
+        rt = self.tracker(te)
+        entry = self.entry(rt, int(9.5 * GWEI))
+        rt._replace(entry, 102)
+        rt._replace(entry, 104)
+        self.assertEqual(te.resent, [])
+        self.assertEqual(entry['block'], 104)
+        self.assertEqual(len([l for l in self.lines if "can not be replaced" in l]), 1)
+
+    def test_underpriced_replacement_is_not_retried(self):
+        te = _TradeExecutor("replacement transaction underpriced")
+        rt = self.tracker(te)
+        entry = self.entry(rt, 4 * GWEI)
+        rt._replace(entry, 102)
+        self.assertEqual(entry['block'], 102)
+        self.assertEqual(rt.pendingCount(), 1)
+        self.assertEqual(len([l for l in self.lines if "can not be replaced" in l]), 1)
@@ -0,0 +1,71 @@
+import json, time, unittest
+import lib.Sharding, lib.HashRing
+
+MATCHES = [("0x{:040x}".format(i), {'trader': "0x{:040x}".format(i * 31 + 7)}) for i in range(300)]
+SIGNAL = {'type': "type3", 'name': "ETH20SMACO", 'execution_time': "NOW", 'params': {'pairs': [["sUSD", "sETH"]]}}
+
+def stamped(epoch, workers, **shard):
+    return dict(SIGNAL, shard = dict({'epoch': epoch, 'workers': workers}, **shard))
+
+class ShardWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.workers = [lib.Sharding.ShardWorker(i, None, None, None, lambda s, **fields: None) for i in range(3)]
+
+    def test_traders_are_split_by_the_membership_of_the_signal(self):
+        #worker 2 joined (epoch 2), but worker 0 has not received the new membership yet
+        self.workers[0]._membership({'epoch': 1, 'workers': [0, 1]})
+        for w in self.workers[1:]:
+            w._membership({'epoch': 2, 'workers': [0, 1, 2]})
+        for signal in (stamped(1, [0, 1]), stamped(2, [0, 1, 2])):
+            owned = [set(m[0] for m in w.owned(signal, MATCHES)) for w in self.workers]
+            self.assertEqual(sum(len(o) for o in owned), len(MATCHES))
+            self.assertEqual(set.union(*owned), set(m[0] for m in MATCHES))
+        self.assertEqual(self.workers[2].owned(stamped(1, [0, 1]), MATCHES), [])
+        #a signal of a newer epoch updates the membership of the worker
+        self.assertEqual(self.workers[0].epoch, 2)
+
+    def test_takeover_owns_the_traders_of_the_expired_worker_only(self):
+        previous = lib.HashRing.HashRing([0, 1, 2])
+        lost = set(m[0] for m in MATCHES if previous.node(m[1]['trader']) == 1)
+        takeover = stamped(3, [0, 2], takeover = {'worker': 1, 'workers': [0, 1, 2]})
+        owned = [set(m[0] for m in w.owned(takeover, MATCHES)) for w in (self.workers[0], self.workers[2])]
+        self.assertEqual(owned[0] | owned[1], lost)
+        self.assertFalse(owned[0] & owned[1])
+
+
+class ShardRouterTest(unittest.TestCase):
+    def setUp(self):
+        self.router = lib.Sharding.ShardRouter("tcp://127.0.0.1:*", "tcp://127.0.0.1:*", lambda s, **fields: None, timeout_secs = 5)
+        self.sent = []
+        self.router._send = lambda topic, value: self.sent.append((topic, json.loads(json.dumps(value))))
+
+    def tearDown(self):
+        self.router.pub.close()
+        self.router.heartbeats.close()
+
+    def signals(self):
+        return [v for topic, v in self.sent if topic == lib.Sharding.TOPIC_SIGNAL]
+
+    def test_signals_are_stamped_with_the_membership(self):
+        self.router.workers = {0: time.time(), 1: time.time()}
+        self.router.publish(dict(SIGNAL))
+        self.assertEqual(self.signals()[0]['shard'], {'epoch': self.router.epoch, 'workers': [0, 1]})
+
+    def test_signals_of_an_expired_worker_are_published_again(self):
+        now = time.time()
+        self.router.workers = {0: now, 1: now - 3}
+        self.router.publish(dict(SIGNAL, journal_key = "s1"))
+        self.router.workers[1] = now - 6    #missed its heartbeats
+        self.router._expire()
+        original, takeover = self.signals()
+        self.assertEqual(takeover['shard']['workers'], [0])
+        self.assertEqual(takeover['shard']['takeover'], {'worker': 1, 'workers': [0, 1]})
+        self.assertNotEqual(takeover['journal_key'], original['journal_key'])
+
+    def test_signals_are_held_when_every_worker_expired(self):
+        self.router.workers = {0: time.time()}
+        self.router.publish(dict(SIGNAL))
+        self.router.workers[0] = time.time() - 6
+        self.router._expire()
+        self.assertEqual(len(self.signals()), 1)
+        self.assertEqual([s['name'] for s in self.router.held], [SIGNAL['name']])
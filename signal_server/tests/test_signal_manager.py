@@ -0,0 +1,47 @@
+import json, threading, unittest
+import lib.SignalManager
+
+class _Config():
+    MAX_MINS_BEHIND = 5
+    MAX_PENDING_SIGNALS = 10000
+    ZMQ_RECV_BATCH = 100
+    SIGNAL_COALESCE_SECS = 0
+    zmqPullSocket = None
+    zmqRouterSocket = None
+
+def message(signal_id, pair = ("sUSD", "sETH")):
+    return json.dumps({'type': "type3", 'name': "ETH20SMACO", 'execution_time': "NOW", 'id': signal_id,
+                       'params': {'pairs': [list(pair)]}})
+
+class SignalManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.sm = lib.SignalManager.SignalManager(_Config(), lambda s, **fields: None, sockets = False)
+
+    def test_duplicate_ids(self):
+        self.assertEqual(self.sm._ingest(message("a"))['status'], "accepted")
+        self.assertEqual(self.sm._ingest(message("a"))['status'], "duplicate")
+
+    def test_rejected_id_can_be_sent_again(self):
+        self.assertEqual(self.sm._ingest(message("a", ("sUSD", "sUSD")))['status'], "rejected")
+        self.assertEqual(self.sm._ingest(message("a"))['status'], "accepted")
+
+    def test_restored_ids_are_duplicates(self):
+        self.sm.restore({'ids': ["a"], 'pending': []})
+        self.assertEqual(self.sm._ingest(message("a"))['status'], "duplicate")
+
+    def test_ingest_while_restoring(self):
+        self.sm.RECENT_IDS = 500
+        errors = []
+        def ingest():
+            try:
+                for i in range(2000):
+                    self.sm._ingest(message("zmq-{}".format(i)))
+            except Exception as e:
+                errors.append(e)
+        t = threading.Thread(target = ingest)
+        t.start()
+        for i in range(50):
+            self.sm.restore({'ids': ["journal-{}-{}".format(i, j) for j in range(100)], 'pending': []})
+        t.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(self.sm.recent_ids), self.sm.RECENT_IDS)
@@ -0,0 +1,41 @@
+import unittest
+import lib.SignalSchema
+
+def signal(signal_type, params, **fields):
+    return dict({'type': signal_type, 'name': "ETH20SMACO", 'execution_time': "NOW", 'params': params}, **fields)
+
+TYPE2 = {'synths': ["sBTC", "sETH"], 'weights': [75, 25]}
+TYPE3 = {'pairs': [["sUSD", "sETH"]]}
+
+class SignalSchemaTest(unittest.TestCase):
+    def assertValid(self, s):
+        self.assertIsNone(lib.SignalSchema.validate(s))
+
+    def assertInvalid(self, s):
+        self.assertIsNotNone(lib.SignalSchema.validate(s))
+
+    def test_valid(self):
+        self.assertValid(signal("type2", TYPE2, id = "ETH20SMACO-1000"))
+        self.assertValid(signal("type3", TYPE3, id = 7))
+        self.assertValid(signal("type1", {'trades': [{'from': "sUSD", 'to': "sETH", 'percent': 50}]}))
+
+    def test_malformed_id(self):
+        for bad_id in ([1], {'a': 1}, 1.5, True):
+            self.assertIsNotNone(lib.SignalSchema.validateId(signal("type3", TYPE3, id = bad_id)))
+            self.assertInvalid(signal("type3", TYPE3, id = bad_id))
+        self.assertIsNone(lib.SignalSchema.validateId(signal("type3", TYPE3)))
+
+    def test_bad_weights(self):
+        for weights in ([75, -25], [0, 0], [float('nan'), 1], [float('inf'), 1], [75], ["75", 25]):
+            self.assertInvalid(signal("type2", dict(TYPE2, weights = weights)))
+        self.assertValid(signal("type2", dict(TYPE2, weights = [0, 1])))
+
+    def test_bad_pairs(self):
+        for pairs in ([["sUSD", "sUSD"]], [["sUSD"]], [["sUSD", "sETH", "sBTC"]], ["sUSD"], [["sUSD", 1]]):
+            self.assertInvalid(signal("type3", {'pairs': pairs}))
+
+    def test_bad_fields(self):
+        self.assertInvalid(signal("type4", TYPE3))
+        self.assertInvalid({'type': "type3", 'params': TYPE3})
+        self.assertInvalid("not a signal")
+        self.assertInvalid(signal("type1", {'trades': [{'from': "sUSD", 'to': "sETH", 'percent': 150}]}))
@@ -0,0 +1,67 @@
+import random, unittest
+import lib.Type2Engine
+
+DUST = 10 * 1e18
+
+def scalarPlan(weights, balances, rates):
+    """The trades of one contract, matching the surpluses and the deficits synth by synth, largest first."""
+    values = [b * r / 1e18 for b, r in zip(balances, rates)]
+    targets = [sum(values) * w / sum(weights) for w in weights]
+    surplus = [max(v - t, 0) for v, t in zip(values, targets)]
+    deficit = [max(t - v, 0) for v, t in zip(values, targets)]
+    trades = []
+    i = j = 0
+    while i < len(weights) and j < len(weights):
+        if surplus[i] <= 0:
+            i += 1
+        elif deficit[j] <= 0:
+            j += 1
+        else:
+            value = min(surplus[i], deficit[j])
+            if value >= DUST:
+                trades.append((value, (i, value * 1e18 / rates[i], j)))
+            surplus[i] -= value
+            deficit[j] -= value
+    return [trade for _value, trade in sorted(trades, key = lambda t: -t[0])]
+
+class Type2EngineTest(unittest.TestCase):
+    def setUp(self):
+        rnd = random.Random(1)
+        self.weights = [50, 0, 30, 20]
+        self.rates = [1e18, 2000e18, 40000e18, 0.5e18]
+        self.balances = [[rnd.choice([0, rnd.randrange(10**24)]) for _ in self.weights] for _ in range(200)]
+        self.engine = lib.Type2Engine.Type2Engine(dust_usd = 10)
+
+    def test_bulk_matches_the_scalar_path(self):
+        bulk = {}
+        for row, from_idx, amount, to_idx in self.engine.plan(self.weights, self.balances, self.rates):
+            bulk.setdefault(row, []).append((from_idx, amount, to_idx))
+        for row, balances in enumerate(self.balances):
+            expected = scalarPlan(self.weights, balances, self.rates)
+            got = bulk.get(row, [])
+            self.assertEqual([(f, t) for f, _a, t in got], [(f, t) for f, _a, t in expected])
+            for (_f, amount, _t), (_f2, expected_amount, _t2) in zip(got, expected):
+                self.assertAlmostEqual(amount / expected_amount, 1, places = 6)
+
+    def test_amounts_within_balances(self):
+        sold = {}
+        for row, from_idx, amount, _to_idx in self.engine.plan(self.weights, self.balances, self.rates):
+            self.assertGreater(amount, 0)
+            sold[row, from_idx] = sold.get((row, from_idx), 0) + amount
+        for (row, from_idx), amount in sold.items():
+            self.assertLessEqual(amount, self.balances[row][from_idx])
+        #the synth with weight 0 is sold in full
+        for row, balances in enumerate(self.balances):
+            if balances[1] * self.rates[1] / 1e18 >= DUST:
+                self.assertEqual(sold.get((row, 1)), balances[1])
+
+    def test_unpriced_synths_are_left_out(self):
+        for rate in (0, float("inf"), float("nan")):
+            rates = [1e18, rate, 40000e18, 0.5e18]
+            plan = self.engine.plan(self.weights, self.balances, rates)
+            self.assertTrue(plan)
+            self.assertFalse([t for t in plan if 1 in (t[1], t[3])])
+        self.assertEqual(self.engine.plan([1, 1], [[10**21, 0]], [1e18, 0]), [])
+
+    def test_no_contracts(self):
+        self.assertEqual(self.engine.plan(self.weights, [], self.rates), [])
@@ -1,54 +1,130 @@
 
-import time, json, web3, threading, datetime, sys
-import lib.ContractMonitor, lib.SignalManager, lib.TradeExecutor, lib.Utils
+import time, json, web3, threading, datetime, sys, argparse
+import lib.ContractMonitor, lib.SignalManager, lib.TradeExecutor, lib.FanoutExecutor, lib.ReceiptTracker, lib.Journal, lib.Metrics, lib.ContractRegistry, lib.BulkSigner, lib.AsyncLogger, lib.Sharding, lib.Preflight
 import server_config as cfg
 
 
-def log(s):
-    dt = datetime.datetime.now().strftime("%m-%d %H:%M:%S")
-    print(dt + " " + s)
-    with open("logger.log" , 'a') as f:
-        f.write(dt + " " + s + '\n')   
+#log records are written to a rotating JSON lines file by a background thread
+log = lib.AsyncLogger.AsyncLogger(cfg.log_fn, cfg.LOG_MAX_MB, cfg.LOG_BACKUPS)
 
 
-def main():
+def executeSignal(signal, matches, fe, rt, journal, w3):
+    """Executes the signal on the matching contracts and hands the txes over to the receipt tracker."""
+    log("A signal was triggered: {}".format(signal['name']), contracts = [m[0] for m in matches],
+        stale = sum(1 for m in matches if m[1].get('stale')))
+    results = fe.execute(signal, matches)
+    if journal is not None:
+        journal.signalStatus(signal, "done")
+    for contract_address, tx_hashes, broadcast_ts in results:
+        for tx_hash in tx_hashes:
+            rt.add(tx_hash, signal, broadcast_ts)
+            #the node's view of the tx is a diagnostic; it is fetched off the critical path, for a sample of txes
+            log.defer("Initial TX receipt", lambda tx_hash = tx_hash: w3.eth.getTransaction(tx_hash), cfg.LOG_TX_SAMPLE)
+        log("Signal submitted", contract = contract_address, tx_hashes = tx_hashes, signal = signal)
+
+
+def main(worker = None):
+    """worker: the index of this process in a sharded deployment (see lib/Sharding.py). None to run as a single
+    process server."""
+    worker_id = None if worker is None else "w{}".format(worker)
+    #each worker keeps its own state files
+    state_fn = lambda fn: fn if worker_id is None else lib.Sharding.workerFile(fn, worker_id)
+    
+    metrics_port = cfg.METRICS_PORT if worker is None else cfg.SHARD_METRICS_PORT_BASE + worker
+    if metrics_port:
+        lib.Metrics.startServer(metrics_port, profiler = cfg.PROFILER_ENABLED)
+    
+    # Journal records the signals, fan-outs and txes so that the server can resume after a restart.
+    journal = lib.Journal.Journal(state_fn(cfg.journal_fn), log, cfg.JOURNAL_COMMIT_MS) if cfg.journal_fn else None
+    recovered = journal.recover() if journal is not None else None
+    
     # SignalManger manages the inputting of trade_signals. Currently a simple file system is used communicate the trade signals.
-    sm = lib.SignalManager.SignalManager(cfg, log)
+    # A shard worker receives the signals from the router (see signal_router.py) instead of the zmq sockets.
+    sm = lib.SignalManager.SignalManager(cfg, log, journal, sockets = worker is None)
+    if recovered:
+        sm.restore(recovered)
     
     # ContractMonitor monitors the state of tradeProxy.sol contracts (e.g., trading enabled, trade strategy selected, etc.). 
     w3 = cfg.getWeb3Instance()
-    cm = lib.ContractMonitor.ContractMonitor(w3, cfg.contracts_to_monitor_fn, log)
+    registry = lib.ContractRegistry.ContractRegistry(w3)   #contract handles shared by the monitor and the executor
+    cm = lib.ContractMonitor.ContractMonitor(w3, cfg.contracts_to_monitor_fn, log, 
+                                            cfg.getMulticallAddress(), cfg.MULTICALL_BATCH_SIZE,
+                                            cfg.getTradeProxyFactoryAddress(), state_fn(cfg.monitor_cursor_fn),
+                                            cfg.FULL_UPDATE_MINUTES, state_fn(cfg.monitor_snapshot_fn), cfg.SNAPSHOT_MINUTES,
+                                            registry, cfg.LEGACY_UPDATE_MINUTES)
     threading.Thread(target=cm.run).start() #start thread to periodically fetch contract state info from the blockchain
     
     # TradeExecutor submits the trade txes to the blockchain. 
     te = lib.TradeExecutor.TradeExecutor(w3, cfg.getSynthetixAddress(), cfg.signing_accounts, 
-                                         cfg.network, cfg.MIN_FEE_RATE, log)
+                                         cfg.network, cfg.MIN_FEE_RATE, log,
+                                         cfg.getMulticallAddress(), cfg.MULTICALL_BATCH_SIZE, journal, registry,
+                                         cfg.TYPE2_DUST_USD)
     
-    pending_tx_hashes = []
+    # FanoutExecutor executes a signal on all of its matching contracts concurrently (in order per trader).
+    signer = None
+    if cfg.SIGNING_PROCESSES != 0:
+        signer = lib.BulkSigner.BulkSigner(cfg.signing_accounts, cfg.SIGNING_PROCESSES, log, cfg.BULK_SIGN_MIN_BATCH)
+    preflight = None
+    if cfg.PREFLIGHT_ENABLED:
+        preflight = lib.Preflight.Preflight(w3, te.multicall, log, cfg.GAS_LIMIT_MARGIN_PCT)
+    fe = lib.FanoutExecutor.FanoutExecutor(te, cfg.MAX_FANOUT_WORKERS, cfg.MIN_FEE_RATE, log, journal, signer, preflight)
+    
+    # ReceiptTracker fetches the receipts of the pending txes once per block and replaces the stuck ones.
+    rt = lib.ReceiptTracker.ReceiptTracker(w3, te, log, cfg.REPLACE_AFTER_BLOCKS, cfg.GAS_PRICE_BUMP_PCT,
+                                           journal = journal)
+    if recovered:
+        rt.restore(recovered['txs'])
+    threading.Thread(target=rt.run).start()
+    
+    # A shard worker executes the signals on the contracts whose trader it owns on the hash ring of the live workers.
+    owned = lambda signal, matches: matches
+    if worker_id is not None:
+        def rebalance(old_ring, new_ring):
+            #another worker may have sent txes for the traders taken over. Re-sync their nonces with the node.
+            for trader_address in cfg.signing_accounts:
+                if new_ring.node(trader_address) == worker_id and old_ring.node(trader_address) != worker_id:
+                    te.nonces.forget(trader_address)
+        health = lambda: {'pending_signals': sm.pendingCount(), 'pending_txs': rt.pendingCount(),
+                          'monitored_contracts': len(cm.contract_state), 'last_block': cm.last_block}
+        shard = lib.Sharding.ShardWorker(worker_id, cfg.zmqShardSubSocket, cfg.zmqShardHeartbeatConnect, sm, log,
+                                         health, rebalance, cfg.SHARD_HEARTBEAT_SECS, cfg.SHARD_VNODES)
+        threading.Thread(target=shard.run).start()
+        if not shard.joined.wait(cfg.SHARD_TIMEOUT_SECS * 2):
+            log("Shard worker {} has not been acknowledged by the router yet".format(worker_id))
+        owned = shard.owned
+    
+    #Resume the fan-outs that were interrupted, skipping the contracts that were already executed. A fan-out
+    #whose signal is now more than MAX_MINS_BEHIND late is not resumed, as a new signal that late is not executed.
+    if recovered:
+        for signal, executed in recovered['executing']:
+            if sm.isExpired(signal, cfg.MAX_MINS_BEHIND):
+                log("Not resuming signal {}: its execution time is too far in the past. {} contracts were "
+                    "executed.".format(signal['name'], len(executed)))
+                if journal is not None:
+                    journal.signalStatus(signal, "expired")
+                continue
+            matches = [m for m in owned(signal, cm.getStatesThatMatchLabel(signal['name'])) if m[0] not in executed]
+            log("Resuming signal {}. {} contracts were already executed.".format(signal['name'], len(executed)))
+            executeSignal(signal, matches, fe, rt, journal, w3)
     
     while True:
+        #wakes up when a signal is due
+        sm.waitForSignals(5)
         triggered_signals, error_signals = sm.triggeredSignals(cfg.MAX_MINS_BEHIND)
         
         if triggered_signals:
             for signal in triggered_signals:
-                addresses = cm.getAddressesThatMatchLabel(signal['name'])
-                log("A signal was triggered: {}. Matching addresses: {}".format(signal['name'], addresses))
-                for contract_address in addresses:
-                    tx_hashes = te.executeOne(signal, contract_address, cm.getContractState(contract_address), cfg.MIN_FEE_RATE)
-                    for tx_hash in tx_hashes:
-                        log("Initial TX receipt:" + str(w3.eth.getTransaction(tx_hash)))                
-                    log("Signal submitted. Tx hash(es): {}. Signal:{}".format(tx_hashes, signal))
-                    tx_hashes = [(v, signal, time.time()) for v in tx_hashes]
-                    pending_tx_hashes.extend(tx_hashes)
-                    
-        #Check status of pending tx hashes
-        pending_tx_hashes, _completed = lib.Utils.checkTxHashes(pending_tx_hashes, w3, log)
-        
-        time.sleep(5)
+                executeSignal(signal, owned(signal, cm.getStatesThatMatchLabel(signal['name'])), fe, rt, journal, w3)
     
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Synth-Sets trade signal server")
+    parser.add_argument("--worker", type = int, default = None,
+                        help = "run as shard worker N of a sharded deployment (see signal_router.py)")
+    args = parser.parse_args()
+    if args.worker is not None:
+        log.fn = lib.Sharding.workerFile(cfg.log_fn, "w{}".format(args.worker))
     try:
-        main()
+        main(args.worker)
     except:
-        log("Unhandled error - SHUTTING DOWN: {}".format(sys.exc_info()[0]))
+        log("Unhandled error - SHUTTING DOWN: {}".format(sys.exc_info()[0]), level = "error")
     